@@ -1,18 +1,21 @@
 import os
-from flask import Flask, request, jsonify
+import json
+import atexit
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 import asyncio
 import nest_asyncio
 import uuid
 import logging
 import threading
-from langchain_core.messages import AIMessage, HumanMessage
+import queue
+import time
 
 from config import Args
-from utils.database_operation import (load_data_from_mysql, create_chroma_for_docs, save_conversation_to_mysql,
-                                      delete_session_in_mysql, delete_session_in_chroma)
-from ingestion.get_file_chunks import ingest_file_chunks
-from graphs.orchestrator import build_orchestrator
+from services import (SESSIONS, UPLOAD_JOBS, TTFT_STATS, STREAM_STATS, upload_save_path, start_upload_job,
+                      iter_upload_progress, question_error, build_question_state, session_config, get_orchestrator,
+                      finish_question, stream_answer,
+                      list_session_summaries, remove_session, collect_stats, shutdown)
 nest_asyncio.apply()
 
 args = Args()
@@ -23,48 +26,23 @@ CORS(app)
 os.makedirs(args.UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(args.CHROMA_PERSIST_DIR, exist_ok=True)
 
-# Sessions store
-# session_id -> {
-#   "vector_store": <Chroma instance>,
-#   "app_agent": <agent instance>,
-#   "docs": <list of docs>,
-#   "history": [ {role, content, ...}, ... ],
-#   "metadatas": {filename, uploaded_at}
-# }
-SESSIONS = {}
-
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-
-def load_data():
-    """initialize the SESSIONS"""
-    SESSIONS = load_data_from_mysql()
-    for session_id, session in SESSIONS.items():
-        session["app_agent"] = build_agent_for_session(session["vector_store"])
-    return SESSIONS
-
-
-def build_agent_for_session(vector_store):
-    """
-    Try to build an orchestrator/agent that uses the per-session vector_store.
-    :param vector_store:
-    :return:
-    """
-    try:
-        agent = build_orchestrator(vector_store)
-        logger.info("build orchestrator for session {session_id}")
-        return agent
-    except Exception as e:
-        logger.exception("Unexpected error while building orchestrator: %s", e)
-        raise
+# write the buffered chat messages, checkpoints and queued memories when the server stops (asgi_app.py does it in
+# its lifespan)
+atexit.register(shutdown)
 
 
 @app.route("/upload", methods=["POST"])
 def upload_pdf():
     """
-    Upload a pdf, ingest into documents, create a per-session Chroma collection and agent
-    :return: { session_id, filename, pages }
+    Upload a pdf and queue a job that ingests it into the Chroma collection of its content (shared by every
+    session of the same file), poll /upload_status/<job_id> until its stage is "done". A file that is already
+    indexed gets its session right away (200, `reused`). With `stream=1` (query string or form field) the file is
+    indexed in the request instead and the response is a stream of ndjson progress lines. The vector store of the
+    session is opened on the first /ask.
+    :return: { session_id, job_id, doc_id, reused, filename, status_url }
     """
 
     if "file" not in request.files:
@@ -74,50 +52,81 @@ def upload_pdf():
     if pdf_file.filename == '':
         return jsonify({"error": 'no selected part'}), 400
     filename = pdf_file.filename
-    save_path = os.path.join(args.UPLOAD_FOLDER, filename)
+    save_path = upload_save_path(filename)
     pdf_file.save(save_path)
     logger.info(f"saved uploaded file to {save_path}")
 
-    # Ingest and chunk PDF into documents (your helper)
-    try:
-        docs = ingest_file_chunks(save_path)
-    except Exception as e:
-        logger.exception("Failed to ingest file: %s", e)
-        return jsonify({"error": "Failed to ingest file", "details": str(e)}), 500
+    if request.values.get("stream") in ("1", "true"):
+        return Response(stream_with_context(stream_upload(save_path, filename)), mimetype="application/x-ndjson")
 
-    # create a new session
+    # create a new session, it can be asked as soon as the ingestion job is done
     session_id = str(uuid.uuid4())
+    job, reused = start_upload_job(session_id, [save_path], filename)
+    if not reused:
+        logger.info("Queued ingestion job for session %s (%s)", session_id, filename)
 
-    # Create Chroma vector store for this session
-    try:
-        vector_store = create_chroma_for_docs(docs, session_id)
-    except Exception as e:
-        logger.exception("Failed to create Chroma vector store: %s", e)
-        return jsonify({"error": "Failed to create vector store", "details": str(e)}), 500
+    return jsonify({
+        "message": "PDF already indexed, session ready" if reused else "PDF uploaded, indexing in background",
+        "session_id": session_id,
+        "job_id": session_id,
+        "doc_id": job["doc_id"],
+        "reused": reused,
+        "filename": filename,
+        "status_url": f"/upload_status/{session_id}"
+    }), 200 if reused else 202
 
-    # Build the agent for this session (attempt to pass vector_store)
-    try:
-        agent = build_agent_for_session(vector_store)
-    except Exception as e:
-        logger.exception("Failed to build agent: %s", e)
-        return jsonify({"error": "Failed to build agent", "details": str(e)}), 500
-
-    # Save session info
-    SESSIONS[session_id] = {
-        "vector_store": vector_store,
-        "app_agent": agent,
-        "docs": docs,
-        "history": [],
-        "metadatas": {"filename": filename}
-    }
-    logger.info("Created session %s for file %s (%d docs)", session_id, filename, len(docs))
+
+@app.route("/upload_batch", methods=["POST"])
+def upload_batch():
+    """
+    Upload several pdf / docx / md files (form field `files`, repeated) into one session. The files are parsed
+    in a process pool by a background job, poll /upload_status/<job_id> for the per-file parse/split/embed timings.
+    :return: { session_id, job_id, doc_id, reused, filenames, status_url }
+    """
+    uploaded = [f for f in request.files.getlist("files") if f.filename]
+    if not uploaded:
+        return jsonify({"error": 'no file part'}), 400
+    filenames, save_paths = [], []
+    for upload in uploaded:
+        save_path = upload_save_path(upload.filename)
+        upload.save(save_path)
+        filenames.append(upload.filename)
+        save_paths.append(save_path)
+    logger.info("saved %d uploaded files to %s", len(save_paths), args.UPLOAD_FOLDER)
+
+    session_id = str(uuid.uuid4())
+    filename = ", ".join(filenames)
+    job, reused = start_upload_job(session_id, save_paths, filename)
+    if not reused:
+        logger.info("Queued batch ingestion job for session %s (%d files)", session_id, len(save_paths))
 
     return jsonify({
-        "message": "PDF uploaded and processed",
+        "message": "Files already indexed, session ready" if reused else "Files uploaded, indexing in background",
         "session_id": session_id,
-        "filename": filename,
-        "pages": len(docs)
-    }), 200
+        "job_id": session_id,
+        "doc_id": job["doc_id"],
+        "reused": reused,
+        "filenames": filenames,
+        "status_url": f"/upload_status/{session_id}"
+    }), 200 if reused else 202
+
+
+@app.route("/upload_status/<job_id>", methods=["GET"])
+def upload_status(job_id):
+    """
+    Status of an ingestion job
+    :return: { job_id, filename, stage, chunks, pages, timings, error }
+    """
+    job = UPLOAD_JOBS.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job_id"}), 404
+    return jsonify(job), 200
+
+
+def stream_upload(save_path, filename):
+    """index an uploaded file batch by batch and report the progress as ndjson lines"""
+    for progress in iter_upload_progress(save_path, filename, str(uuid.uuid4())):
+        yield json.dumps(progress) + "\n"
 
 
 # Create a persistent event loop in a background thread
@@ -138,34 +147,41 @@ def run_async(coro):
     return future.result()
 
 
-@app.route("/ask", methods=["POST"])
-def ask_question():
+def prepare_question(data):
     """
-    Ask a question for a specific session
-    :return: { question: '...', session_id: '...' }
+    Validate an /ask body and build the orchestrator input for it
+    :return: ((question, session_id, session, state), None) or (None, error response)
     """
-    data = request.get_json(force=True, silent=True)
     if not data:
-        return jsonify({"error": 'Invalid json body'}), 400
+        return None, (jsonify({"error": 'Invalid json body'}), 400)
     question = data.get('question', '')
     session_id = data.get('session_id','')
 
-    session = SESSIONS[session_id]
-    app_agent = session["app_agent"]
-    docs = session['docs']
+    error = question_error(session_id)
+    if error is not None:
+        body, status = error
+        return None, (jsonify(body), status)
+    try:
+        session = SESSIONS.get(session_id)
+    except Exception as e:
+        logger.exception("Failed to activate session %s: %s", session_id, e)
+        return None, (jsonify({"error": "Failed to load session", "details": str(e)}), 500)
+    return (question, session_id, session, build_question_state(question, session_id, session)), None
 
-    state = {
-        'task': "",
-        "query": question,
-        "contents": docs,
-        "final_answer": '',
-        "final_summary": '',
-        "history": session.get("history", []),
-    }
+
+@app.route("/ask", methods=["POST"])
+def ask_question():
+    """
+    Ask a question for a specific session
+    :return: { question: '...', session_id: '...' }
+    """
+    prepared, error = prepare_question(request.get_json(force=True, silent=True))
+    if error is not None:
+        return error
+    question, session_id, session, state = prepared
 
     async def run_agent():
-        config = {'configurable': {'thread_id': session_id}}
-        result = await app_agent.ainvoke(state, config)
+        result = await get_orchestrator().ainvoke(state, session_config(session_id, session))
         return result
 
     try:
@@ -175,48 +191,90 @@ def ask_question():
         traceback.print_exc()
         return jsonify({"error": "agent execution failed", "details": str(e)}), 500
 
-    if result['task'] == 'summarize':
-        answer = result['final_summary']
-    else:
-        answer = result['final_answer']
+    answer = finish_question(question, session_id, session, result)
+    return jsonify({"answer": answer}), 200
 
-    logger.info("Session %s answered: %s", session_id, answer[:120].replace("\n", " "))
 
-    # Save history (keep minimal)
-    session["history"] = session.get("history", []) + [
-        HumanMessage(content=question),
-        AIMessage(content=answer),
-    ]
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
 
-    result = save_conversation_to_mysql(session_id, session)
-    if result is not None:
-        session['vector_store'] = result
 
-    return jsonify({"answer": answer}), 200
+@app.route("/ask_stream", methods=["POST"])
+def ask_question_stream():
+    """
+    Same as /ask, but the answer is pushed as Server-Sent Events while the LLM generates it:
+    `task` once the intent is known, `token` for every generated piece of text, then `done` with the
+    full answer and the time to first token (`error` if the orchestrator fails). Answers served from
+    a cache arrive in `done` without `token` events. The exchange is saved after the stream completes.
+    """
+    prepared, error = prepare_question(request.get_json(force=True, silent=True))
+    if error is not None:
+        return error
+    question, session_id, session, state = prepared
+    events = queue.Queue()
+
+    async def run_agent():
+        try:
+            async for item in stream_answer(get_orchestrator(), state, session_config(session_id, session)):
+                events.put(item)
+        except Exception as e:
+            logger.exception("Streaming agent failed for session %s: %s", session_id, e)
+            events.put(("error", str(e)))
+        finally:
+            events.put(None)
+
+    def generate():
+        start = time.perf_counter()
+        ttft = None
+        result = None
+        future = asyncio.run_coroutine_threadsafe(run_agent(), background_loop)
+        try:
+            while (item := events.get()) is not None:
+                kind, payload = item
+                if kind == "token":
+                    if ttft is None:
+                        ttft = time.perf_counter() - start
+                        TTFT_STATS.record(ttft)
+                    yield sse_event("token", {"text": payload})
+                elif kind == "task":
+                    yield sse_event("task", {"task": payload})
+                elif kind == "result":
+                    result = payload
+                else:
+                    yield sse_event("error", {"error": "agent execution failed", "details": payload})
+                    return
+        finally:
+            if not future.done():
+                # client went away, stop generating
+                future.cancel()
+
+        if result is None:
+            yield sse_event("error", {"error": "agent execution failed", "details": "no result"})
+            return
+        answer = finish_question(question, session_id, session, result)
+        elapsed = time.perf_counter() - start
+        STREAM_STATS.record(elapsed)
+        logger.info("Session %s streamed answer, ttft %s, total %.2fs", session_id,
+                    f"{ttft:.2f}s" if ttft is not None else "n/a (cached)", elapsed)
+        yield sse_event("done", {"answer": answer, "task": result["task"], "ttft": ttft, "elapsed": elapsed})
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @app.route("/sessions", methods=["GET"])
 def list_sessions():
     """
-    Return a list of active sessions (id + metadata)
-    """
-    global SESSIONS
-    SESSIONS = load_data()
-    word_map = {'ai': 'assistant', 'human': 'user'}
-    out = []
-    for sid, s in SESSIONS.items():
-        out.append({
-            "session_id": sid,
-            "filename": s.get("metadatas", {}).get("filename"),
-            "messages": [{"role": word_map[msg.type], "content": msg.content} for msg in s['history']]
-        })
+    Return a list of sessions (id + metadata). Only metadata is read, no session is activated here.
+    """
+    out = list_session_summaries()
     return jsonify({"sessions": out}), 200
 
 
 @app.route("/delete_session", methods=["POST"])
 def delete_session():
     """
-    Delete a session and its Chroma collection.
+    Delete a session, and the Chroma collection of its document once no other session uses it.
     """
     data = request.get_json(force=True, silent=True)
     if not data:
@@ -227,15 +285,18 @@ def delete_session():
     if session_id not in SESSIONS:
         return jsonify({"error": "Unknown session_id"}), 400
 
-    delete_session_in_mysql(session_id)
-    logging.info("Deleting specific session from mysql")
-    delete_session_in_chroma(session_id)
-    logging.info("Deleting specific session from chroma")
-    del SESSIONS[session_id]  # 移除会话入口
-    logger.info("Successfully deleted session: %s", session_id)
+    remove_session(session_id)
 
     return jsonify({"message": "Session deleted"}), 200
 
 
+@app.route("/stats", methods=["GET"])
+def stats():
+    """
+    Return runtime counters of the caches and stores
+    """
+    return jsonify(collect_stats()), 200
+
+
 if __name__ == "__main__":
     app.run(port=5000, debug=True)
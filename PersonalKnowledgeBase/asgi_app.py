@@ -0,0 +1,319 @@
+"""
+ASGI serving mode with the same routes as app.py. The orchestrator is awaited on the server's own event loop
+(no nest_asyncio, no background loop thread) and the blocking work runs in dedicated thread pools:
+session activation and streamed ingestion in the vector pool, chat history reads/writes in the db pool, and
+`asyncio.to_thread` / sync langgraph tools (query embeddings, similarity search) in the loop's default pool.
+
+usage (from PersonalKnowledgeBase/):
+    uvicorn asgi_app:app --port 5000
+"""
+import asyncio
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+from config import Args
+from utils.chroma_client import close_chroma_clients
+from services import (SESSIONS, UPLOAD_JOBS, TTFT_STATS, STREAM_STATS, upload_save_path, start_upload_job,
+                      iter_upload_progress, question_error, build_question_state, session_config, get_orchestrator,
+                      finish_question, stream_answer,
+                      list_session_summaries, remove_session, collect_stats, shutdown)
+
+args = Args()
+
+os.makedirs(args.UPLOAD_FOLDER, exist_ok=True)
+os.makedirs(args.CHROMA_PERSIST_DIR, exist_ok=True)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+VECTOR_EXECUTOR = ThreadPoolExecutor(args.asgi_vector_workers, thread_name_prefix="vector")
+DB_EXECUTOR = ThreadPoolExecutor(args.asgi_db_workers, thread_name_prefix="db")
+
+
+async def run_blocking(executor, func, *func_args):
+    return await asyncio.get_running_loop().run_in_executor(executor, partial(func, *func_args))
+
+
+async def iterate_blocking(executor, iterator):
+    """consume a blocking iterator in `executor` without holding the event loop"""
+    loop = asyncio.get_running_loop()
+    done = object()
+    while (item := await loop.run_in_executor(executor, next, iterator, done)) is not done:
+        yield item
+
+
+@asynccontextmanager
+async def lifespan(app):
+    default_executor = ThreadPoolExecutor(args.asgi_default_workers, thread_name_prefix="blocking")
+    asyncio.get_running_loop().set_default_executor(default_executor)
+    # compile the orchestrator (and load its checkpoints) and read the session list before serving, not on the
+    # event loop of the first request
+    await asyncio.to_thread(get_orchestrator)
+    await run_blocking(DB_EXECUTOR, SESSIONS.refresh)
+    yield
+    # let the queued long-term memories reach chroma before its client is closed, write the buffered
+    # checkpoints and chat messages
+    await asyncio.to_thread(shutdown, 10)
+    VECTOR_EXECUTOR.shutdown(wait=False)
+    DB_EXECUTOR.shutdown(wait=False)
+    default_executor.shutdown(wait=False)
+    close_chroma_clients()
+
+
+async def read_json(request):
+    try:
+        return await request.json()
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return None
+
+
+async def upload_pdf(request):
+    """
+    Same as /upload of app.py
+    :return: { session_id, job_id, doc_id, reused, filename, status_url }
+    """
+    form = await request.form()
+    pdf_file = form.get("file")
+    if pdf_file is None or isinstance(pdf_file, str):
+        return JSONResponse({"error": 'no file part'}, 400)
+    if pdf_file.filename == '':
+        return JSONResponse({"error": 'no selected part'}, 400)
+    filename = pdf_file.filename
+    save_path = upload_save_path(filename)
+
+    def save():
+        with open(save_path, "wb") as out:
+            shutil.copyfileobj(pdf_file.file, out)
+
+    await run_blocking(VECTOR_EXECUTOR, save)
+    logger.info(f"saved uploaded file to {save_path}")
+
+    if (request.query_params.get("stream") or form.get("stream")) in ("1", "true"):
+        async def stream_upload():
+            progress = iter_upload_progress(save_path, filename, str(uuid.uuid4()))
+            async for item in iterate_blocking(VECTOR_EXECUTOR, progress):
+                yield json.dumps(item) + "\n"
+
+        return StreamingResponse(stream_upload(), media_type="application/x-ndjson")
+
+    # create a new session, it can be asked as soon as the ingestion job is done
+    session_id = str(uuid.uuid4())
+    job, reused = await run_blocking(VECTOR_EXECUTOR, start_upload_job, session_id, [save_path], filename)
+    if not reused:
+        logger.info("Queued ingestion job for session %s (%s)", session_id, filename)
+
+    return JSONResponse({
+        "message": "PDF already indexed, session ready" if reused else "PDF uploaded, indexing in background",
+        "session_id": session_id,
+        "job_id": session_id,
+        "doc_id": job["doc_id"],
+        "reused": reused,
+        "filename": filename,
+        "status_url": f"/upload_status/{session_id}"
+    }, 200 if reused else 202)
+
+
+async def upload_batch(request):
+    """
+    Same as /upload_batch of app.py
+    :return: { session_id, job_id, doc_id, reused, filenames, status_url }
+    """
+    form = await request.form()
+    uploaded = [f for f in form.getlist("files") if not isinstance(f, str) and f.filename]
+    if not uploaded:
+        return JSONResponse({"error": 'no file part'}, 400)
+    save_paths = [upload_save_path(upload.filename) for upload in uploaded]
+    filenames = [upload.filename for upload in uploaded]
+
+    def save():
+        for upload, save_path in zip(uploaded, save_paths):
+            with open(save_path, "wb") as out:
+                shutil.copyfileobj(upload.file, out)
+
+    await run_blocking(VECTOR_EXECUTOR, save)
+    logger.info("saved %d uploaded files to %s", len(save_paths), args.UPLOAD_FOLDER)
+
+    session_id = str(uuid.uuid4())
+    filename = ", ".join(filenames)
+    job, reused = await run_blocking(VECTOR_EXECUTOR, start_upload_job, session_id, save_paths, filename)
+    if not reused:
+        logger.info("Queued batch ingestion job for session %s (%d files)", session_id, len(save_paths))
+
+    return JSONResponse({
+        "message": "Files already indexed, session ready" if reused else "Files uploaded, indexing in background",
+        "session_id": session_id,
+        "job_id": session_id,
+        "doc_id": job["doc_id"],
+        "reused": reused,
+        "filenames": filenames,
+        "status_url": f"/upload_status/{session_id}"
+    }, 200 if reused else 202)
+
+
+async def upload_status(request):
+    """
+    Status of an ingestion job
+    :return: { job_id, filename, stage, chunks, pages, timings, error }
+    """
+    job = UPLOAD_JOBS.get(request.path_params["job_id"])
+    if job is None:
+        return JSONResponse({"error": "Unknown job_id"}, 404)
+    return JSONResponse(job)
+
+
+async def prepare_question(request):
+    """
+    Validate an /ask body and activate its session
+    :return: ((question, session_id, session, state), None) or (None, error response)
+    """
+    data = await read_json(request)
+    if not data:
+        return None, JSONResponse({"error": 'Invalid json body'}, 400)
+    question = data.get('question', '')
+    session_id = data.get('session_id', '')
+
+    # an unknown session_id reloads the session list from the database
+    error = await run_blocking(DB_EXECUTOR, question_error, session_id)
+    if error is not None:
+        body, status = error
+        return None, JSONResponse(body, status)
+    try:
+        session = await run_blocking(VECTOR_EXECUTOR, SESSIONS.get, session_id)
+        state = await run_blocking(VECTOR_EXECUTOR, build_question_state, question, session_id, session)
+    except Exception as e:
+        logger.exception("Failed to activate session %s: %s", session_id, e)
+        return None, JSONResponse({"error": "Failed to load session", "details": str(e)}, 500)
+    return (question, session_id, session, state), None
+
+
+async def ask_question(request):
+    """
+    Ask a question for a specific session
+    :return: { answer: '...' }
+    """
+    prepared, error = await prepare_question(request)
+    if error is not None:
+        return error
+    question, session_id, session, state = prepared
+
+    try:
+        result = await get_orchestrator().ainvoke(state, session_config(session_id, session))
+    except Exception as e:
+        logger.exception("Agent failed for session %s: %s", session_id, e)
+        return JSONResponse({"error": "agent execution failed", "details": str(e)}, 500)
+
+    answer = await run_blocking(DB_EXECUTOR, finish_question, question, session_id, session, result)
+    return JSONResponse({"answer": answer})
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def ask_question_stream(request):
+    """
+    Same as /ask_stream of app.py: `task`, `token`... and `done` (or `error`) Server-Sent Events
+    """
+    prepared, error = await prepare_question(request)
+    if error is not None:
+        return error
+    question, session_id, session, state = prepared
+
+    async def generate():
+        start = time.perf_counter()
+        ttft = None
+        result = None
+        try:
+            async for kind, payload in stream_answer(get_orchestrator(), state, session_config(session_id, session)):
+                if kind == "token":
+                    if ttft is None:
+                        ttft = time.perf_counter() - start
+                        TTFT_STATS.record(ttft)
+                    yield sse_event("token", {"text": payload})
+                elif kind == "task":
+                    yield sse_event("task", {"task": payload})
+                else:
+                    result = payload
+        except Exception as e:
+            logger.exception("Streaming agent failed for session %s: %s", session_id, e)
+            yield sse_event("error", {"error": "agent execution failed", "details": str(e)})
+            return
+
+        if result is None:
+            yield sse_event("error", {"error": "agent execution failed", "details": "no result"})
+            return
+        answer = await run_blocking(DB_EXECUTOR, finish_question, question, session_id, session, result)
+        elapsed = time.perf_counter() - start
+        STREAM_STATS.record(elapsed)
+        logger.info("Session %s streamed answer, ttft %s, total %.2fs", session_id,
+                    f"{ttft:.2f}s" if ttft is not None else "n/a (cached)", elapsed)
+        yield sse_event("done", {"answer": answer, "task": result["task"], "ttft": ttft, "elapsed": elapsed})
+
+    return StreamingResponse(generate(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+async def list_sessions(request):
+    """
+    Return a list of sessions (id + metadata). Only metadata is read, no session is activated here.
+    """
+    out = await run_blocking(DB_EXECUTOR, list_session_summaries)
+    return JSONResponse({"sessions": out})
+
+
+async def delete_session(request):
+    """
+    Delete a session, and the Chroma collection of its document once no other session uses it.
+    """
+    data = await read_json(request)
+    if not data:
+        return JSONResponse({"error": "Invalid JSON body"}, 400)
+    session_id = data.get("session_id")
+    if not session_id:
+        return JSONResponse({"error": "No session_id provided"}, 400)
+    if not await run_blocking(DB_EXECUTOR, SESSIONS.__contains__, session_id):
+        return JSONResponse({"error": "Unknown session_id"}, 400)
+
+    await run_blocking(DB_EXECUTOR, remove_session, session_id)
+    return JSONResponse({"message": "Session deleted"})
+
+
+async def stats(request):
+    """
+    Return runtime counters of the caches and stores
+    """
+    return JSONResponse(await run_blocking(DB_EXECUTOR, collect_stats))
+
+
+app = Starlette(
+    routes=[
+        Route("/upload", upload_pdf, methods=["POST"]),
+        Route("/upload_batch", upload_batch, methods=["POST"]),
+        Route("/upload_status/{job_id}", upload_status, methods=["GET"]),
+        Route("/ask", ask_question, methods=["POST"]),
+        Route("/ask_stream", ask_question_stream, methods=["POST"]),
+        Route("/sessions", list_sessions, methods=["GET"]),
+        Route("/delete_session", delete_session, methods=["POST"]),
+        Route("/stats", stats, methods=["GET"]),
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])],
+    lifespan=lifespan,
+)
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, port=5000)
@@ -0,0 +1,89 @@
+"""
+Latency of long-term memory and chunk searches when memories share the document collection (metadata filter
+on "type" / "session_id", the layout before memories had their own collections) versus one collection for
+the chunks and one per session for its memories. Random unit vectors, so only the index and the filter are
+measured, not the embedding model.
+
+usage (from PersonalKnowledgeBase/):
+    python -m benchmarks.bench_memory_index [--chunks 5000] [--sessions 20] [--memories 50] [--queries 200]
+"""
+import argparse
+import statistics
+import tempfile
+import time
+
+import numpy as np
+
+from config import Args
+
+args = Args()
+
+
+def unit_vectors(rng, count, dim):
+    vectors = rng.standard_normal((count, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def add(collection, prefix, vectors, metadatas, batch_size=1000):
+    for start in range(0, len(vectors), batch_size):
+        end = min(start + batch_size, len(vectors))
+        collection.add(ids=[f"{prefix}{i}" for i in range(start, end)], embeddings=vectors[start:end].tolist(),
+                       documents=[f"{prefix}{i}" for i in range(start, end)], metadatas=metadatas[start:end])
+
+
+def measure(name, search, queries):
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        search(query)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    print(f"{name:<28} {statistics.mean(latencies) * 1000:>10.2f} "
+          f"{latencies[int(0.95 * (len(latencies) - 1))] * 1000:>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chunks', type=int, default=5000)
+    parser.add_argument('--sessions', type=int, default=20)
+    parser.add_argument('--memories', type=int, default=50, help='memories per session')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--dim', type=int, default=args.embedding_dim)
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args()
+
+    import chromadb
+    from chromadb.config import Settings
+    rng = np.random.default_rng(options.seed)
+    chunks = unit_vectors(rng, options.chunks, options.dim)
+    memories = unit_vectors(rng, options.sessions * options.memories, options.dim)
+    memory_sessions = [f"s{i // options.memories}" for i in range(len(memories))]
+    queries = unit_vectors(rng, options.queries, options.dim).tolist()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        client = chromadb.PersistentClient(path=tmp, settings=Settings(anonymized_telemetry=False))
+        shared = client.create_collection("shared", configuration={"hnsw": dict(args.document_hnsw)})
+        add(shared, "c", chunks, [{"type": "documents"}] * len(chunks))
+        add(shared, "m", memories, [{"type": "memory", "session_id": sid} for sid in memory_sessions])
+
+        documents = client.create_collection("documents", configuration={"hnsw": dict(args.document_hnsw)})
+        add(documents, "c", chunks, [{"type": "documents"}] * len(chunks))
+        session_memories = client.create_collection("memory_s0", configuration={"hnsw": dict(args.memory_hnsw)})
+        first = [i for i, sid in enumerate(memory_sessions) if sid == "s0"]
+        add(session_memories, "m", memories[first], [{"type": "memory", "session_id": "s0"}] * len(first))
+
+        print(f"{options.chunks} chunks, {options.sessions} sessions x {options.memories} memories, "
+              f"{options.queries} queries\n")
+        print(f"{'search':<28} {'mean ms':>10} {'p95 ms':>10}")
+        measure("chunks, shared + filter", lambda q: shared.query(
+            query_embeddings=[q], n_results=20, where={"type": "documents"}), queries)
+        measure("chunks, own collection", lambda q: documents.query(query_embeddings=[q], n_results=20), queries)
+        measure("memories, shared + filter", lambda q: shared.query(
+            query_embeddings=[q], n_results=2,
+            where={"$and": [{"type": "memory"}, {"session_id": "s0"}]}), queries)
+        measure("memories, own collection", lambda q: session_memories.query(query_embeddings=[q], n_results=2),
+                queries)
+
+
+if __name__ == '__main__':
+    main()
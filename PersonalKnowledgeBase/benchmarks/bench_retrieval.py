@@ -0,0 +1,92 @@
+"""
+Retrieval quality and latency of vector search, BM25, their reciprocal rank fusion and the optional
+cross-encoder rerank. Queries are generated from the chunks themselves (a window of words, or the rarest
+terms of the chunk, e.g. identifiers and numbers), the chunk a query was taken from is its target.
+
+usage (from PersonalKnowledgeBase/):
+    python -m benchmarks.bench_retrieval [--queries 100] [--k 2] [--rerank] [file ...]
+"""
+import argparse
+import random
+import statistics
+import time
+import uuid
+
+from config import get_embeddings, Args
+from ingestion.get_file_chunks import ingest_file_chunks
+from utils.bm25_index import BM25Index, tokenize
+from utils.hybrid_search import HybridRetriever, CrossEncoderReranker
+
+args = Args()
+DEFAULT_FILES = ['data/2024190948.pdf', 'data/PromptEngineering.md', 'data/example.docx']
+
+
+def make_queries(docs, bm25_index, count, rng):
+    """(query, target id) pairs: half natural-language windows, half keyword queries of rare terms"""
+    document_frequency = {term: len(postings) for term, postings in bm25_index.postings.items()}
+    candidates = [doc for doc in docs if len(doc.page_content.split()) >= 8]
+    queries = []
+    for i in range(count):
+        doc = rng.choice(candidates)
+        if i % 2 == 0:
+            words = doc.page_content.split()
+            start = rng.randrange(0, max(1, len(words) - 8))
+            queries.append((" ".join(words[start:start + 8]), doc.id))
+        else:
+            terms = sorted(set(tokenize(doc.page_content)), key=lambda term: (document_frequency[term], -len(term)))
+            queries.append((" ".join(terms[:3]), doc.id))
+    return queries
+
+
+def evaluate(name, retrieve, queries, k):
+    latencies, hits = [], 0
+    for query, target in queries:
+        start = time.perf_counter()
+        docs = retrieve(query, k)
+        latencies.append(time.perf_counter() - start)
+        hits += any(doc.id == target for doc in docs)
+    latencies.sort()
+    print(f"{name:<16} {hits / len(queries):>10.3f} {statistics.mean(latencies) * 1000:>10.2f} "
+          f"{latencies[int(0.95 * (len(latencies) - 1))] * 1000:>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files', nargs='*', default=DEFAULT_FILES)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--k', type=int, default=args.retrieve_top_k)
+    parser.add_argument('--candidates', type=int, default=args.retrieve_candidate_k)
+    parser.add_argument('--rerank', action='store_true', help=f'also measure the {args.rerank_model_name} rerank')
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args()
+
+    from langchain_chroma import Chroma
+    docs = [doc for file in options.files for doc in ingest_file_chunks(file)]
+    vector_store = Chroma(collection_name=f"bench_{uuid.uuid4().hex}", embedding_function=get_embeddings())
+    ids = vector_store.add_documents(docs)
+    for doc, doc_id in zip(docs, ids):
+        doc.id = doc_id
+    bm25_index = BM25Index()
+    bm25_index.add(docs, ids)
+    queries = make_queries(docs, bm25_index, options.queries, random.Random(options.seed))
+    print(f"{len(docs)} chunks, {len(queries)} queries, recall@{options.k}\n")
+
+    retrievers = {
+        "vector": HybridRetriever(vector_store).retrieve,
+        "bm25": lambda query, k: [doc for doc, _ in bm25_index.search(query, k)],
+        "hybrid": HybridRetriever(vector_store, bm25_index, candidate_k=options.candidates,
+                                  rrf_k=args.rrf_k).retrieve,
+    }
+    if options.rerank:
+        retrievers["hybrid+rerank"] = HybridRetriever(vector_store, bm25_index,
+                                                      CrossEncoderReranker(args.rerank_model_name),
+                                                      candidate_k=options.candidates, rrf_k=args.rrf_k).retrieve
+    print(f"{'retriever':<16} {'recall':>10} {'mean ms':>10} {'p95 ms':>10}")
+    for name, retrieve in retrievers.items():
+        retrieve(queries[0][0], options.k)  # warm up (model load, first query embedding)
+        evaluate(name, retrieve, queries, options.k)
+    vector_store.delete_collection()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Startup cost of the entry points: wall time and resident memory of a fresh interpreter importing a module,
+e.g. `import app`. Pass --rev to measure another git revision (exported to a temp dir) for a before/after
+comparison.
+
+usage (from PersonalKnowledgeBase/):
+    python -m benchmarks.bench_startup [--runs 5] [--rev HEAD~1] [module ...]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+DEFAULT_MODULES = ['app', 'config', 'utils.database_operation', 'ingestion.get_file_chunks']
+
+CHILD = r'''
+import importlib, json, sys, time
+start = time.perf_counter()
+importlib.import_module(sys.argv[1])
+seconds = time.perf_counter() - start
+try:
+    import psutil
+    rss = psutil.Process().memory_info().rss
+except ImportError:
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # peak rss, kB on linux
+print(json.dumps({"seconds": seconds, "rss": rss, "modules": len(sys.modules)}))
+'''
+
+
+def measure(module, cwd, runs):
+    samples = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, '-c', CHILD, module], cwd=cwd, capture_output=True, text=True)
+        if out.returncode != 0:
+            raise RuntimeError(f"import {module} failed:\n{out.stderr[-2000:]}")
+        samples.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    return {
+        "seconds": statistics.median(s["seconds"] for s in samples),
+        "rss_mb": statistics.median(s["rss"] for s in samples) / 1024 / 1024,
+        "modules": samples[-1]["modules"],
+    }
+
+
+def export_revision(rev, target):
+    """check out PersonalKnowledgeBase/ of `rev` into `target`, return the directory to run from"""
+    root = subprocess.run(['git', 'rev-parse', '--show-toplevel'], capture_output=True, text=True,
+                          check=True).stdout.strip()
+    prefix = os.path.relpath(os.getcwd(), root).replace(os.sep, '/')
+    archive = subprocess.run(['git', 'archive', rev, prefix], cwd=root, capture_output=True, check=True).stdout
+    subprocess.run(['tar', '-x', '-C', target], input=archive, check=True)
+    return os.path.join(target, prefix)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('modules', nargs='*', default=DEFAULT_MODULES)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--rev', help='git revision to measure instead of the working tree')
+    options = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cwd = export_revision(options.rev, tmp) if options.rev else os.getcwd()
+        print(f"{options.rev or 'working tree'}, median of {options.runs} runs\n")
+        print(f"{'import':<30} {'seconds':>10} {'rss MB':>10} {'modules':>10}")
+        for module in options.modules:
+            result = measure(module, cwd, options.runs)
+            print(f"{module:<30} {result['seconds']:>10.3f} {result['rss_mb']:>10.1f} {result['modules']:>10d}")
+
+
+if __name__ == '__main__':
+    main()
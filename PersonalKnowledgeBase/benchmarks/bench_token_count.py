@@ -0,0 +1,60 @@
+"""
+Collapse planning cost with the model tokenizer (`llm.get_num_tokens`) vs the memoized local TokenCounter.
+
+usage (from PersonalKnowledgeBase/):
+    python -m benchmarks.bench_token_count [--rounds 3] [file ...]
+"""
+import argparse
+import time
+
+from langchain.chains.combine_documents.reduce import split_list_of_docs
+from langchain_core.documents import Document
+
+from config import get_llm, Args
+from ingestion.get_file_chunks import ingest_file_chunks
+from utils.token_counter import TokenCounter, approx_token_count
+
+args = Args()
+DEFAULT_FILES = ['data/2024190948.pdf', 'data/PromptEngineering.md', 'data/example.docx']
+
+
+def plan_collapse(docs, length_function, rounds):
+    """replay the planning work of the summary graph: should_collapse + split_list_of_docs in every round"""
+    for _ in range(rounds):
+        length_function(docs)
+        split_list_of_docs(docs, length_func=length_function, token_max=args.max_token)
+
+
+def run(name, length_function, docs, rounds):
+    start = time.perf_counter()
+    plan_collapse(docs, length_function, rounds)
+    seconds = time.perf_counter() - start
+    tokens = length_function(docs)
+    print(f"{name:<28} {seconds * 1000:>12.2f} ms {seconds * 1e6 / rounds:>14.1f} us/round {tokens:>10d} tokens")
+    return tokens
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files', nargs='*', default=DEFAULT_FILES)
+    parser.add_argument('--rounds', type=int, default=3)
+    options = parser.parse_args()
+
+    # chunks stand in for map summaries, the planning work is the same
+    docs = []
+    for file_name in options.files:
+        docs.extend(Document(doc.page_content) for doc in ingest_file_chunks(file_name))
+    print(f"{len(docs)} chunks, {options.rounds} collapse rounds\n")
+
+    llm = get_llm()
+    model_tokens = run("llm.get_num_tokens", lambda ds: sum(llm.get_num_tokens(d.page_content) for d in ds),
+                       docs, options.rounds)
+    run("TokenCounter(model)", TokenCounter(llm.get_num_tokens).count_documents, docs, options.rounds)
+    approx_tokens = run("approx_token_count", lambda ds: sum(approx_token_count(d.page_content) for d in ds),
+                        docs, options.rounds)
+    run("TokenCounter(approx)", TokenCounter().count_documents, docs, options.rounds)
+    print(f"\napproximation error: {(approx_tokens - model_tokens) / max(model_tokens, 1):+.1%}")
+
+
+if __name__ == '__main__':
+    main()
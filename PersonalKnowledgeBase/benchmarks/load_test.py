@@ -0,0 +1,125 @@
+"""
+Throughput of /ask under concurrent sessions. Works against both serving modes, e.g.
+
+    python app.py                         # Flask + background loop
+    uvicorn asgi_app:app --port 5000      # ASGI
+
+usage (from PersonalKnowledgeBase/):
+    python -m benchmarks.load_test [--sessions 8] [--questions 5] [--file data/2024190948.pdf] [--stream]
+    python -m benchmarks.load_test --session-id <id> --session-id <id> ...   # reuse indexed sessions
+"""
+import argparse
+import asyncio
+import os
+import time
+
+import httpx
+
+from utils.latency_stats import LatencyStats
+
+QUESTIONS = [
+    'What is the main contribution of this document?',
+    'Which method is proposed and how does it work?',
+    'What data is used in the experiments?',
+    'What are the limitations mentioned by the authors?',
+    'Summarize this document',
+]
+
+
+async def create_session(client, file_name):
+    """upload a file and wait for its ingestion job"""
+    with open(file_name, 'rb') as f:
+        r = await client.post('/upload', files={'file': (os.path.basename(file_name), f.read())})
+    r.raise_for_status()
+    session_id = r.json()['session_id']
+    while True:
+        status = (await client.get(f'/upload_status/{session_id}')).json()
+        if status['stage'] == 'done':
+            return session_id
+        if status['stage'] == 'failed':
+            raise RuntimeError(f"ingestion failed: {status.get('error')}")
+        await asyncio.sleep(0.5)
+
+
+async def ask(client, session_id, question, stream):
+    """:return: (latency, time to first token or None)"""
+    start = time.perf_counter()
+    body = {'question': question, 'session_id': session_id}
+    if not stream:
+        r = await client.post('/ask', json=body)
+        r.raise_for_status()
+        return time.perf_counter() - start, None
+    ttft = None
+    async with client.stream('POST', '/ask_stream', json=body) as r:
+        r.raise_for_status()
+        async for line in r.aiter_lines():
+            if ttft is None and line == 'event: token':
+                ttft = time.perf_counter() - start
+            if line.startswith('event: error'):
+                raise RuntimeError('agent execution failed')
+    return time.perf_counter() - start, ttft
+
+
+async def run_session(client, session_id, questions, stream, latency, ttft_stats, errors):
+    """one simulated user: asks its questions one after another"""
+    for question in questions:
+        try:
+            seconds, ttft = await ask(client, session_id, question, stream)
+        except (httpx.HTTPError, RuntimeError) as e:
+            errors.append(f'{session_id[:8]}: {e}')
+            continue
+        latency.record(seconds)
+        if ttft is not None:
+            ttft_stats.record(ttft)
+
+
+async def main(options):
+    async with httpx.AsyncClient(base_url=options.url, timeout=options.timeout) as client:
+        session_ids = list(options.session_id)
+        if len(session_ids) < options.sessions:
+            start = time.perf_counter()
+            results = await asyncio.gather(*(create_session(client, options.file)
+                                              for _ in range(options.sessions - len(session_ids))),
+                                           return_exceptions=True)
+            created = [r for r in results if isinstance(r, str)]
+            session_ids.extend(created)
+            print(f"indexed {len(created)} sessions in {time.perf_counter() - start:.1f}s")
+            for failure in results:
+                if not isinstance(failure, str):
+                    print(f"  upload failed: {failure}")
+
+        questions = [QUESTIONS[i % len(QUESTIONS)] for i in range(options.questions)]
+        latency, ttft_stats, errors = LatencyStats(), LatencyStats(), []
+        start = time.perf_counter()
+        await asyncio.gather(*(run_session(client, sid, questions, options.stream, latency, ttft_stats, errors)
+                               for sid in session_ids))
+        seconds = time.perf_counter() - start
+
+        total = latency.stats()
+        print(f"{len(session_ids)} sessions x {len(questions)} questions against {options.url}"
+              f"{' (/ask_stream)' if options.stream else ''}")
+        print(f"  completed   {total['count']} in {seconds:.2f}s, {total['count'] / seconds:.2f} req/s, "
+              f"{len(errors)} errors")
+        print(f"  latency     mean {total['mean']:.3f}s  p50 {total['p50']:.3f}s  p95 {total['p95']:.3f}s  "
+              f"max {total['max']:.3f}s")
+        if options.stream:
+            ttft = ttft_stats.stats()
+            print(f"  ttft        mean {ttft['mean']:.3f}s  p50 {ttft['p50']:.3f}s  p95 {ttft['p95']:.3f}s")
+        for error in errors[:10]:
+            print(f"  error {error}")
+        if not options.keep:
+            for sid in session_ids[len(options.session_id):]:
+                await client.post('/delete_session', json={'session_id': sid})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--sessions', type=int, default=8, help='number of concurrent sessions')
+    parser.add_argument('--questions', type=int, default=5, help='questions asked per session')
+    parser.add_argument('--file', default='data/2024190948.pdf', help='file uploaded for every new session')
+    parser.add_argument('--session-id', action='append', default=[], help='already indexed session to reuse')
+    parser.add_argument('--stream', action='store_true', help='use /ask_stream and report time to first token')
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--keep', action='store_true', help='do not delete the sessions created by the test')
+    asyncio.run(main(parser.parse_args()))
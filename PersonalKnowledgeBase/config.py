@@ -1,53 +1,189 @@
 import os
-from langchain.chat_models import init_chat_model
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_chroma import Chroma
-from langchain_ollama import ChatOllama
-
-# 【注意】 如果使用Ollama的模型，代理请使用规则模式
-# 所有外网请求都走代理
-os.environ['HTTP_PROXY'] = 'http://127.0.0.1:7890'
-os.environ['HTTPS_PROXY'] = 'http://127.0.0.1:7890'
+import threading
 
 
 class Args:
     def __init__(self):
         self.max_token = 1500
+        self.max_collapse_concurrency = 4  # 摘要合并阶段同时归约的分组数
+        self.token_counter = 'approx'  # 'approx': 本地近似计数；'model': 使用llm.get_num_tokens
+        # 意图识别：先用关键词与示例问题的向量中心判断，两类相似度差小于 intent_margin 时才调用LLM
+        self.use_intent_router = True
+        self.intent_margin = 0.05
+        # 出现总结类关键词时加到“总结”相似度上的偏置
+        self.intent_keyword_prior = 0.05
+        self.intent_cache_size = 1024
+        # 语义回答缓存：同一文档上相似度不低于阈值的问题（任意会话）直接返回缓存的回答，引用对话内容的问题不缓存
+        self.use_answer_cache = True
+        self.answer_cache_threshold = 0.92
+        self.answer_cache_ttl = 3600
+        self.answer_cache_max_entries = 2000
         self.chunk_size = 1500
         self.chunk_overlap = 50
+        # 流式入库：每批嵌入的文本块数量，以及解析线程最多领先的批次数（限制内存占用）
+        self.ingest_batch_size = 64
+        self.ingest_queue_batches = 4
+        # 上传任务：后台同时处理的上传数量，以及已完成任务的状态保留时间（秒）
+        self.upload_workers = 2
+        self.upload_job_ttl = 3600
+        # 批量入库：并行解析文件的进程数
+        self.batch_ingest_workers = min(4, os.cpu_count() or 1)
+        # ASGI服务（asgi_app.py）：向量库、数据库及其余阻塞调用（嵌入、工具）各自使用的线程池大小
+        self.asgi_vector_workers = 4
+        self.asgi_db_workers = 4
+        self.asgi_default_workers = 16
         self.pdf_file_path = 'data/example.docx'
         self.use_model_way = 'api'
+        self.api_model_name = 'gemini-2.5-flash'
+        self.ollama_model_name = 'llama3.2:latest'
+        # LLM调用调度：最大并发数、每分钟token预算（None表示不限制）、失败重试次数及指数退避时间（秒）
+        self.llm_max_in_flight = 4
+        self.llm_tokens_per_minute = None
+        self.llm_max_retries = 3
+        self.llm_backoff_base = 1.0
+        self.llm_backoff_max = 30.0
         self.CHROMA_PERSIST_DIR = "data/CHROMA_PERSIST"
+        # 进程内共享一个 Chroma 客户端，最多缓存的 collection 句柄数（按最近最少使用淘汰）
+        self.max_open_collections = 64
+        # 文档文本块与长期记忆分开存放：文档一个collection，每个会话的记忆一个 memory_<session_id> collection，
+        # 两者的HNSW参数分别设置（只在collection创建时生效）
+        self.document_hnsw = {"ef_construction": 200, "ef_search": 100, "max_neighbors": 32}
+        self.memory_hnsw = {"space": "cosine", "ef_construction": 100, "ef_search": 50, "max_neighbors": 16}
+        # 混合检索：每个会话在入库时建立BM25倒排索引（保存在 BM25_PERSIST_DIR），与向量检索结果用RRF融合，
+        # 可选交叉编码器重排；retrieve_top_k 为返回给agent的文本块数，retrieve_candidate_k 为每路召回的候选数
+        self.BM25_PERSIST_DIR = "data/BM25_PERSIST"
+        self.use_hybrid_retrieval = True
+        self.retrieve_top_k = 2
+        self.retrieve_candidate_k = 20
+        self.rrf_k = 60
+        self.use_rerank = False
+        self.rerank_model_name = "cross-encoder/ms-marco-MiniLM-L-6-v2"
         self.UPLOAD_FOLDER = "data/UPLOAD_FOLDER"
         self.for_test = False
         self.mysql_user = 'root'
         self.mysql_password = os.environ.get('MYSQL_PASSWORD')
         self.mysql_database = 'qa_agent_mvp'
+        self.mysql_host = 'localhost'
+        # 聊天记录持久化：连接池大小、是否异步批量写入；chat_store_backend 为 'sqlite' 时使用本地sqlite文件代替mysql
+        self.mysql_pool_size = 5
+        self.chat_store_backend = 'mysql'
+        self.chat_store_sqlite_path = 'data/chat_history.sqlite3'
+        self.chat_store_async_writes = True
+        self.chat_store_batch_size = 64
+        self.chat_store_flush_interval = 0.5
+        # 对话检查点：保存在 checkpoint_sqlite_path，每个会话只保留最近 max_checkpoints_per_thread 个检查点，
+        # 超过 max_checkpoint_kb_per_thread 时继续删除较早的检查点
+        self.checkpoint_sqlite_path = 'data/checkpoints.sqlite3'
+        self.max_checkpoints_per_thread = 4
+        self.max_checkpoint_kb_per_thread = 256
+        # 历史窗口：对话历史超过 history_window 条消息时只保留最近 history_keep 条，较早的消息在后台总结进历史摘要
+        self.history_window = 12
+        self.history_keep = 6
+        # 长期记忆：每 memory_every_messages 条消息交给后台线程提取一次关键信息；最多 memory_batch_size 个任务
+        # （或等待 memory_batch_wait 秒）合并处理，与该会话已有记忆余弦相似度不低于 memory_dedup_threshold 的事实不再写入
+        self.memory_every_messages = 10
+        self.memory_batch_size = 16
+        self.memory_batch_wait = 2.0
+        self.memory_dedup_threshold = 0.92
+        self.memory_max_queue = 1000
+        # 会话注册表：最多同时激活（加载向量库与agent）的会话数量及估算内存上限
+        self.max_active_sessions = 8
+        self.max_active_session_mb = 512
+        self.embedding_dim = 768
+        # 嵌入模型及其磁盘缓存（按 模型名 + 文本哈希 缓存向量，超过上限后按最近最少使用淘汰）
+        self.embedding_model_name = "sentence-transformers/all-mpnet-base-v2"
+        self.embedding_model_path = "D:/PersonalLearning/20250926_LangChian/PersonalKnowledgeBase/sentence-transformers-all-mpnet-base-v2"
+        self.EMBEDDING_CACHE_PATH = "data/EMBEDDING_CACHE/embeddings.sqlite3"
+        self.embedding_cache_max_mb = 1024
+        # 嵌入服务：并发的嵌入请求在 embedding_batch_wait_ms 毫秒内合并成一批，每批最多 embedding_batch_size 条文本
+        self.embedding_batch_size = 64
+        self.embedding_batch_wait_ms = 5
+        # 摘要缓存：按文本块哈希保存map阶段摘要，按文档保存最终摘要
+        self.SUMMARY_CACHE_PATH = "data/SUMMARY_CACHE/summaries.sqlite3"
+
+    @property
+    def chat_model_name(self):
+        return self.api_model_name if self.use_model_way == 'api' else self.ollama_model_name
 
 
 args = Args()
 
 # os.environ['LANGSMITH_TRACING'] = 'True'
-llm = None
-if args.use_model_way == 'api':
-    os.environ.get('GOOGLE_API_KEY')
 
-    llm = init_chat_model("gemini-2.5-flash", model_provider='google-genai')
-else:
-    llm = ChatOllama(
-        base_url='http://localhost:11434',
-        model='llama3.2:latest',
-    )
+# The chat model, the embedding model and their libraries are loaded on first use, importing config is cheap.
+_lock = threading.Lock()
+_llm = None
+_embedding_service = None
+_embeddings = None
+
+
+def use_proxy():
+    # 【注意】 如果使用Ollama的模型，代理请使用规则模式
+    # 所有外网请求都走代理
+    os.environ['HTTP_PROXY'] = 'http://127.0.0.1:7890'
+    os.environ['HTTPS_PROXY'] = 'http://127.0.0.1:7890'
+
+
+def get_llm():
+    """chat model of `args.use_model_way`, built on the first call"""
+    global _llm
+    with _lock:
+        if _llm is None:
+            use_proxy()
+            if args.use_model_way == 'api':
+                from langchain.chat_models import init_chat_model
+                os.environ.get('GOOGLE_API_KEY')
+
+                _llm = init_chat_model(args.api_model_name, model_provider='google-genai')
+            else:
+                from langchain_ollama import ChatOllama
+                _llm = ChatOllama(
+                    base_url='http://localhost:11434',
+                    model=args.ollama_model_name,
+                )
+        return _llm
+
+
+def load_embedding_model():
+    use_proxy()
+    from langchain_huggingface import HuggingFaceEmbeddings
+    return HuggingFaceEmbeddings(model_name=args.embedding_model_path)
+
+
+def get_embedding_service():
+    """
+    one model per process, every embed call goes through the batching service, which loads the model on its
+    first batch (mpnet has no query prompt, queries and documents share batches)
+    """
+    global _embedding_service
+    with _lock:
+        if _embedding_service is None:
+            from utils.embedding_service import BatchingEmbeddings
+            _embedding_service = BatchingEmbeddings(
+                load_embedding_model,
+                max_batch_size=args.embedding_batch_size,
+                max_wait=args.embedding_batch_wait_ms / 1000,
+                queries_as_documents=True,
+            )
+        return _embedding_service
+
 
-embeddings = HuggingFaceEmbeddings(
-    model_name="D:/PersonalLearning/20250926_LangChian/PersonalKnowledgeBase/sentence-transformers-all-mpnet-base-v2"
-)
+def get_embeddings():
+    """embeddings used everywhere: disk cache in front of the embedding service, cache hits never load the model"""
+    global _embeddings
+    service = get_embedding_service()
+    with _lock:
+        if _embeddings is None:
+            from utils.embedding_cache import CachedEmbeddings
+            _embeddings = CachedEmbeddings(
+                service,
+                model_name=args.embedding_model_name,
+                path=args.EMBEDDING_CACHE_PATH,
+                max_bytes=args.embedding_cache_max_mb * 1024 * 1024,
+            )
+        return _embeddings
 
 
 def get_vector_store():
-    vector_store = Chroma(
-        collection_name="example_collection",
-        embedding_function=embeddings,
-        persist_directory="./data/chroma_langchain_db",
-    )
-    return vector_store
+    from utils.chroma_client import get_chroma_client
+    return get_chroma_client("./data/chroma_langchain_db").collection("example_collection")
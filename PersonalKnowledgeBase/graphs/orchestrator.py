@@ -1,71 +1,181 @@
+import asyncio
+import logging
+import threading
+import time
+
 from utils.types import OrchestratorState
 from langgraph.graph import StateGraph
 from langgraph.graph import START, END
-from langchain_core.messages import HumanMessage, AIMessage
-from langgraph.checkpoint.memory import MemorySaver
+from langchain_core.messages import HumanMessage, AIMessage, RemoveMessage
+from langchain_core.runnables import RunnableConfig
+from langgraph.graph.message import REMOVE_ALL_MESSAGES
 
-from prompts.intent import intent_prompt
-from prompts.qa import qa_prompt
-from config import llm
-from graphs.summary import build_summary_graph
+from prompts.intent import intent_prompt, summarize_keywords, detail_qualifiers, summarize_examples, qa_examples
+from prompts.qa import qa_prompt, history_references
+from config import get_llm, get_embeddings, Args
+from utils.llm_scheduler import llm_scheduler
+from utils.intent_router import IntentRouter
+from utils.answer_cache import SemanticAnswerCache
+from utils.checkpoint_store import BoundedCheckpointSaver
+from utils.history_summarizer import HistorySummarizer
+from utils.database_operation import load_document_texts
+from graphs.summary import build_summary_graph, get_summary_cache
 from graphs.qa import build_qa_agent
 
+args = Args()
+logger = logging.getLogger(__name__)
+history_summarizer = HistorySummarizer()
+# built on first use like the orchestrator: both need the embeddings, whose disk cache is not opened at import
+_intent_router = None
+_answer_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_intent_router():
+    global _intent_router
+    with _cache_lock:
+        if _intent_router is None:
+            _intent_router = IntentRouter(get_embeddings(), summarize_examples, qa_examples, summarize_keywords,
+                                          detail_qualifiers, margin=args.intent_margin,
+                                          keyword_prior=args.intent_keyword_prior, cache_size=args.intent_cache_size)
+        return _intent_router
+
+
+def get_answer_cache():
+    global _answer_cache
+    with _cache_lock:
+        if _answer_cache is None:
+            _answer_cache = SemanticAnswerCache(get_embeddings(), threshold=args.answer_cache_threshold,
+                                                ttl=args.answer_cache_ttl, max_entries=args.answer_cache_max_entries,
+                                                history_references=history_references)
+        return _answer_cache
+
+
+def used_tool(messages, name):
+    """True if one of the agent's messages called the tool"""
+    return any(call["name"] == name for msg in messages for call in getattr(msg, "tool_calls", None) or [])
+
 
-def format_chat_history(history):
-    if not history:
+def format_chat_history(history, summary=""):
+    if not history and not summary:
         return "No prior conversation."
-    try:
-        content = "\n".join(f"{msg.type}: {msg.content}\n" for msg in history[-10:])
-    except Exception as e:
-        print(history)
+    content = "\n".join(f"{msg.type}: {msg.content}\n" for msg in history)
+    if summary:
+        content = f"summary of the earlier conversation: {summary}\n\n{content}"
     return content
 
 
+async def compact_history(state: OrchestratorState, config: RunnableConfig):
+    """
+    Keep the thread bounded: once the history is longer than history_window messages, only the last
+    history_keep messages stay in the checkpoint and the older ones are folded into history_summary in the
+    background; the summary computed since the last turn is picked up here
+    """
+    thread_id = config['configurable'].get('thread_id')
+    update = {}
+    summary = history_summarizer.take(thread_id)
+    if summary is not None and summary != state.get('history_summary', ''):
+        update['history_summary'] = summary
+    history = state.get('history') or []
+    if len(history) > args.history_window:
+        old, kept = history[:-args.history_keep], history[-args.history_keep:]
+        history_summarizer.submit(thread_id, update.get('history_summary', state.get('history_summary', '')), old)
+        update['history'] = [RemoveMessage(id=REMOVE_ALL_MESSAGES), *kept]
+    return update
+
+
 async def judge_task(state: OrchestratorState):
-    prompt = intent_prompt.invoke({'query': state['query']})
-    resp = await llm.ainvoke(prompt.to_messages())
-    intent = resp.content.strip().lower()
-    if 'summarize' in intent or 'summary' in intent:
-        state['task'] = 'summarize'
-        return 'summarize'
-    state['task'] = 'qa'
-    return 'qa'
+    # example centroids (summary keywords as a prior) first, the LLM is only asked when they are not confident
+    task = None
+    if args.use_intent_router:
+        task = await asyncio.to_thread(get_intent_router().classify, state['query'])
+    if task is None:
+        prompt = intent_prompt.invoke({'query': state['query']})
+        resp = await llm_scheduler.ainvoke(get_llm(), prompt.to_messages())
+        intent = resp.content.strip().lower()
+        task = 'summarize' if 'summarize' in intent or 'summary' in intent else 'qa'
+        get_intent_router().remember(state['query'], task)
+    state['task'] = task
+    return task
 
 
-def build_orchestrator(vector_store):
-    summary_graph = build_summary_graph(vector_store)
-    qa_agent = build_qa_agent(vector_store)
+def build_orchestrator():
+    """
+    Compile the orchestrator. The graph does not hold any session: the session's vector store and BM25 index
+    are passed in the run config (see services.session_config) and read by the QA tools at call time.
+    """
+    summary_graph = build_summary_graph()
+    qa_agent = build_qa_agent()
 
     graph = StateGraph(OrchestratorState)
 
-    async def run_summary_task(state: OrchestratorState):
-        contents = [d.page_content for d in state['contents']]
-        result = await summary_graph.ainvoke({
-            'contents': contents
-        })
+    async def run_summary_task(state: OrchestratorState, config: RunnableConfig):
+        # chunks are read from the session's collection only when a summary is asked, they are not in the state
+        vector_store = config['configurable']['vector_store']
+        contents = await asyncio.to_thread(load_document_texts, vector_store)
+        # the document does not change within a session, repeated summaries are served from the cache
+        final_summary = get_summary_cache().get_final_summary(contents)
+        if final_summary is None:
+            result = await summary_graph.ainvoke({
+                'contents': contents
+            })
+            final_summary = result['final_summary']
+            get_summary_cache().put_final_summary(contents, final_summary)
         return {
             'task': 'summarize',
-            'final_summary': result['final_summary'],
+            'final_summary': final_summary,
         }
 
-    async def run_qa_task(state: OrchestratorState):
+    async def run_qa_task(state: OrchestratorState, config: RunnableConfig):
+        # semantically identical questions on the same document are answered from the cache, in any session
+        doc_id = state.get('doc_id')
+        cacheable = args.use_answer_cache and doc_id and get_answer_cache().cacheable(state['query'])
+        vector = None
+        if cacheable:
+            answer, vector = await asyncio.to_thread(get_answer_cache().lookup, doc_id, state['query'])
+            if answer is not None:
+                return {
+                    'task': 'qa',
+                    'final_answer': answer,
+                    'history': [HumanMessage(content=state["query"]), AIMessage(content=answer)]
+                }
+
+        start = time.perf_counter()
         prompt = qa_prompt.invoke({
             'input': state['query'],
-            'chat_history': state['history']
+            'chat_history': format_chat_history(state['history'], state.get('history_summary', ''))
         })
-        result = await qa_agent.ainvoke({'messages': prompt.to_messages()})
+        result = await qa_agent.ainvoke({'messages': prompt.to_messages()}, config)
+        answer = result['messages'][-1].content
+        # an answer built from the session's long-term memories is not shared with the other sessions
+        if cacheable and answer and not used_tool(result['messages'], 'retrieve_long_term_memory'):
+            get_answer_cache().put(doc_id, state['query'], answer, time.perf_counter() - start, vector)
         return {
             'task': 'qa',
-            'final_answer': result['messages'][-1].content,
+            'final_answer': answer,
             'history': [HumanMessage(content=state["query"]), result["messages"][-1]]
         }
 
+    graph.add_node('compact_history', compact_history)
     graph.add_node('summarize', run_summary_task)
     graph.add_node('qa', run_qa_task)
 
-    graph.add_conditional_edges(START, judge_task, ['summarize', 'qa'])
+    graph.add_edge(START, 'compact_history')
+    graph.add_conditional_edges('compact_history', judge_task, ['summarize', 'qa'])
     graph.add_edge('summarize', END)
     graph.add_edge('qa', END)
 
-    memory = MemorySaver()
-    return graph.compile(checkpointer=memory)
+    return graph.compile(checkpointer=BoundedCheckpointSaver())
+
+
+_orchestrator = None
+_orchestrator_lock = threading.Lock()
+
+
+def get_orchestrator():
+    """the orchestrator shared by all sessions, compiled on first use"""
+    global _orchestrator
+    with _orchestrator_lock:
+        if _orchestrator is None:
+            _orchestrator = build_orchestrator()
+        return _orchestrator
@@ -1,19 +1,48 @@
+import threading
+
 from prompts.qa import qa_prompt
-from config import llm, get_vector_store, Args
+from config import get_llm, get_vector_store, Args
 from ingestion.get_file_chunks import ingest_file_chunks
+from utils.hybrid_search import HybridRetriever, CrossEncoderReranker
+from utils.llm_scheduler import llm_scheduler
 
+from langchain_core.runnables import RunnableConfig
 from langchain_core.tools import tool
 from langgraph.checkpoint.memory import MemorySaver
 from langgraph.prebuilt import create_react_agent
 
 
 args = Args()
+_reranker = None
+_reranker_lock = threading.Lock()
+
+
+def get_reranker():
+    """the cross-encoder is shared by all sessions, its model is loaded on the first rerank"""
+    global _reranker
+    with _reranker_lock:
+        if _reranker is None:
+            _reranker = CrossEncoderReranker(args.rerank_model_name)
+        return _reranker
 
 
+def build_retriever(vector_store, bm25_index=None):
+    return HybridRetriever(vector_store, bm25_index,
+                           reranker=get_reranker() if args.use_rerank else None,
+                           top_k=args.retrieve_top_k, candidate_k=args.retrieve_candidate_k,
+                           rrf_k=args.rrf_k)
+
+
+# The stores of the session being answered come from the run config, not from module state:
+# config["configurable"] = {"session_id", "vector_store", "memory_store", "bm25_index"}, see services.session_config.
+# The document collection holds chunks only and each session has its own memory collection, neither search
+# needs a metadata filter.
 @tool(response_format='content')
-def retrieve_docs(query: str):
+def retrieve_docs(query: str, config: RunnableConfig):
     """ retrieve information in passage related to the query """
-    retrieved_docs = vector_store.similarity_search(query, k=2, filter={"type": "documents"})  # 取连两个最相似的文档
+    configurable = config["configurable"]
+    retriever = build_retriever(configurable["vector_store"], configurable.get("bm25_index"))
+    retrieved_docs = retriever.retrieve(query)  # BM25 + 向量检索融合，取最相关的 retrieve_top_k 个文档
     retrieved_contents = "\n\n".join(
         f"Content: {doc.page_content}\n\n" for doc in retrieved_docs
     )
@@ -21,34 +50,42 @@ def retrieve_docs(query: str):
 
 
 @tool(response_format='content')
-def retrieve_long_term_memory(query: str):
+def retrieve_long_term_memory(query: str, config: RunnableConfig):
     """retrieve the long term memory related to the query """
-    retrieved = vector_store.similarity_search(query, k=2, filter={"type": "memory"})
+    memory_store = config["configurable"].get("memory_store")
+    if memory_store is None:
+        return ""
+    retrieved = memory_store.similarity_search(query, k=2)
     retrieved_contents = "\n\n".join(
-        f"the key information about the long term memory:\n\n{content}"
-        for content in retrieved
+        f"the key information about the long term memory:\n\n{doc.page_content}"
+        for doc in retrieved
     )
     return retrieved_contents
 
 
-def build_qa_agent(VectorStore, test=True):
-    global vector_store
-    vector_store = VectorStore
+def build_qa_agent(test=True):
+    """
+    ReAct agent shared by all sessions, its tools read the session's stores from the run config. Tool calls of
+    one turn run concurrently (ToolNode gathers them, each sync tool in an executor thread), the model calls go
+    through the llm scheduler like every other llm call
+    """
+    tools = [retrieve_docs, retrieve_long_term_memory]
+    model = llm_scheduler.wrap(get_llm().bind_tools(tools))
     if args.for_test:
         memory = MemorySaver()
-        agent_executor = create_react_agent(llm, [retrieve_docs, retrieve_long_term_memory], memory)
+        agent_executor = create_react_agent(lambda state, runtime: model, tools, checkpointer=memory)
     else:
-        agent_executor = create_react_agent(llm, [retrieve_docs, retrieve_long_term_memory])
+        # tool calls and retrieved chunks of a turn are not checkpointed in the session's thread
+        agent_executor = create_react_agent(lambda state, runtime: model, tools, checkpointer=False)
 
     return agent_executor
 
-
 if __name__ == '__main__':
     docs = ingest_file_chunks('../data/2024190948.pdf')
     vector_store = get_vector_store()
     _ = vector_store.add_documents(docs)
-    app = build_qa_agent(vector_store, test=True)
-    config = {"configurable": {'thread_id': '0001'}}
+    app = build_qa_agent(test=True)
+    config = {"configurable": {'thread_id': '0001', 'vector_store': vector_store}}
     for event in app.stream(
             {"messages": [{"role": "user", "content": 'how to select k in k-means algorithm'}]},
             stream_mode="values",
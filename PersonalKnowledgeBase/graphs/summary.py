@@ -1,24 +1,44 @@
 import asyncio
+import threading
 
 from prompts.summary import map_prompt, reduce_prompt
 from utils.types import SummaryOverallState, SummaryState
-from config import llm, Args, get_vector_store
+from config import get_llm, Args
 from langgraph.types import Send
 from langchain_core.documents import Document
 from langchain.chains.combine_documents.reduce import split_list_of_docs, acollapse_docs
 from typing import List
 from langgraph.graph import START, END, StateGraph
 from ingestion.get_file_chunks import ingest_file_chunks
+from utils.summary_cache import SummaryCache
+from utils.llm_scheduler import llm_scheduler
+from utils.token_counter import TokenCounter, approx_token_count
 
 args = Args()
-# semaphore = asyncio.Semaphore(3)
+_summary_cache = None
+_summary_cache_lock = threading.Lock()
+# collapse planning measures the same summaries every round, counts are memoized per string
+token_counter = TokenCounter(approx_token_count if args.token_counter == 'approx'
+                             else lambda text: get_llm().get_num_tokens(text))
+
+
+def get_summary_cache():
+    """the summary cache, its sqlite file is opened on first use rather than at import"""
+    global _summary_cache
+    with _summary_cache_lock:
+        if _summary_cache is None:
+            _summary_cache = SummaryCache(args.SUMMARY_CACHE_PATH, namespace=args.chat_model_name)
+        return _summary_cache
 
 
 async def generate_summary(state: SummaryState):
-    """ Generate a summary of each piece of content """
-    # async with semaphore:
+    """ Generate a summary of each piece of content, chunks summarized before are taken from the cache """
+    cached = get_summary_cache().get_chunk_summary(state['content'])
+    if cached is not None:
+        return {"summaries": [cached]}
     prompt = map_prompt.invoke({'context': state['content']})
-    response = await llm.ainvoke(prompt)
+    response = await llm_scheduler.ainvoke(get_llm(), prompt)
+    get_summary_cache().put_chunk_summary(state['content'], response.content)
     return {"summaries": [response.content]}
 
 
@@ -35,25 +55,28 @@ def collect_summaries(state: SummaryOverallState):
 
 
 async def _reduce(input: List[Document]):
-    # async with semaphore:
     prompt = reduce_prompt.invoke(input)
-    response = await llm.ainvoke(prompt)
+    response = await llm_scheduler.ainvoke(get_llm(), prompt)
     return response.content
 
 
 def length_function(documents: List[Document]):
-    return sum(llm.get_num_tokens(doc.page_content) for doc in documents)
+    return token_counter.count_documents(documents)
 
 
 async def collapse_summaries(state: SummaryOverallState):
     doc_lists = split_list_of_docs(
         state['collapsed_summaries'], length_func=length_function, token_max=args.max_token
     )
-    results = []
-    # async with semaphore:
-    for doc_list in doc_lists:
-        results.append(await acollapse_docs(doc_list, _reduce))
-    return {'collapsed_summaries': results}
+    semaphore = asyncio.Semaphore(args.max_collapse_concurrency)
+
+    async def collapse(doc_list):
+        async with semaphore:
+            return await acollapse_docs(doc_list, _reduce)
+
+    # the groups of one round are reduced concurrently, gather keeps their order
+    results = await asyncio.gather(*[collapse(doc_list) for doc_list in doc_lists])
+    return {'collapsed_summaries': list(results)}
 
 
 def should_collapse(state: SummaryOverallState):
@@ -69,9 +92,11 @@ async def generate_final_summary(state: SummaryOverallState):
     return {'final_summary': response}
 
 
-def build_summary_graph(VectorStore):
-    global vector_store
-    vector_store = VectorStore
+def build_summary_graph():
+    """
+    map-reduce summary of the chunks passed in `contents`, it does not depend on the session. It runs inside
+    the orchestrator's summarize node but keeps no checkpoints of its own, the chunks never reach the thread
+    """
     graph = StateGraph(SummaryOverallState)
 
     graph.add_node('generate_summary', generate_summary)
@@ -85,18 +110,14 @@ def build_summary_graph(VectorStore):
     graph.add_conditional_edges('collapse_summaries', should_collapse)
     graph.add_edge('generate_final_summary', END)
 
-    return graph.compile()
+    return graph.compile(checkpointer=False)
 
 
 async def test():
     docs = ingest_file_chunks('../data/example.pdf')
     print(f"there are {len(docs)} documents after chunk")
 
-    global vector_store
-    if args.for_test:
-        vector_store = get_vector_store()
-    _ = vector_store.add_documents(docs)
-    app = build_summary_graph(vector_store)
+    app = build_summary_graph()
     step = None
     async for step in app.astream(
             {"contents": [doc.page_content for doc in docs]},
@@ -0,0 +1,121 @@
+"""
+Parse many files at once: `ingest_file_chunks` is CPU bound (Unstructured / pypdf) and holds the GIL, so the
+files of a batch are fanned out over a process pool and their chunks come back as soon as each file is done.
+
+usage (from PersonalKnowledgeBase/):
+    python -m ingestion.batch_ingest data/ [more files or folders] [--workers 4]      # parse only, report timings
+    python -m ingestion.batch_ingest data/ --doc-id [<id>]                            # also index into a document
+"""
+import argparse
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Iterator, List
+
+from config import Args
+from ingestion.get_file_chunks import file_suffix, load_file_pages, split_file_pages
+
+args = Args()
+SUPPORTED_SUFFIXES = ('.pdf', '.md', '.doc', '.docx')
+
+
+def collect_files(paths) -> List[str]:
+    """expand folders (recursively) into the supported files they contain"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in sorted(names)
+                             if file_suffix(name) in SUPPORTED_SUFFIXES)
+        else:
+            files.append(path)
+    return files
+
+
+def parse_file(file_name):
+    """
+    Runs in a worker process: parse and split one file.
+    :return: {"file", "chunks": List[Document], "pages", "parse_seconds", "split_seconds", "error"}
+    """
+    result = {"file": file_name, "chunks": [], "pages": 0, "parse_seconds": 0.0, "split_seconds": 0.0,
+              "error": None}
+    try:
+        start = time.perf_counter()
+        pages = load_file_pages(file_name)
+        result["parse_seconds"] = round(time.perf_counter() - start, 3)
+        start = time.perf_counter()
+        chunks = split_file_pages(file_name, pages)
+        result["split_seconds"] = round(time.perf_counter() - start, 3)
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+        return result
+    for chunk in chunks:
+        chunk.metadata["type"] = "documents"
+    result.update(chunks=chunks, pages=len(pages))
+    return result
+
+
+def iter_parsed_files(files, max_workers=args.batch_ingest_workers) -> Iterator[dict]:
+    """
+    Fan `parse_file` out over a process pool and yield its results in completion order.
+    Workers are spawned rather than forked, the web server that calls this runs many threads.
+    """
+    if not files:
+        return
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=min(max_workers, len(files)), mp_context=context) as pool:
+        futures = [pool.submit(parse_file, file_name) for file_name in files]
+        try:
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', nargs='+', help='files or folders')
+    parser.add_argument('--workers', type=int, default=args.batch_ingest_workers)
+    parser.add_argument('--doc-id', nargs='?', const='', default=None,
+                        help='index the chunks into this document (Chroma collection + BM25 index), without a '
+                             'value the id is derived from the file contents like the uploads do')
+    options = parser.parse_args()
+
+    files = collect_files(options.paths)
+    print(f"{len(files)} files, {options.workers} workers")
+    start = time.perf_counter()
+    if options.doc_id is not None:
+        from utils.database_operation import (stream_chroma_for_files, document_id, get_document_info,
+                                              mark_document_ready, delete_document_in_chroma)
+        doc_id = options.doc_id or document_id(files)
+        info = get_document_info(doc_id)
+        if info is not None:
+            print(f"document {doc_id} is already indexed ({info['chunks']} chunks)")
+            return
+        if not options.doc_id:
+            # leftovers of an ingestion of the same files that did not finish
+            delete_document_in_chroma(doc_id)
+        for progress in stream_chroma_for_files(files, doc_id, max_workers=options.workers):
+            if progress["stage"] == "done":
+                break
+            report = progress["file"]
+            print(f"{report['file']:<50} {report['chunks']:>6} chunks  parse {report['parse_seconds']:>7.3f}s  "
+                  f"split {report['split_seconds']:>7.3f}s  embed {report['embed_seconds']:>7.3f}s  "
+                  f"{report['error'] or ''}")
+        mark_document_ready(doc_id, ", ".join(os.path.basename(file) for file in files), progress["chunks"],
+                            progress["pages"])
+        print(f"\nindexed {progress['chunks']} chunks into document {doc_id}")
+    else:
+        chunks = 0
+        for result in iter_parsed_files(files, options.workers):
+            chunks += len(result["chunks"])
+            print(f"{result['file']:<50} {len(result['chunks']):>6} chunks  parse {result['parse_seconds']:>7.3f}s  "
+                  f"split {result['split_seconds']:>7.3f}s  {result['error'] or ''}")
+        print(f"\n{chunks} chunks")
+    print(f"total {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,6 @@
+import os
 import re
-from typing import List
-from langchain_community.document_loaders import UnstructuredPDFLoader
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_community.document_loaders.markdown import UnstructuredMarkdownLoader
-from langchain_community.document_loaders.word_document import UnstructuredWordDocumentLoader
+from typing import Iterator, List
 from langchain_core.documents import Document
 
 from config import Args
@@ -13,48 +10,81 @@ args = Args()
 
 
 def ingest_file_chunks(file_name):
-    if file_name.endswith('.pdf'):
-        docs = ingest_pdf_chunks(file_name)
-    elif file_name.endswith('.md'):
-        docs = ingest_md_chunks(file_name)
-    elif file_name.endswith(('doc', 'docx')):
-        docs = ingest_word_documents(file_name)
+    docs = split_file_pages(file_name, load_file_pages(file_name))
     for doc in docs:
         doc.metadata["type"] = "documents"
     return docs
 
 
+def file_suffix(file_name):
+    """lower-case extension, `REPORT.PDF` is parsed like `report.pdf`"""
+    return os.path.splitext(file_name)[1].lower()
+
+
+def load_file_pages(file_name) -> List[Document]:
+    """parse a pdf / markdown / word file without splitting it"""
+    # the loaders pull in unstructured / pypdf, they are imported when a file of their type is parsed
+    suffix = file_suffix(file_name)
+    if suffix == '.pdf':
+        loader = pdf_loader(file_name)
+    elif suffix == '.md':
+        from langchain_community.document_loaders.markdown import UnstructuredMarkdownLoader
+        loader = UnstructuredMarkdownLoader(file_name)
+    elif suffix in ('.doc', '.docx'):
+        from langchain_community.document_loaders.word_document import UnstructuredWordDocumentLoader
+        loader = UnstructuredWordDocumentLoader(file_name, mode='single')
+    else:
+        raise ValueError(f"unsupported file type: {file_name}")
+    return loader.load()
+
+
+def pdf_loader(pdf_file):
+    """
+    PyPDFLoader, one Document per page. /upload streams its pages and /upload_batch loads them at once, both
+    index into the collection of the file's content so they must parse it the same way
+    """
+    from langchain_community.document_loaders import PyPDFLoader
+    return PyPDFLoader(pdf_file)
+
+
+def split_file_pages(file_name, pages) -> List[Document]:
+    """split the output of `load_file_pages` with the splitter of the file type"""
+    if file_suffix(file_name) == '.md':
+        return split_text_2(pages)
+    return split_text_1(pages)
+
+
 def ingest_pdf_chunks(pdf_file) -> List[Document]:
-    """使用UnstructuredPDFLoader 或 PyPDFLoader解析pdf文档"""
-    try:
-        loader = UnstructuredPDFLoader(pdf_file)
-        print("use UnstructuredPDFLoader")
-    except:
-        loader = PyPDFLoader(pdf_file)
-        print("use PyPDFLoader")
-    documents = loader.load()
-    # context = ""
-    # for doc in documents:
-    #     context += doc.page_content
+    """使用PyPDFLoader解析pdf文档"""
+    return split_file_pages(pdf_file, load_file_pages(pdf_file))
+
+
+def iter_file_chunks(file_name) -> Iterator[Document]:
+    """
+    Generator version of `ingest_file_chunks`: pdf files are parsed and split page by page, so chunks are
+    available before the whole document is parsed. Other file types are small enough to be parsed at once.
+    """
+    if file_suffix(file_name) == '.pdf':
+        chunks = iter_pdf_chunks(file_name)
+    else:
+        chunks = iter(ingest_file_chunks(file_name))
+    for chunk in chunks:
+        chunk.metadata["type"] = "documents"
+        yield chunk
 
-    all_docs = split_text_1(documents)
 
-    # all_docs = [Document(doc) for doc in all_splits]
-    return all_docs
+def iter_pdf_chunks(pdf_file) -> Iterator[Document]:
+    """使用PyPDFLoader.lazy_load逐页解析pdf并切分，内存中只保留当前页"""
+    for page in pdf_loader(pdf_file).lazy_load():
+        yield from split_text_1([page])
 
 
 def ingest_md_chunks(md_file):
-    loader = UnstructuredMarkdownLoader(md_file)
-    md_pages = loader.load()
-    all_docs = split_text_2(md_pages)
-    return all_docs
+    return split_file_pages(md_file, load_file_pages(md_file))
 
 
 def ingest_word_documents(doc_file):
-    loader = UnstructuredWordDocumentLoader(doc_file, mode='single')
-    context = loader.load()
-    all_docs = split_text_1(context)
-    return all_docs
+    return split_file_pages(doc_file, load_file_pages(doc_file))
 
 
 if __name__ == "__main__":
@@ -1,29 +1,37 @@
 import asyncio
-from config import llm, embeddings, Args, get_vector_store
+from config import get_embeddings, Args
 from ingestion.get_file_chunks import ingest_file_chunks
-from graphs.orchestrator import build_orchestrator
+from graphs.orchestrator import get_orchestrator
+from utils.chroma_client import get_chroma_client
+from utils.hashing import documents_hash
 
 
 async def main(args):
     # 1. 提取pdf内容
     docs = ingest_file_chunks(args.pdf_file_path)
-    vector_store = get_vector_store()
-    _ = vector_store.add_documents(docs)
+    # 每个文件内容对应一个collection，重复运行时已写入的文本块不会再次追加
+    doc_id = documents_hash(docs)
+    vector_store = get_chroma_client().collection(doc_id)
+    if vector_store._collection.count() == 0:
+        for index, chunk in enumerate(docs):
+            chunk.metadata["chunk_index"] = index
+        _ = vector_store.add_documents(docs)  # embeddings 带磁盘缓存，重复的文本块不会再次计算
+    print(f"embedding cache: {get_embeddings().stats()}")
 
     # 2. 获取agent
-    app = build_orchestrator(vector_store)
+    app = get_orchestrator()
 
     state = {
         'task': '',
         'query': '',
-        'contents': docs,
+        'doc_id': doc_id,
         'final_summary': '',
         'final_answer': '',
         'history': []
     }
 
     query = ""
-    config = {'configurable': {'thread_id': '0001'}}
+    config = {'configurable': {'thread_id': '0001', 'vector_store': vector_store}}
     while query != "q":
         query = input("human: ")
         if query == "q":
@@ -6,4 +6,43 @@ intent_prompt = ChatPromptTemplate.from_messages([
      "or a QUESTION about specific details. "
      "Output only one word: 'summarize' or 'qa'."),
     ("human", "{query}")
-])
\ No newline at end of file
+])
+
+# 本地意图路由使用的关键词与示例问题（见 utils/intent_router.py），无法确定时才调用上面的LLM分类
+# 英文按整词匹配；关键词只是倾向，仍需通过向量中心的差值判断
+summarize_keywords = [
+    "summarize", "summarise", "summary", "summarization", "overview", "tl;dr", "tldr", "gist",
+    "main points", "key points", "main ideas", "outline of the document",
+    "总结", "概括", "摘要", "概述", "总览", "主要内容", "大意", "讲了什么", "说了什么",
+]
+
+# 指向文档局部（章节、页码、表格、字段）的限定词：出现时不在本地判断，交给LLM分类
+detail_qualifiers = [
+    "section", "chapter", "page", "paragraph", "table", "figure", "appendix", "equation", "field", "column",
+    "row", "line", "step", "slide",
+    "第", "章节", "段落", "表格", "图表", "附录", "字段", "提到",
+]
+
+summarize_examples = [
+    "Summarize this document",
+    "Give me a summary of the paper",
+    "What is this document about?",
+    "Can you give me an overview of the whole file?",
+    "What are the main points of the article?",
+    "Briefly describe the content of this report",
+    "帮我总结一下这篇文档",
+    "这篇文章主要讲了什么",
+    "概括一下全文内容",
+]
+
+qa_examples = [
+    "What does the author say about k-means?",
+    "How is the learning rate chosen in the experiments?",
+    "Who wrote this paper?",
+    "What is the value reported in table 2?",
+    "Explain the definition of prompt engineering given in section 3",
+    "When was the project started?",
+    "文中提到的模型准确率是多少",
+    "第二章中的算法是如何实现的",
+    "作者是谁",
+]
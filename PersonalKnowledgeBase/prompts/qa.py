@@ -14,6 +14,20 @@ qa_prompt = ChatPromptTemplate.from_messages([
     ("human", "questions: {input} \n\nchat history: \n{chat_history}")
 ])
 
+# 指向对话内容（代词、“之前”“刚才”等）的词：这类问题的回答依赖会话历史，不进入语义回答缓存
+history_references = [
+    "it", "that", "those", "they", "them", "he", "she", "him", "her", "previous", "earlier", "before", "again",
+    "above", "last", "same", "said", "told", "my", "we", "our",
+    "它", "他", "她", "那个", "那些", "上面", "刚才", "之前", "前面", "上一个", "你说", "我",
+]
+
+history_summary_prompt = ChatPromptTemplate.from_messages([
+    ("human", "Below are a summary of the earlier conversation (may be empty) and the turns that followed it.\n"
+              "Rewrite them as one concise summary that keeps the facts, preferences, names and numbers the user "
+              "gave and the conclusions reached. Return only the summary.\n\n"
+              "summary: \n{summary}\n\nturns: \n{history}")
+])
+
 
 if __name__ == "__main__":
     prompt = qa_prompt.invoke({
@@ -0,0 +1,341 @@
+"""
+Session, ingestion and question handling shared by the Flask server (app.py) and the ASGI server (asgi_app.py).
+Nothing here depends on the web framework or on the event loop the orchestrator runs on.
+"""
+import logging
+import os
+import threading
+import uuid
+from collections import defaultdict
+
+from langchain_core.messages import AIMessage, HumanMessage, RemoveMessage
+from langgraph.graph.message import REMOVE_ALL_MESSAGES
+
+from config import Args, get_embeddings, get_embedding_service
+from utils.database_operation import (load_data_from_mysql, load_bm25_index,
+                                      save_conversation_to_mysql, insert_session, delete_session_in_mysql,
+                                      delete_session_memories, delete_document_in_chroma, document_id,
+                                      get_document_info, mark_document_ready, move_memories_out_of_document,
+                                      stream_chroma_for_file, stream_chroma_for_files, chat_store)
+from utils.session_registry import SessionRegistry
+from utils.chroma_client import get_chroma_client
+from utils.upload_jobs import UploadJobManager
+from utils.memory_worker import MemoryConsolidator, memory_collection
+from utils.llm_scheduler import llm_scheduler
+from utils.latency_stats import LatencyStats
+from graphs.orchestrator import get_orchestrator, get_intent_router, get_answer_cache, history_summarizer
+from graphs.summary import get_summary_cache, token_counter
+
+args = Args()
+logger = logging.getLogger(__name__)
+
+
+def session_doc_id(session_id, session):
+    """document (Chroma collection) of a session; sessions created before documents were shared own theirs"""
+    return session["metadatas"].get("doc_id") or session_id
+
+
+def activate_session(session_id, session):
+    """
+    open the vector store, memory store and BM25 index of a session when it is used for the first time; the
+    chunk texts are not loaded, a summary reads them from the collection (see load_document_texts)
+    """
+    doc_id = session_doc_id(session_id, session)
+    move_memories_out_of_document(doc_id)
+    return {
+        "vector_store": get_chroma_client().collection(doc_id),
+        "memory_store": memory_collection(session_id),
+        "bm25_index": load_bm25_index(doc_id) if args.use_hybrid_retrieval else None,
+    }
+
+
+def unload_session_thread(session_id):
+    """an evicted session's checkpoints leave memory too, they are read again from the file on its next /ask"""
+    get_orchestrator().checkpointer.unload(session_id)
+
+
+# Sessions store, see SessionRegistry for the layout of a session
+SESSIONS = SessionRegistry(metadata_loader=load_data_from_mysql, activator=activate_session,
+                           on_evict=unload_session_thread)
+# Ingestion jobs of /upload, job_id == session_id
+UPLOAD_JOBS = UploadJobManager()
+# Long-term memory extraction, off the request path
+MEMORY_WORKER = MemoryConsolidator()
+# Nodes whose LLM output is the answer itself and is forwarded by /ask_stream
+STREAM_NODES = {"agent", "generate_final_summary"}
+# Time to first token and total duration of /ask_stream
+TTFT_STATS = LatencyStats()
+STREAM_STATS = LatencyStats()
+# One lock per document: uploads of the same content are indexed once, deletion checks the sessions left
+_document_locks = defaultdict(threading.Lock)
+_document_locks_guard = threading.Lock()
+
+
+def document_lock(doc_id):
+    with _document_locks_guard:
+        return _document_locks[doc_id]
+
+
+def session_config(session_id, session):
+    """
+    Run config of the shared orchestrator for an active session: the checkpoint thread of the session and the
+    stores its QA tools read
+    """
+    return {'configurable': {
+        'thread_id': session_id,
+        'session_id': session_id,
+        'vector_store': session["vector_store"],
+        'memory_store': session.get("memory_store"),
+        'bm25_index': session.get("bm25_index"),
+    }}
+
+
+def upload_save_path(filename):
+    """
+    path an uploaded file is saved to, unique per upload: a file with the same name uploaded meanwhile never
+    overwrites one a queued job has not parsed yet. The client's name stays at the end, the parser picks the
+    loader by its suffix
+    """
+    return os.path.join(args.UPLOAD_FOLDER, f"{uuid.uuid4().hex}_{os.path.basename(filename)}")
+
+
+def register_session(session_id, doc_id, filename):
+    """persist and register a new session on an indexed document, its stores are opened on the first /ask"""
+    insert_session(session_id, doc_id, filename)
+    SESSIONS.add(session_id, {"history": [], "metadatas": {"filename": filename, "doc_id": doc_id}})
+
+
+def start_upload_job(session_id, save_paths, filename):
+    """
+    Create the session of an upload: right away if its content is already indexed, else through a background
+    ingestion job (job_id == session_id). While the document is being indexed or deleted the job waits for it,
+    the request does not.
+    :return: (job status, reused)
+    """
+    doc_id = document_id(save_paths)
+    lock = document_lock(doc_id)
+    if lock.acquire(blocking=False):
+        try:
+            info = get_document_info(doc_id)
+            if info is not None:
+                register_session(session_id, doc_id, filename)
+                logger.info("Created session %s on indexed document %s (%s)", session_id, doc_id, filename)
+                return UPLOAD_JOBS.complete(session_id, filename=filename, doc_id=doc_id, chunks=info["chunks"],
+                                            pages=info["pages"], reused=True), True
+        finally:
+            lock.release()
+    if len(save_paths) == 1:
+        job = UPLOAD_JOBS.submit(session_id, run_upload_job, doc_id, save_paths[0], filename, filename=filename,
+                                 doc_id=doc_id)
+    else:
+        job = UPLOAD_JOBS.submit(session_id, run_batch_upload_job, doc_id, save_paths, filename, filename=filename,
+                                 doc_id=doc_id, files_total=len(save_paths))
+    return job, False
+
+
+def ingest_document(session_id, doc_id, filename, ingest):
+    """
+    Index a document once and register the session on it. Concurrent uploads of the same content wait for the
+    first one and reuse its collection; the leftovers of an ingestion that did not finish are dropped first.
+    :param ingest: (doc_id) -> generator of ingestion progress dicts, see `stream_chroma_for_file`
+    :return: generator of progress dicts, the last one has stage "done" and tells if the document was "reused"
+    """
+    with document_lock(doc_id):
+        info = get_document_info(doc_id)
+        if info is not None:
+            register_session(session_id, doc_id, filename)
+            logger.info("Created session %s on indexed document %s (%s)", session_id, doc_id, filename)
+            yield {"stage": "done", "chunks": info["chunks"], "pages": info["pages"], "parse_seconds": 0.0,
+                   "embed_seconds": 0.0, "elapsed": 0.0, "reused": True}
+            return
+        delete_document_in_chroma(doc_id)
+        get_answer_cache().invalidate(doc_id)
+        for progress in ingest(doc_id):
+            if progress["stage"] == "done":
+                mark_document_ready(doc_id, filename, progress["chunks"], progress["pages"])
+                register_session(session_id, doc_id, filename)
+                logger.info("Created session %s for %s (%d docs)", session_id, filename, progress["chunks"])
+                progress = {**progress, "reused": False}
+            yield progress
+
+
+def run_upload_job(session_id, doc_id, save_path, filename):
+    """worker side of /upload: parse, split, embed and register the session"""
+    for progress in ingest_document(session_id, doc_id, filename,
+                                    lambda collection: stream_chroma_for_file(save_path, collection)):
+        UPLOAD_JOBS.update(session_id, stage=progress["stage"], chunks=progress["chunks"], pages=progress["pages"],
+                           reused=progress.get("reused", False),
+                           timings={"parse": progress["parse_seconds"], "embed": progress["embed_seconds"]})
+
+
+def run_batch_upload_job(session_id, doc_id, save_paths, filename):
+    """worker side of /upload_batch: parse the files in a process pool, embed them into one document"""
+    reports = []
+    for progress in ingest_document(session_id, doc_id, filename,
+                                    lambda collection: stream_chroma_for_files(save_paths, collection)):
+        if progress["stage"] != "done":
+            reports.append(progress["file"])
+        UPLOAD_JOBS.update(session_id, stage=progress["stage"], chunks=progress["chunks"], pages=progress["pages"],
+                           files_done=progress.get("files_done", len(save_paths)), files=list(reports),
+                           reused=progress.get("reused", False),
+                           timings={"parse": progress["parse_seconds"], "embed": progress["embed_seconds"]})
+
+
+def iter_upload_progress(save_path, filename, session_id):
+    """index an uploaded file batch by batch and yield the progress dicts of the streamed /upload"""
+    try:
+        doc_id = document_id([save_path])
+        for progress in ingest_document(session_id, doc_id, filename,
+                                        lambda collection: stream_chroma_for_file(save_path, collection)):
+            yield {"session_id": session_id, "doc_id": doc_id, "filename": filename, **progress}
+    except Exception as e:
+        logger.exception("Failed to ingest file: %s", e)
+        yield {"session_id": session_id, "filename": filename, "stage": "failed",
+               "error": "Failed to ingest file", "details": str(e)}
+
+
+def question_error(session_id):
+    """
+    :return: (error body, status code) if the session cannot be asked right now, else None
+    """
+    if UPLOAD_JOBS.is_pending(session_id):
+        return {"error": "Session is still indexing", "status": UPLOAD_JOBS.get(session_id)}, 409
+    if session_id not in SESSIONS:
+        return {"error": "Unknown session_id"}, 400
+    return None
+
+
+def build_question_state(question, session_id, session):
+    """
+    orchestrator input for a question about an active session. The conversation lives in the checkpoint of the
+    session's thread, it is seeded with the last turns of the stored history only when the thread has none yet
+    (new process without a checkpoint file, sessions older than the checkpoints)
+    """
+    history = []
+    if not get_orchestrator().checkpointer.has_thread(session_id):
+        history = [RemoveMessage(id=REMOVE_ALL_MESSAGES), *session.get("history", [])[-args.history_keep:]]
+    return {
+        'task': "",
+        "query": question,
+        "doc_id": session_doc_id(session_id, session),
+        "final_answer": '',
+        "final_summary": '',
+        "history": history,
+    }
+
+
+def finish_question(question, session_id, session, result):
+    """
+    Pick the answer out of the orchestrator result and persist the exchange
+    :return: answer
+    """
+    if result['task'] == 'summarize':
+        answer = result['final_summary']
+    else:
+        answer = result['final_answer']
+
+    logger.info("Session %s answered: %s", session_id, answer[:120].replace("\n", " "))
+
+    # Save history (keep minimal); extended in place, `session` is a snapshot sharing the registry's list
+    session["history"].extend([
+        HumanMessage(content=question),
+        AIMessage(content=answer),
+    ])
+
+    save_conversation_to_mysql(session_id, session)
+    if len(session["history"]) % args.memory_every_messages == 0:
+        MEMORY_WORKER.submit(session_id, session_doc_id(session_id, session),
+                             session["history"][-args.memory_every_messages:])
+    return answer
+
+
+async def stream_answer(app_agent, state, config):
+    """
+    Run the orchestrator with astream_events and yield ("task", task), ("token", text) for every piece of
+    the answer generated by the LLM, and finally ("result", final state)
+    """
+    async for event in app_agent.astream_events(state, config, version="v2"):
+        kind = event["event"]
+        if kind == "on_chat_model_stream" and event["metadata"].get("langgraph_node") in STREAM_NODES:
+            text = event["data"]["chunk"].content
+            if text and isinstance(text, str):
+                yield "token", text
+        elif kind == "on_chain_end" and event["name"] == "judge_task":
+            yield "task", event["data"]["output"]
+        elif kind == "on_chain_end" and not event["parent_ids"]:
+            yield "result", event["data"]["output"]
+
+
+def list_session_summaries():
+    """body of /sessions, only metadata is read, no session is activated here"""
+    word_map = {'ai': 'assistant', 'human': 'user'}
+    out = []
+    for sid, s in SESSIONS.list_sessions():
+        out.append({
+            "session_id": sid,
+            "filename": s.get("metadatas", {}).get("filename"),
+            "doc_id": session_doc_id(sid, s),
+            "message_count": len(s['history']),
+            "messages": [{"role": word_map[msg.type], "content": msg.content} for msg in s['history']]
+        })
+    return out
+
+
+def remove_session(session_id):
+    """
+    delete the chat history, the long-term memories and the registry entry of a session; the document
+    (Chroma collection and BM25 index) is deleted with the last session referencing it
+    """
+    session = SESSIONS.peek(session_id)
+    if session is None:
+        return
+    doc_id = session_doc_id(session_id, session)
+    with document_lock(doc_id):
+        delete_session_in_mysql(session_id)
+        logger.info("Deleting specific session from mysql")
+        SESSIONS.remove(session_id)  # 移除会话入口
+        get_orchestrator().checkpointer.delete_thread(session_id)
+        history_summarizer.discard(session_id)
+        references = sum(1 for sid, s in SESSIONS.list_sessions() if session_doc_id(sid, s) == doc_id)
+        MEMORY_WORKER.discard(session_id)
+        delete_session_memories(doc_id, session_id)
+        if references:
+            logger.info("Deleted memories of session %s, document %s is still used by %d sessions",
+                        session_id, doc_id, references)
+        else:
+            delete_document_in_chroma(doc_id)
+            get_answer_cache().invalidate(doc_id)
+            logger.info("Deleted document %s from chroma", doc_id)
+    logger.info("Successfully deleted session: %s", session_id)
+
+
+def shutdown(timeout=10):
+    """
+    write what is still buffered before the process exits: long-term memories queued for chroma, the checkpoint
+    snapshots of the orchestrator and the chat messages of the async writer
+    """
+    if not MEMORY_WORKER.flush(timeout):
+        logger.warning("memory worker still busy after %ss, queued jobs are lost", timeout)
+    get_orchestrator().checkpointer.flush()
+    chat_store.close()
+
+
+def collect_stats():
+    """runtime counters of the caches and stores, body of /stats"""
+    return {
+        "sessions": SESSIONS.stats(),
+        "chat_store": chat_store.stats(),
+        "embedding_cache": get_embeddings().stats(),
+        "embedding_service": get_embedding_service().stats(),
+        "chroma": get_chroma_client().stats(),
+        "checkpoints": get_orchestrator().checkpointer.stats(),
+        "upload_jobs": UPLOAD_JOBS.stats(),
+        "memory_worker": MEMORY_WORKER.stats(),
+        "history_summarizer": history_summarizer.stats(),
+        "summary_cache": get_summary_cache().stats(),
+        "llm_scheduler": llm_scheduler.stats(),
+        "token_counter": token_counter.stats(),
+        "intent_router": get_intent_router().stats(),
+        "answer_cache": get_answer_cache().stats(),
+        "ask_stream": {"ttft": TTFT_STATS.stats(), "total": STREAM_STATS.stats()},
+    }
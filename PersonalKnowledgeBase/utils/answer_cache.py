@@ -0,0 +1,152 @@
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from utils.intent_router import normalize_query, term_pattern
+
+
+class SemanticAnswerCache:
+    """
+    Cache of QA answers keyed by document + query embedding. A new question on a document hits when the cosine
+    similarity to a question already answered on it, in any session, reaches `threshold`. Only answers that
+    depend on the document alone are shared: questions referring to the conversation ("what did I ask before",
+    "explain it again") are not cacheable, and the caller does not store answers built from a session's
+    long-term memories. Entries expire after `ttl` seconds and the least recently used ones are dropped beyond
+    `max_entries`.
+    """
+
+    def __init__(self, embeddings, threshold=0.92, ttl=3600, max_entries=2000, history_references=()):
+        """
+        :param embeddings: langchain Embeddings used for the questions
+        :param threshold: min cosine similarity between two questions to reuse the answer
+        :param ttl: seconds an answer stays valid
+        :param max_entries: max number of cached answers over all documents
+        :param history_references: words that point back at the conversation, questions with them bypass the cache
+        """
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.reference_pattern = term_pattern(history_references)
+        self._by_doc = {}  # doc_id -> {entry_id: entry}
+        self._lru = OrderedDict()  # entry_id -> doc_id, least recently used first
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.bypassed = 0
+        self.latency_saved = 0.0
+
+    def cacheable(self, query):
+        """False when the question refers to the conversation, its answer depends on the session's history"""
+        if self.reference_pattern is not None and self.reference_pattern.search(normalize_query(query)):
+            with self._lock:
+                self.bypassed += 1
+            return False
+        return True
+
+    def embed(self, query):
+        vector = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, doc_id, query, vector=None):
+        """
+        :param vector: normalized query embedding, computed if not given
+        :return: (answer or None, query vector) so a miss can be stored without embedding the query again
+        """
+        if vector is None:
+            vector = self.embed(query)
+        now = time.time()
+        with self._lock:
+            self.lookups += 1
+            entries = self._by_doc.get(doc_id, {})
+            best_id, best_score = None, self.threshold
+            for entry_id, entry in list(entries.items()):
+                if now - entry["created_at"] > self.ttl:
+                    self._drop(entry_id)
+                    continue
+                score = float(vector @ entry["vector"])
+                if score >= best_score:
+                    best_id, best_score = entry_id, score
+            if best_id is None:
+                return None, vector
+            entry = entries[best_id]
+            self._lru.move_to_end(best_id)
+            self.hits += 1
+            self.latency_saved += entry["latency"]
+            return entry["answer"], vector
+
+    def put(self, doc_id, query, answer, latency, vector=None):
+        """
+        :param latency: seconds it took to compute the answer, reported as saved on every hit
+        """
+        if vector is None:
+            vector = self.embed(query)
+        with self._lock:
+            entry_id = next(self._ids)
+            self._by_doc.setdefault(doc_id, {})[entry_id] = {
+                "question": query, "answer": answer, "vector": vector, "latency": latency, "created_at": time.time(),
+            }
+            self._lru[entry_id] = doc_id
+            while len(self._lru) > self.max_entries:
+                self._drop(next(iter(self._lru)))
+
+    def invalidate(self, doc_id):
+        """drop the answers of a document (deleted or re-indexed)"""
+        with self._lock:
+            for entry_id in list(self._by_doc.get(doc_id, {})):
+                self._drop(entry_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._lru),
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "bypassed": self.bypassed,
+                "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+                "latency_saved_seconds": round(self.latency_saved, 3),
+            }
+
+    def _drop(self, entry_id):
+        doc_id = self._lru.pop(entry_id, None)
+        entries = self._by_doc.get(doc_id)
+        if entries is not None:
+            entries.pop(entry_id, None)
+            if not entries:
+                del self._by_doc[doc_id]
+
+
+def test():
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+
+    cache = SemanticAnswerCache(DeterministicFakeEmbedding(size=64), history_references=["it", "before", "之前"])
+    question = "How is k selected in k-means?"
+    # first turn of a session: miss, the answer is stored for the document
+    assert cache.cacheable(question)
+    answer, vector = cache.lookup("doc", question)
+    assert answer is None
+    cache.put("doc", question, "elbow method", 1.5, vector)
+    # the same question after one turn of history, then from another session on the same file
+    assert cache.cacheable(question)
+    assert cache.lookup("doc", question)[0] == "elbow method"
+    assert cache.lookup("doc", question)[0] == "elbow method"
+    assert cache.lookup("other-doc", question)[0] is None
+    assert not cache.cacheable("Can you explain it with an example?")
+    assert not cache.cacheable("我之前问了什么")
+    assert cache.cacheable("What is the iteration limit?")
+    cache.invalidate("other-doc")
+    assert cache.lookup("doc", question)[0] == "elbow method"
+    cache.invalidate("doc")
+    assert cache.lookup("doc", question)[0] is None
+    stats = cache.stats()
+    assert stats["hits"] == 3 and stats["bypassed"] == 2 and stats["entries"] == 0, stats
+    print(stats)
+
+
+if __name__ == '__main__':
+    test()
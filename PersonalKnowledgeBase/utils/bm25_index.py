@@ -0,0 +1,139 @@
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter
+
+from langchain_core.documents import Document
+
+from utils.token_counter import _CJK
+
+# latin words / identifiers / numbers (inner '.', '_' and '-' are kept: "v2.1", "snake_case", "gpt-4"),
+# CJK text is indexed as single characters and bigrams
+_WORD_PATTERN = re.compile(rf"[^\W{_CJK}]+(?:[._-][^\W{_CJK}]+)*|[{_CJK}]+", re.UNICODE)
+_CJK_RUN = re.compile(rf"[{_CJK}]+")
+
+
+def tokenize(text):
+    tokens = []
+    for match in _WORD_PATTERN.finditer(text.lower()):
+        piece = match.group()
+        if _CJK_RUN.fullmatch(piece):
+            tokens.extend(piece)
+            tokens.extend(piece[i:i + 2] for i in range(len(piece) - 1))
+        else:
+            tokens.append(piece)
+            if any(sep in piece for sep in "._-"):
+                # "gpt-4" also matches a query for "gpt" or "4"
+                tokens.extend(part for part in re.split(r"[._-]", piece) if part)
+    return tokens
+
+
+class BM25Index:
+    """
+    Okapi BM25 over the chunks of one document, kept as an inverted index (term -> [[chunk, tf], ...]) and
+    persisted as json next to the Chroma collection. Chunks keep their Chroma ids so the results can be fused
+    with the vector search.
+    """
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.ids = []
+        self.texts = []
+        self.metadatas = []
+        self.lengths = []
+        self.postings = {}
+        self._lock = threading.Lock()
+
+    def add(self, documents, ids=None):
+        """
+        :param documents: langchain Documents
+        :param ids: Chroma ids of the documents, defaults to `doc.id`
+        """
+        ids = ids or [doc.id for doc in documents]
+        with self._lock:
+            for doc_id, doc in zip(ids, documents):
+                position = len(self.ids)
+                terms = Counter(tokenize(doc.page_content))
+                for term, tf in terms.items():
+                    self.postings.setdefault(term, []).append([position, tf])
+                self.ids.append(doc_id)
+                self.texts.append(doc.page_content)
+                self.metadatas.append(dict(doc.metadata))
+                self.lengths.append(sum(terms.values()))
+
+    def search(self, query, k=4):
+        """
+        :return: list of (Document with its Chroma id, score), best first; chunks sharing no term with the
+                 query are not returned
+        """
+        with self._lock:
+            n = len(self.ids)
+            if not n:
+                return []
+            avg_length = sum(self.lengths) / n or 1.0
+            scores = {}
+            for term in set(tokenize(query)):
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+                for position, tf in postings:
+                    norm = self.k1 * (1 - self.b + self.b * self.lengths[position] / avg_length)
+                    scores[position] = scores.get(position, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+            best = sorted(scores.items(), key=lambda item: -item[1])[:k]
+            return [(Document(page_content=self.texts[position], metadata=self.metadatas[position],
+                              id=self.ids[position]), score) for position, score in best]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def save(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._lock:
+            data = {"k1": self.k1, "b": self.b, "ids": self.ids, "texts": self.texts, "metadatas": self.metadatas,
+                    "lengths": self.lengths, "postings": self.postings}
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        index = cls(k1=data["k1"], b=data["b"])
+        index.ids, index.texts, index.metadatas = data["ids"], data["texts"], data["metadatas"]
+        index.lengths, index.postings = data["lengths"], data["postings"]
+        return index
+
+
+def test():
+    docs = [
+        Document("The learning rate of AdamW is set to 3e-4 in all runs.", id="a"),
+        Document("K-means selects k with the elbow method and silhouette_score.", id="b"),
+        Document("模型使用余弦相似度检索相关文本块。", id="c"),
+    ]
+    index = BM25Index()
+    index.add(docs)
+    assert index.search("silhouette_score", k=1)[0][0].id == "b"
+    assert index.search("k-means", k=1)[0][0].id == "b"
+    assert index.search("AdamW learning rate", k=1)[0][0].id == "a"
+    assert index.search("相似度", k=1)[0][0].id == "c"
+    assert index.search("unrelated words") == []
+
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bm25", "index.json")
+        index.save(path)
+        loaded = BM25Index.load(path)
+        assert [(d.id, s) for d, s in loaded.search("elbow method")] == [(d.id, s) for d, s in
+                                                                        index.search("elbow method")]
+    print("ok")
+
+
+if __name__ == '__main__':
+    test()
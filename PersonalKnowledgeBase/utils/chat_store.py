@@ -0,0 +1,339 @@
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from config import Args
+
+args = Args()
+logger = logging.getLogger(__name__)
+
+SQLITE_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS chat_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id VARCHAR(255) NOT NULL,
+        role TEXT NOT NULL CHECK (role IN ('human', 'ai')),
+        content TEXT NOT NULL,
+        filename VARCHAR(255),
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_session_created ON chat_history (session_id, created_at)",
+    """
+    CREATE TABLE IF NOT EXISTS sessions (
+        session_id VARCHAR(255) PRIMARY KEY,
+        doc_id VARCHAR(255) NOT NULL,
+        filename VARCHAR(255),
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_sessions_doc ON sessions (doc_id)",
+)
+
+
+class ConnectionPool:
+    """A small thread-safe pool of DB-API connections, connections are created on demand up to `size`."""
+
+    def __init__(self, factory, size=5, validate=None):
+        """
+        :param factory: () -> new DB-API connection
+        :param size: max number of connections handed out at the same time
+        :param validate: optional (conn) -> None, called on checkout, should raise if the connection is broken
+        """
+        self._factory = factory
+        self._validate = validate
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self.size = size
+        self.created = 0
+
+    def acquire(self):
+        self._slots.acquire()
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return self._new_connection()
+            if self._validate is not None:
+                try:
+                    self._validate(conn)
+                except Exception as e:
+                    logger.warning("dropping broken pooled connection: %s", e)
+                    self._close_quietly(conn)
+                    return self._new_connection()
+            return conn
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, conn, discard=False):
+        if discard:
+            self._close_quietly(conn)
+        else:
+            self._idle.put(conn)
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """checkout a connection, roll back and drop it if the block raises"""
+        conn = self.acquire()
+        try:
+            yield conn
+        except Exception:
+            try:
+                conn.rollback()
+            except Exception:
+                self.release(conn, discard=True)
+            else:
+                self.release(conn)
+            raise
+        self.release(conn)
+
+    def close(self):
+        while True:
+            try:
+                self._close_quietly(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+    def _new_connection(self):
+        conn = self._factory()
+        self.created += 1
+        return conn
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+class ChatHistoryStore:
+    """
+    Persistence of the chat_history and sessions tables on top of a connection pool.
+    Messages of one turn are written as a single multi-row INSERT in one transaction. With `async_writes`
+    the inserts are buffered and flushed by a background thread, several turns per transaction; a batch that
+    fails is retried with backoff, then written row by row so only the rows that really fail are lost.
+    """
+
+    def __init__(self, pool, placeholder="%s", async_writes=False, batch_size=64, flush_interval=0.5,
+                 max_retries=3, retry_backoff=0.5):
+        """
+        :param pool: ConnectionPool
+        :param placeholder: parameter marker of the driver, '%s' for mysql.connector and '?' for sqlite3
+        :param async_writes: buffer inserts and write them off the caller's thread
+        :param batch_size: max number of messages written in one transaction by the background writer
+        :param flush_interval: seconds the background writer waits for more messages before writing
+        :param max_retries: retries of a failed batch by the background writer
+        :param retry_backoff: seconds before the first retry, doubled every retry
+        """
+        self.pool = pool
+        self.placeholder = placeholder
+        self.async_writes = async_writes
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self._pending = queue.Queue()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        self.rows_written = 0
+        self.transactions = 0
+        self.failed_rows = 0
+        self.retries = 0
+
+    @classmethod
+    def for_mysql(cls, db_config, pool_size=args.mysql_pool_size, **kwargs):
+        import mysql.connector
+
+        def validate(conn):
+            conn.ping(reconnect=True, attempts=1)
+
+        pool = ConnectionPool(lambda: mysql.connector.connect(**db_config), size=pool_size, validate=validate)
+        return cls(pool, placeholder="%s", **kwargs)
+
+    @classmethod
+    def for_sqlite(cls, path, pool_size=args.mysql_pool_size, **kwargs):
+        """local stand-in for mysql, the table is created if it does not exist"""
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        def connect():
+            return sqlite3.connect(path, check_same_thread=False)
+
+        conn = connect()
+        for statement in SQLITE_SCHEMA:
+            conn.execute(statement)
+        conn.commit()
+        conn.close()
+        return cls(ConnectionPool(connect, size=pool_size), placeholder="?", **kwargs)
+
+    def insert_messages(self, rows):
+        """
+        :param rows: [(session_id, role, content, filename), ...]
+        """
+        rows = [tuple(row) for row in rows]
+        if not rows:
+            return
+        if self.async_writes:
+            self._ensure_writer()
+            for row in rows:
+                self._pending.put(row)
+        else:
+            self._write(rows)
+
+    def load_rows(self):
+        """
+        :return: [{"session_id", "role", "content", "filename", "created_at"}, ...] ordered by session and time
+        """
+        self.flush()
+        query = """
+            SELECT session_id, role, content, filename, created_at
+            FROM chat_history
+            ORDER BY session_id, created_at, id
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query)
+            columns = [col[0] for col in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+            cursor.close()
+        return rows
+
+    def insert_session(self, session_id, doc_id, filename=None):
+        """record which document (Chroma collection) a session asks about"""
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"INSERT INTO sessions (session_id, doc_id, filename) "
+                           f"VALUES ({self.placeholder}, {self.placeholder}, {self.placeholder})",
+                           (session_id, doc_id, filename))
+            conn.commit()
+            cursor.close()
+
+    def load_sessions(self):
+        """
+        :return: [{"session_id", "doc_id", "filename", "created_at"}, ...] ordered by creation time
+        """
+        query = "SELECT session_id, doc_id, filename, created_at FROM sessions ORDER BY created_at"
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query)
+            columns = [col[0] for col in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+            cursor.close()
+        return rows
+
+    def delete_session(self, session_id):
+        self.flush()
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"DELETE FROM chat_history WHERE session_id = {self.placeholder}", (session_id,))
+            cursor.execute(f"DELETE FROM sessions WHERE session_id = {self.placeholder}", (session_id,))
+            conn.commit()
+            cursor.close()
+
+    def flush(self):
+        """block until every buffered message has been written"""
+        if self._writer is not None:
+            self._pending.join()
+
+    def stats(self):
+        return {
+            "pending_rows": self._pending.unfinished_tasks,
+            "rows_written": self.rows_written,
+            "transactions": self.transactions,
+            "failed_rows": self.failed_rows,
+            "retries": self.retries,
+            "connections_created": self.pool.created,
+        }
+
+    def close(self):
+        self.flush()
+        self.pool.close()
+
+    def _write(self, rows):
+        values = ", ".join([f"({', '.join([self.placeholder] * 4)})"] * len(rows))
+        params = [value for row in rows for value in row]
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"INSERT INTO chat_history (session_id, role, content, filename) VALUES {values}", params)
+            conn.commit()
+            cursor.close()
+        self.rows_written += len(rows)
+        self.transactions += 1
+
+    def _ensure_writer(self):
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name="chat-history-writer", daemon=True)
+                self._writer.start()
+
+    def _write_loop(self):
+        while True:
+            batch = [self._pending.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._pending.get(timeout=self.flush_interval))
+                except queue.Empty:
+                    break
+            try:
+                self._write_with_retries(batch)
+            finally:
+                for _ in batch:
+                    self._pending.task_done()
+
+    def _write_with_retries(self, batch):
+        for attempt in range(self.max_retries + 1):
+            try:
+                self._write(batch)
+                return
+            except Exception as e:
+                if attempt == self.max_retries:
+                    logger.warning("failed to write %d chat messages, writing them one by one: %s", len(batch), e)
+                    break
+                self.retries += 1
+                time.sleep(self.retry_backoff * 2 ** attempt)
+        for row in batch:
+            try:
+                self._write([row])
+            except Exception as e:
+                self.failed_rows += 1
+                logger.exception("failed to write chat message of session %s: %s", row[0], e)
+
+
+def test():
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), "db", "chat_history.sqlite3")
+    store = ChatHistoryStore.for_sqlite(path, async_writes=True, flush_interval=0.05)
+    store.insert_session("s1", "doc_a", "a.pdf")
+    store.insert_session("s2", "doc_a", "a.pdf")
+    store.insert_messages([("s1", "human", "hello", "a.pdf"), ("s1", "ai", "hi", "a.pdf")])
+    store.insert_messages([("s2", "human", "question", "b.pdf"), ("s2", "ai", "answer", "b.pdf")])
+    print(store.load_rows())
+    store.delete_session("s1")
+    print(store.load_rows())
+    print(store.load_sessions())
+
+    # a failing batch is retried, then written row by row
+    write, failures = store._write, iter([True, True, True, True, False, True, False])
+
+    def flaky_write(rows):
+        if next(failures, False):
+            raise sqlite3.OperationalError("database is locked")
+        write(rows)
+
+    store._write, store.retry_backoff = flaky_write, 0.01
+    store.insert_messages([("s2", "human", "q2", "b.pdf"), ("s2", "ai", "a2", "b.pdf")])
+    store.flush()
+    assert [row["content"] for row in store.load_rows()] == ["question", "answer", "q2"]
+    print(store.stats())
+    store.close()
+
+
+if __name__ == "__main__":
+    test()
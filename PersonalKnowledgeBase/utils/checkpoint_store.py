@@ -0,0 +1,324 @@
+import logging
+import os
+import pickle
+import queue
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+
+from langgraph.checkpoint.memory import InMemorySaver
+
+from config import Args
+
+args = Args()
+logger = logging.getLogger(__name__)
+
+
+class BoundedCheckpointSaver(InMemorySaver):
+    """
+    Checkpointer of the orchestrator. Checkpoints are served from memory like InMemorySaver, but every thread
+    (session) keeps only its latest checkpoints, the channel blobs they reference and their pending writes, and
+    is written to a sqlite file in the background so conversations survive a restart. A thread is read from
+    the file the first time it is used and `unload` drops it from memory again (when its session is evicted),
+    only the threads of active sessions are kept in RAM.
+    Checkpoints of subgraphs (the QA agent, the summary graph) are dropped once the run that created them is
+    older than the oldest checkpoint kept.
+    """
+
+    def __init__(self, path=args.checkpoint_sqlite_path, max_checkpoints=args.max_checkpoints_per_thread,
+                 max_thread_bytes=args.max_checkpoint_kb_per_thread * 1024):
+        """
+        :param path: sqlite file, None to keep the checkpoints in memory only
+        :param max_checkpoints: checkpoints kept per thread, at least 2 (the running step and its parent)
+        :param max_thread_bytes: older checkpoints of a thread are also dropped while it is larger than this,
+                                 the latest two are always kept
+        """
+        super().__init__()
+        self.path = path
+        self.max_checkpoints = max(2, max_checkpoints)
+        self.max_thread_bytes = max_thread_bytes
+        self._lock = threading.RLock()
+        self._versions = {}  # (thread_id, ns, checkpoint_id) -> channel_versions of the checkpoint
+        self._blob_keys = defaultdict(set)  # thread_id -> keys of its blobs
+        self._pending = queue.Queue()  # (thread_id, snapshot or None to delete)
+        self._unwritten = {}  # thread_id -> latest snapshot queued and not written yet, read instead of the file
+        self._resident = set()  # threads loaded from the file (or created) in this process
+        self.loaded_threads = 0
+        self.unloaded_threads = 0
+        self.pruned_checkpoints = 0
+        self.threads_written = 0
+        self.failed_writes = 0
+        self._conn = None
+        self._writer = None
+        if path:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS checkpoints (
+                    thread_id TEXT PRIMARY KEY,
+                    data BLOB NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            self._conn.commit()
+            self._writer = threading.Thread(target=self._write_loop, name="checkpoint-writer", daemon=True)
+            self._writer.start()
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"]["checkpoint_ns"]
+        with self._lock:
+            self._ensure_loaded(thread_id)
+            next_config = super().put(config, checkpoint, metadata, new_versions)
+            self._versions[(thread_id, checkpoint_ns, checkpoint["id"])] = dict(checkpoint["channel_versions"])
+            self._blob_keys[thread_id].update((thread_id, checkpoint_ns, channel, version)
+                                              for channel, version in new_versions.items())
+            if checkpoint_ns == "":
+                self._prune(thread_id)
+                if self._conn is not None:
+                    self._queue_write(thread_id, self._snapshot(thread_id))
+        return next_config
+
+    def put_writes(self, config, writes, task_id, task_path=""):
+        with self._lock:
+            self._ensure_loaded(config["configurable"]["thread_id"])
+            super().put_writes(config, writes, task_id, task_path)
+
+    def get_tuple(self, config):
+        with self._lock:
+            self._ensure_loaded(config["configurable"]["thread_id"])
+            return super().get_tuple(config)
+
+    def list(self, config, *, filter=None, before=None, limit=None):
+        with self._lock:
+            if config is not None:
+                self._ensure_loaded(config["configurable"]["thread_id"])
+            return iter(list(super().list(config, filter=filter, before=before, limit=limit)))
+
+    def delete_thread(self, thread_id):
+        with self._lock:
+            super().delete_thread(thread_id)
+            self._forget(thread_id)
+            self._resident.add(thread_id)  # nothing left to load
+            if self._conn is not None:
+                self._queue_write(thread_id, None)
+
+    def has_thread(self, thread_id):
+        """whether the thread has a checkpoint, without creating an empty entry like get_tuple does"""
+        with self._lock:
+            self._ensure_loaded(thread_id)
+            return bool(self.storage.get(thread_id, {}).get(""))
+
+    def unload(self, thread_id):
+        """drop a thread from memory, it is read from the file again when it is used; no-op without a file"""
+        with self._lock:
+            if self._conn is None or thread_id not in self._resident:
+                return
+            self.storage.pop(thread_id, None)
+            for key in [key for key in self.writes if key[0] == thread_id]:
+                del self.writes[key]
+            for key in self._blob_keys.get(thread_id, ()):
+                self.blobs.pop(key, None)
+            self._forget(thread_id)
+            self._resident.discard(thread_id)
+            self.unloaded_threads += 1
+
+    def _forget(self, thread_id):
+        for key in [key for key in self._versions if key[0] == thread_id]:
+            del self._versions[key]
+        self._blob_keys.pop(thread_id, None)
+
+    def _drop_checkpoint(self, thread_id, checkpoint_ns, checkpoint_id):
+        self.storage[thread_id][checkpoint_ns].pop(checkpoint_id, None)
+        self.writes.pop((thread_id, checkpoint_ns, checkpoint_id), None)
+        self._versions.pop((thread_id, checkpoint_ns, checkpoint_id), None)
+        self.pruned_checkpoints += 1
+
+    def _prune(self, thread_id):
+        namespaces = self.storage[thread_id]
+        root = namespaces[""]
+        # checkpoint ids are time ordered (uuid6), the same order InMemorySaver uses to find the latest one
+        checkpoint_ids = sorted(root)
+        for checkpoint_id in checkpoint_ids[:-self.max_checkpoints]:
+            self._drop_checkpoint(thread_id, "", checkpoint_id)
+        checkpoint_ids = checkpoint_ids[-self.max_checkpoints:]
+
+        oldest = checkpoint_ids[0]
+        for checkpoint_ns in [ns for ns in namespaces if ns != ""]:
+            if not namespaces[checkpoint_ns] or max(namespaces[checkpoint_ns]) < oldest:
+                for checkpoint_id in list(namespaces[checkpoint_ns]):
+                    self._drop_checkpoint(thread_id, checkpoint_ns, checkpoint_id)
+                del namespaces[checkpoint_ns]
+        self._drop_unused_blobs(thread_id)
+
+        while len(checkpoint_ids) > 2 and self.thread_bytes(thread_id) > self.max_thread_bytes:
+            self._drop_checkpoint(thread_id, "", checkpoint_ids.pop(0))
+            self._drop_unused_blobs(thread_id)
+
+    def _drop_unused_blobs(self, thread_id):
+        used = {(thread_id, checkpoint_ns, channel, version)
+                for checkpoint_ns, checkpoints in self.storage[thread_id].items()
+                for checkpoint_id in checkpoints
+                for channel, version in self._versions.get((thread_id, checkpoint_ns, checkpoint_id), {}).items()}
+        keys = self._blob_keys[thread_id]
+        for key in keys - used:
+            self.blobs.pop(key, None)
+        keys &= used
+
+    def _checkpoint_keys(self, thread_id):
+        return [(thread_id, checkpoint_ns, checkpoint_id)
+                for checkpoint_ns, checkpoints in self.storage.get(thread_id, {}).items()
+                for checkpoint_id in checkpoints]
+
+    def thread_bytes(self, thread_id):
+        """serialized size of the checkpoints, writes and blobs of a thread"""
+        with self._lock:
+            size = 0
+            for key in self._checkpoint_keys(thread_id):
+                checkpoint, metadata, _ = self.storage[thread_id][key[1]][key[2]]
+                size += len(checkpoint[1]) + len(metadata[1])
+                size += sum(len(write[2][1]) for write in self.writes.get(key, {}).values())
+            size += sum(len(self.blobs[key][1]) for key in self._blob_keys.get(thread_id, ()) if key in self.blobs)
+            return size
+
+    def _snapshot(self, thread_id):
+        keys = self._checkpoint_keys(thread_id)
+        return {
+            "storage": {ns: dict(checkpoints) for ns, checkpoints in self.storage[thread_id].items()},
+            "writes": {key: dict(self.writes[key]) for key in keys if key in self.writes},
+            "blobs": {key: self.blobs[key] for key in self._blob_keys[thread_id] if key in self.blobs},
+        }
+
+    def _ensure_loaded(self, thread_id):
+        """read a thread from the file on its first use, called with the lock held"""
+        if thread_id in self._resident:
+            return
+        self._resident.add(thread_id)
+        if self._conn is None:
+            return
+        if thread_id in self._unwritten:
+            snapshot = self._unwritten[thread_id]
+        else:
+            row = self._conn.execute("SELECT data FROM checkpoints WHERE thread_id = ?", (thread_id,)).fetchone()
+            snapshot = pickle.loads(row[0]) if row else None
+        if snapshot is None:
+            return
+        for checkpoint_ns, checkpoints in snapshot["storage"].items():
+            self.storage[thread_id][checkpoint_ns].update(checkpoints)
+            for checkpoint_id, (checkpoint, _, _) in checkpoints.items():
+                versions = self.serde.loads_typed(checkpoint).get("channel_versions", {})
+                self._versions[(thread_id, checkpoint_ns, checkpoint_id)] = dict(versions)
+        for key, writes in snapshot["writes"].items():
+            self.writes[key] = dict(writes)
+        self.blobs.update(snapshot["blobs"])
+        self._blob_keys[thread_id] = set(snapshot["blobs"])
+        self.loaded_threads += 1
+
+    def _queue_write(self, thread_id, snapshot):
+        self._unwritten[thread_id] = snapshot
+        self._pending.put((thread_id, snapshot))
+
+    def _write_loop(self):
+        while True:
+            items = [self._pending.get()]
+            while True:
+                try:
+                    items.append(self._pending.get_nowait())
+                except queue.Empty:
+                    break
+            # a thread checkpointed several times meanwhile is written once, with its latest state
+            batch = dict(items)
+            try:
+                now = time.time()
+                for thread_id, snapshot in batch.items():
+                    if snapshot is None:
+                        self._conn.execute("DELETE FROM checkpoints WHERE thread_id = ?", (thread_id,))
+                    else:
+                        self._conn.execute("INSERT OR REPLACE INTO checkpoints (thread_id, data, updated_at) "
+                                           "VALUES (?, ?, ?)", (thread_id, pickle.dumps(snapshot), now))
+                self._conn.commit()
+                self.threads_written += len(batch)
+            except Exception as e:
+                self.failed_writes += len(batch)
+                logger.exception("failed to write checkpoints of %d threads: %s", len(batch), e)
+            finally:
+                with self._lock:
+                    for thread_id, snapshot in batch.items():
+                        if self._unwritten.get(thread_id, False) is snapshot:
+                            del self._unwritten[thread_id]
+                for _ in items:
+                    self._pending.task_done()
+
+    def flush(self):
+        """wait until the queued checkpoints are written"""
+        if self._conn is not None:
+            self._pending.join()
+
+    def stats(self):
+        with self._lock:
+            thread_bytes = {thread_id: self.thread_bytes(thread_id) for thread_id in list(self.storage)
+                            if self.storage[thread_id].get("")}
+            return {
+                "path": self.path,
+                "threads": len(thread_bytes),
+                "loaded_threads": self.loaded_threads,
+                "unloaded_threads": self.unloaded_threads,
+                "total_bytes": sum(thread_bytes.values()),
+                "max_thread_bytes": max(thread_bytes.values(), default=0),
+                "thread_bytes": thread_bytes,
+                "max_checkpoints_per_thread": self.max_checkpoints,
+                "pruned_checkpoints": self.pruned_checkpoints,
+                "threads_written": self.threads_written,
+                "failed_writes": self.failed_writes,
+                "pending_writes": self._pending.qsize(),
+            }
+
+
+def test():
+    import asyncio
+    import operator
+    import tempfile
+    from typing import TypedDict, Annotated, List
+    from langgraph.graph import StateGraph, START, END
+
+    class State(TypedDict):
+        items: Annotated[List[str], operator.add]
+
+    def step(state: State):
+        return {"items": ["x" * 100]}
+
+    builder = StateGraph(State)
+    builder.add_node("step", step)
+    builder.add_edge(START, "step")
+    builder.add_edge("step", END)
+
+    path = os.path.join(tempfile.mkdtemp(), "checkpoints.sqlite3")
+    saver = BoundedCheckpointSaver(path, max_checkpoints=3)
+    graph = builder.compile(checkpointer=saver)
+    for i in range(10):
+        asyncio.run(graph.ainvoke({"items": [str(i)]}, {"configurable": {"thread_id": "t1"}}))
+    graph.invoke({"items": ["a"]}, {"configurable": {"thread_id": "t2"}})
+    assert len(saver.storage["t1"][""]) == 3
+    assert len(graph.get_state({"configurable": {"thread_id": "t1"}}).values["items"]) == 20
+    saver.flush()
+    print(saver.stats())
+
+    saver.unload("t1")
+    assert "t1" not in saver.storage
+    assert len(graph.get_state({"configurable": {"thread_id": "t1"}}).values["items"]) == 20
+
+    reloaded = BoundedCheckpointSaver(path)
+    assert not reloaded.storage
+    assert reloaded.has_thread("t1") and not reloaded.has_thread("t3")
+    state = builder.compile(checkpointer=reloaded).get_state({"configurable": {"thread_id": "t1"}})
+    assert len(state.values["items"]) == 20
+    reloaded.delete_thread("t1")
+    reloaded.flush()
+    assert not BoundedCheckpointSaver(path).has_thread("t1")
+    print("ok")
+
+
+if __name__ == '__main__':
+    test()
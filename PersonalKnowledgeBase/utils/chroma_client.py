@@ -0,0 +1,167 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from config import Args, get_embeddings
+
+args = Args()
+logger = logging.getLogger(__name__)
+
+
+class ChromaClient:
+    """
+    One chromadb PersistentClient for a persist directory, shared by every session of the process, with an LRU
+    cache of the langchain Chroma handles of its collections. Opening a session no longer reopens the sqlite
+    metadata and the HNSW segments, and concurrent first calls do not race on the client creation.
+    """
+
+    def __init__(self, persist_dir, max_collections=args.max_open_collections):
+        """
+        :param persist_dir: chroma persist directory
+        :param max_collections: max number of collection handles kept open, least recently used are evicted
+        """
+        self.persist_dir = persist_dir
+        self.max_collections = max_collections
+        self._client = None
+        self._collections = OrderedDict()  # collection name -> Chroma, least recently used first
+        self._lock = threading.RLock()
+        self.clients_created = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                import chromadb  # chromadb is slow to import, load it on first use
+                from chromadb.config import Settings
+                self._client = chromadb.PersistentClient(path=self.persist_dir,
+                                                         settings=Settings(anonymized_telemetry=False))
+                self.clients_created += 1
+                logger.info("opened chroma client on %s", self.persist_dir)
+            return self._client
+
+    def collection(self, name, embedding_function=None, hnsw=None):
+        """
+        :param name: collection name, the doc_id for document collections
+        :param embedding_function: defaults to the shared embedding model
+        :param hnsw: HNSW configuration used if the collection is created, defaults to args.document_hnsw
+        :return: langchain Chroma handle of the collection, created if it does not exist
+        """
+        with self._lock:
+            vector_store = self._collections.get(name)
+            if vector_store is not None:
+                self.hits += 1
+                self._collections.move_to_end(name)
+                return vector_store
+            from langchain_chroma import Chroma
+            self.misses += 1
+            vector_store = Chroma(collection_name=name, embedding_function=embedding_function or get_embeddings(),
+                                  client=self.client,
+                                  collection_configuration={"hnsw": dict(hnsw or args.document_hnsw)})
+            self._collections[name] = vector_store
+            while len(self._collections) > self.max_collections:
+                self._collections.popitem(last=False)
+                self.evictions += 1
+            return vector_store
+
+    def collection_metadata(self, name):
+        """metadata of a collection without creating it, None if there is no such collection"""
+        from chromadb.errors import NotFoundError
+        try:
+            return self.client.get_collection(name).metadata or {}
+        except NotFoundError:
+            return None
+
+    def evict(self, name):
+        """drop the cached handle of a collection, e.g. after it was deleted; sessions still holding it keep working"""
+        with self._lock:
+            if self._collections.pop(name, None) is not None:
+                self.evictions += 1
+                return True
+            return False
+
+    def delete_collection(self, name):
+        """
+        Delete a collection and its records from chroma.sqlite3. Its HNSW segment directory stays on disk (the
+        files may still be open in the client) until `python -m utils.chroma_compact` removes it.
+        :return: False if the collection did not exist
+        """
+        from chromadb.errors import NotFoundError
+        with self._lock:
+            self.evict(name)
+            try:
+                self.client.delete_collection(name)
+            except NotFoundError:
+                return False
+            return True
+
+    def close(self):
+        """drop all handles and stop the client, the next call opens a new one"""
+        with self._lock:
+            self._collections.clear()
+            if self._client is not None:
+                from chromadb.api.shared_system_client import SharedSystemClient
+                self._client._system.stop()
+                # chromadb keeps one system per path, forget it so that a new client really reopens the store
+                SharedSystemClient._identifier_to_system.pop(self._client._identifier, None)
+                self._client = None
+                logger.info("closed chroma client on %s", self.persist_dir)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "persist_dir": self.persist_dir,
+                "client_open": self._client is not None,
+                "clients_created": self.clients_created,
+                "open_collections": len(self._collections),
+                "max_collections": self.max_collections,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_chroma_client(persist_dir=args.CHROMA_PERSIST_DIR):
+    """the process-wide ChromaClient of a persist directory"""
+    key = os.path.abspath(persist_dir)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = ChromaClient(persist_dir)
+        return _clients[key]
+
+
+def close_chroma_clients():
+    with _clients_lock:
+        for chroma_client in _clients.values():
+            chroma_client.close()
+
+
+def test():
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+    from langchain_core.documents import Document
+    from langchain_core.embeddings import FakeEmbeddings
+
+    with tempfile.TemporaryDirectory() as tmp:
+        chroma_client = ChromaClient(tmp, max_collections=2)
+        embeddings = FakeEmbeddings(size=8)
+        with ThreadPoolExecutor(8) as pool:
+            handles = list(pool.map(lambda i: chroma_client.collection(f"session{i % 3}", embeddings), range(24)))
+        assert chroma_client.clients_created == 1
+        assert len(set(map(id, handles))) >= 3
+        handles[0].add_documents([Document("hello", metadata={"type": "documents"})])
+        chroma_client.close()
+        assert chroma_client.collection("session0", embeddings)._collection.count() == 1
+        print(chroma_client.stats())
+        chroma_client.close()
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,118 @@
+"""
+Garbage collection of the Chroma persist directory. Deleting a collection removes its rows from chroma.sqlite3
+but leaves its HNSW segment directory (named by segment UUID) on disk, and sqlite does not give the freed pages
+back to the file system. This removes the segment directories no segment row points to, the BM25 indexes of
+collections that no longer exist, then VACUUMs chroma.sqlite3.
+
+Run it while the server is stopped, chroma must not be writing to the directory.
+
+usage (from PersonalKnowledgeBase/):
+    python -m utils.chroma_compact [--persist-dir data/CHROMA_PERSIST] [--bm25-dir data/BM25_PERSIST] [--dry-run]
+"""
+import argparse
+import os
+import shutil
+import sqlite3
+import uuid
+
+from config import Args
+
+args = Args()
+
+SQLITE_FILE = "chroma.sqlite3"
+# files of a hnsw-local-persisted segment, a directory without any of them is not touched
+SEGMENT_FILES = {"header.bin", "data_level0.bin", "length.bin", "link_lists.bin", "index_metadata.pickle"}
+
+
+def path_bytes(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def sqlite_bytes(db_path):
+    return sum(path_bytes(db_path + suffix) for suffix in ("", "-wal", "-shm") if os.path.exists(db_path + suffix))
+
+
+def is_segment_dir(path):
+    try:
+        uuid.UUID(os.path.basename(path))
+    except ValueError:
+        return False
+    return os.path.isdir(path) and bool(SEGMENT_FILES & set(os.listdir(path)))
+
+
+def compact(persist_dir=args.CHROMA_PERSIST_DIR, bm25_dir=args.BM25_PERSIST_DIR, dry_run=False):
+    """
+    :param persist_dir: chroma persist directory
+    :param bm25_dir: directory of the per-session BM25 indexes, None to leave them alone
+    :param dry_run: only report what would be removed
+    :return: report dict, sizes in bytes
+    """
+    db_path = os.path.join(persist_dir, SQLITE_FILE)
+    if not os.path.exists(db_path):
+        raise FileNotFoundError(f"{db_path} does not exist")
+
+    conn = sqlite3.connect(db_path)
+    try:
+        segment_ids = {row[0] for row in conn.execute("SELECT id FROM segments")}
+        collection_names = {row[0] for row in conn.execute("SELECT name FROM collections")}
+    finally:
+        conn.close()
+
+    report = {"segment_dirs_removed": [], "segment_bytes": 0, "bm25_files_removed": [], "bm25_bytes": 0,
+              "sqlite_bytes_before": sqlite_bytes(db_path), "sqlite_bytes_after": None, "dry_run": dry_run}
+    for name in sorted(os.listdir(persist_dir)):
+        path = os.path.join(persist_dir, name)
+        if name in segment_ids or not is_segment_dir(path):
+            continue
+        report["segment_dirs_removed"].append(name)
+        report["segment_bytes"] += path_bytes(path)
+        if not dry_run:
+            shutil.rmtree(path)
+
+    if bm25_dir and os.path.isdir(bm25_dir):
+        for name in sorted(os.listdir(bm25_dir)):
+            session_id, ext = os.path.splitext(name)
+            if ext != ".json" or session_id in collection_names:
+                continue
+            path = os.path.join(bm25_dir, name)
+            report["bm25_files_removed"].append(name)
+            report["bm25_bytes"] += path_bytes(path)
+            if not dry_run:
+                os.remove(path)
+
+    if dry_run:
+        report["sqlite_bytes_after"] = report["sqlite_bytes_before"]
+    else:
+        conn = sqlite3.connect(db_path, isolation_level=None)
+        try:
+            conn.execute("VACUUM")
+        finally:
+            conn.close()
+        report["sqlite_bytes_after"] = sqlite_bytes(db_path)
+    report["bytes_reclaimed"] = (report["segment_bytes"] + report["bm25_bytes"]
+                                 + report["sqlite_bytes_before"] - report["sqlite_bytes_after"])
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--persist-dir', default=args.CHROMA_PERSIST_DIR)
+    parser.add_argument('--bm25-dir', default=args.BM25_PERSIST_DIR)
+    parser.add_argument('--dry-run', action='store_true', help='only report what would be removed')
+    options = parser.parse_args()
+
+    report = compact(options.persist_dir, options.bm25_dir, options.dry_run)
+    action = "would remove" if options.dry_run else "removed"
+    print(f"{action} {len(report['segment_dirs_removed'])} orphan segment dirs, {report['segment_bytes']} bytes")
+    for name in report["segment_dirs_removed"]:
+        print(f"  {name}")
+    print(f"{action} {len(report['bm25_files_removed'])} orphan BM25 indexes, {report['bm25_bytes']} bytes")
+    print(f"{os.path.join(options.persist_dir, SQLITE_FILE)}: {report['sqlite_bytes_before']} -> "
+          f"{report['sqlite_bytes_after']} bytes")
+    print(f"reclaimed {report['bytes_reclaimed']} bytes ({report['bytes_reclaimed'] / 1024 / 1024:.1f} MB)")
+
+
+if __name__ == '__main__':
+    main()
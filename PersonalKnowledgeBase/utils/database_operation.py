@@ -1,48 +1,208 @@
 import os
-import shutil
-import mysql.connector
+import queue
+import threading
+import time
 from langchain_core.documents import Document
 from langchain_core.messages import HumanMessage, AIMessage
-from langchain_chroma import Chroma
 
-from prompts.extract_key_info import extract_key_info_prompt
-from config import llm, embeddings, Args
+from config import Args
+from utils.chat_store import ChatHistoryStore
+from ingestion.get_file_chunks import iter_file_chunks
+from ingestion.batch_ingest import iter_parsed_files
+from utils.bm25_index import BM25Index
+from utils.chroma_client import get_chroma_client
+from utils.hashing import file_hash, text_hash
+from utils.memory_worker import MEMORY_TYPE, memory_collection, memory_collection_name, memory_filter
 
 args = Args()
 DB_CONFIG = {
-    "host": "localhost",
+    "host": args.mysql_host,
     "user": args.mysql_user,
     "password": args.mysql_password,
     "database": args.mysql_database,
 }
 
+_store_options = dict(async_writes=args.chat_store_async_writes, batch_size=args.chat_store_batch_size,
+                      flush_interval=args.chat_store_flush_interval)
+if args.chat_store_backend == 'sqlite':
+    chat_store = ChatHistoryStore.for_sqlite(args.chat_store_sqlite_path, **_store_options)
+else:
+    # 连接在第一次使用时才会建立
+    chat_store = ChatHistoryStore.for_mysql(DB_CONFIG, **_store_options)
 
-def create_chroma_for_docs(docs, session_id):
+
+def document_id(files):
     """
-    Create (or reuse) a Chroma collection for this session and add documents.
-    :param docs:
-    :param session_id:
-    :return:
+    Id of the document store entry (Chroma collection + BM25 index) of uploaded files, derived from their
+    content: the same file uploaded twice, under any name, maps to the same collection.
+    :param files: paths of the files indexed together
+    :return: "doc_<sha256>"
     """
-    chroma_vs = Chroma.from_documents(
-        documents=docs,
-        embedding=embeddings,
-        collection_name=session_id,
-        persist_directory=args.CHROMA_PERSIST_DIR
-    )
-    return chroma_vs
+    hashes = sorted(file_hash(file) for file in files)
+    return "doc_" + (hashes[0] if len(hashes) == 1 else text_hash("\n".join(hashes), "files"))
+
+
+def get_document_info(doc_id):
+    """
+    :return: {"status": "ready", "filename", "chunks", "pages"} of a completely indexed document, None if it
+             was never indexed or its ingestion did not finish
+    """
+    metadata = get_chroma_client().collection_metadata(doc_id)
+    if not metadata or metadata.get("status") != "ready":
+        return None
+    return metadata
+
+
+def mark_document_ready(doc_id, filename, chunks, pages):
+    """flag the collection as completely indexed, later uploads of the same content reuse it"""
+    vector_store = get_chroma_client().collection(doc_id)
+    vector_store._collection.modify(metadata={"status": "ready", "filename": filename, "chunks": chunks,
+                                              "pages": pages})
+
+
+def bm25_path(doc_id):
+    return os.path.join(args.BM25_PERSIST_DIR, f"{doc_id}.json")
+
+
+def load_bm25_index(doc_id):
+    """
+    BM25 index written at ingestion time; documents indexed before it existed get theirs built from the chunks
+    in their collection
+    """
+    path = bm25_path(doc_id)
+    if os.path.exists(path):
+        return BM25Index.load(path)
+    _, docs = load_data_from_chroma(doc_id)
+    bm25_index = BM25Index()
+    bm25_index.add(docs)
+    bm25_index.save(path)
+    return bm25_index
+
+
+def stream_chroma_for_file(file_name, doc_id, batch_size=args.ingest_batch_size,
+                           max_pending_batches=args.ingest_queue_batches):
+    """
+    Parse, split, embed and write a file into the session's Chroma collection batch by batch.
+    Parsing runs in a producer thread and is at most `max_pending_batches` batches ahead of the embedding,
+    so parsing and embedding overlap while memory stays bounded.
+    :return: generator of progress dicts, the last one has stage "done"
+    """
+    vector_store = get_chroma_client().collection(doc_id)
+    batches = queue.Queue(maxsize=max_pending_batches)
+    stop = threading.Event()
+    finished = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    parse_seconds = [0.0]
+
+    def produce():
+        batch = []
+        try:
+            chunks = iter_file_chunks(file_name)
+            while not stop.is_set():
+                tick = time.perf_counter()
+                chunk = next(chunks, None)
+                parse_seconds[0] += time.perf_counter() - tick
+                if chunk is None:
+                    break
+                batch.append(chunk)
+                if len(batch) >= batch_size:
+                    put(batch)
+                    batch = []
+            if batch:
+                put(batch)
+            put(finished)
+        except Exception as e:
+            put(e)
 
+    producer = threading.Thread(target=produce, name=f"ingest-{doc_id}", daemon=True)
+    start = time.perf_counter()
+    producer.start()
+    progress = {"stage": "indexing", "chunks": 0, "pages": 0, "batches": 0,
+                "parse_seconds": 0.0, "embed_seconds": 0.0, "elapsed": 0.0}
+    pages = set()
+    bm25_index = BM25Index()
+    try:
+        while True:
+            item = batches.get()
+            if item is finished:
+                break
+            if isinstance(item, Exception):
+                raise item
+            for index, chunk in enumerate(item, start=progress["chunks"]):
+                chunk.metadata["chunk_index"] = index
+                pages.add(chunk.metadata.get("page"))
+            tick = time.perf_counter()
+            bm25_index.add(item, vector_store.add_documents(item))
+            progress.update(chunks=progress["chunks"] + len(item), pages=len(pages), batches=progress["batches"] + 1,
+                            parse_seconds=round(parse_seconds[0], 3),
+                            embed_seconds=round(progress["embed_seconds"] + time.perf_counter() - tick, 3),
+                            elapsed=round(time.perf_counter() - start, 3))
+            yield dict(progress)
+    finally:
+        stop.set()
+    if not progress["chunks"]:
+        # e.g. a scanned pdf without a text layer, it must not be marked ready and reused by later uploads
+        raise ValueError("no text could be extracted from the file")
+    bm25_index.save(bm25_path(doc_id))
+    progress.update(stage="done", parse_seconds=round(parse_seconds[0], 3),
+                    elapsed=round(time.perf_counter() - start, 3))
+    yield dict(progress)
 
-def load_data_from_chroma(session_id, data_type='documents', persist_dir=args.CHROMA_PERSIST_DIR):
+
+def stream_chroma_for_files(files, doc_id, max_workers=args.batch_ingest_workers,
+                            batch_size=args.ingest_batch_size):
+    """
+    Index many files into one Chroma collection. The files are parsed in a process pool (see
+    ingestion/batch_ingest.py) and each file is embedded as soon as its chunks come back.
+    Files that fail to parse are reported and skipped.
+    :return: generator of progress dicts, one per file with its timings under "file", the last one has stage
+             "done" and all file reports under "files"
+    """
+    vector_store = get_chroma_client().collection(doc_id)
+    start = time.perf_counter()
+    progress = {"stage": "indexing", "files_done": 0, "files_total": len(files), "chunks": 0, "pages": 0,
+                "parse_seconds": 0.0, "embed_seconds": 0.0, "elapsed": 0.0}
+    reports = []
+    bm25_index = BM25Index()
+    for result in iter_parsed_files(files, max_workers):
+        chunks = result.pop("chunks")
+        tick = time.perf_counter()
+        for index, chunk in enumerate(chunks, start=progress["chunks"]):
+            chunk.metadata["chunk_index"] = index
+        for i in range(0, len(chunks), batch_size):
+            batch = chunks[i:i + batch_size]
+            bm25_index.add(batch, vector_store.add_documents(batch))
+        report = {**result, "chunks": len(chunks), "embed_seconds": round(time.perf_counter() - tick, 3)}
+        reports.append(report)
+        progress.update(files_done=progress["files_done"] + 1, chunks=progress["chunks"] + len(chunks),
+                        pages=progress["pages"] + report["pages"],
+                        parse_seconds=round(progress["parse_seconds"] + report["parse_seconds"], 3),
+                        embed_seconds=round(progress["embed_seconds"] + report["embed_seconds"], 3),
+                        elapsed=round(time.perf_counter() - start, 3))
+        yield {**progress, "file": report}
+    if not progress["chunks"]:
+        errors = "; ".join(f"{r['file']}: {r['error']}" for r in reports if r["error"])
+        raise ValueError(f"no chunks could be extracted from the batch ({errors or 'no files'})")
+    bm25_index.save(bm25_path(doc_id))
+    progress.update(stage="done", elapsed=round(time.perf_counter() - start, 3))
+    yield {**progress, "files": reports}
+
+
+def load_data_from_chroma(doc_id, data_type='documents', persist_dir=args.CHROMA_PERSIST_DIR):
     """
-    load vector_store, docs from chroma and create app_agent for this session.
+    load vector_store, docs of a document from chroma.
+    :param doc_id: collection name, the session_id for sessions created before documents were shared
     :return:
     """
-    vector_store = Chroma(
-        embedding_function=embeddings,
-        collection_name=session_id,
-        persist_directory=persist_dir
-    )
+    vector_store = get_chroma_client(persist_dir).collection(doc_id)
     # print(vector_store._collection.count())
     result = vector_store.get(
         where={"type": data_type},
@@ -51,109 +211,117 @@ def load_data_from_chroma(session_id, data_type='documents', persist_dir=args.CH
     documents = result["documents"]
     metadatas = result["metadatas"]
     docs = []
-    for doc, metadata in zip(documents, metadatas):
-        docs.append(Document(page_content=doc, metadata=metadata))
+    for chunk_id, doc, metadata in zip(result["ids"], documents, metadatas):
+        docs.append(Document(page_content=doc, metadata=metadata, id=chunk_id))
     # print(docs)
     return vector_store, docs
 
 
-def load_data_from_mysql():
+def load_document_texts(vector_store):
     """
-    load history, metadata from mysql database
-    :return SESSIONS[session_id] = {"history": List[BaseMessage], "metadata": {"filename": "filename"}}
+    Chunk texts of the document in a collection, in document order (`chunk_index`, insertion order for chunks
+    indexed without it). Long-term memories stored in the same collection are left out.
+    Read from chroma when a summary needs them, sessions do not keep them in memory.
     """
-    print("log: 试图从mysql读取数据")
-    conn = mysql.connector.connect(**DB_CONFIG)
-    cursor = conn.cursor(dictionary=True)
+    result = vector_store.get(where={"type": "documents"}, include=["documents", "metadatas"])
+    order = sorted(range(len(result["ids"])),
+                   key=lambda i: (result["metadatas"][i] or {}).get("chunk_index", i))
+    return [result["documents"][i] for i in order]
 
-    query = """
-        SELECT session_id, role, content, filename, created_at
-        FROM chat_history
-        ORDER BY session_id, created_at
-    """
-    cursor.execute(query)
-    rows = cursor.fetchall()
 
+def load_data_from_mysql():
+    """
+    load history, metadata from mysql database. Vector stores and docs are not opened here,
+    see `load_data_from_chroma` which is called when a session becomes active.
+    :return SESSIONS[session_id] = {"history": List[BaseMessage], "metadatas": {"filename": "filename",
+                                                                                 "doc_id": "doc_..."}}
+    """
+    print("log: 试图从mysql读取数据")
     SESSIONS = {}
-    for row in rows:
+    for row in chat_store.load_sessions():
+        SESSIONS[row["session_id"]] = {"history": [], "metadatas": {"filename": row["filename"],
+                                                                    "doc_id": row["doc_id"]}}
+
+    for row in chat_store.load_rows():
         sid = row["session_id"]
         if sid not in SESSIONS:
-            vector_store, docs = load_data_from_chroma(sid)
-            SESSIONS[sid] = {"vector_store": vector_store, "docs": docs, "history": [], "metadatas": {}}
-            SESSIONS[sid]["metadatas"]["filename"] = row["filename"]
+            # 旧会话没有sessions记录，其collection以session_id命名
+            SESSIONS[sid] = {"history": [], "metadatas": {"filename": row["filename"], "doc_id": sid}}
 
         if row['role'] == "human":
             SESSIONS[sid]["history"].append(HumanMessage(row["content"]))
         else:
             SESSIONS[sid]["history"].append(AIMessage(row["content"]))
 
-    cursor.close()
-    conn.close()
-
     return SESSIONS
 
 
 def insert_message(session_id, role, content, filename=None):
-    conn = mysql.connector.connect(**DB_CONFIG)
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT INTO chat_history (session_id, role, content, filename)
-        VALUES (%s, %s, %s, %s)
-    """, (session_id, role, content, filename))
-    conn.commit()
-    cursor.close()
-    conn.close()
-
-
-def add_long_term_memory(histories, vector_store):
-    """extract key information from the last 10 chat messages and store it into chroma"""
-    print("log:试图把聊天历史转化为长期记忆")
-    content = "\n"
-    for msg in histories:
-        content += f"{msg.type}: {msg.content}\n"
-    prompt = extract_key_info_prompt.invoke({"history": content})
-    answer = llm.invoke(prompt)
-    vector_store.add_texts([answer.content], metadatas=[{"type": "lang-term-memory"}])
-    return vector_store
+    chat_store.insert_messages([(session_id, role, content, filename)])
 
 
 def save_conversation_to_mysql(session_id, session):
     """
-    save conversation to mysql database and turn the last 10 new chat message into long-term memory
-    :return None or session['vector_store'], the latter if there are some updates in vector_store
+    save the last question and answer of a session to mysql database; turning chat messages into long-term
+    memory is done in the background, see utils/memory_worker.py
     """
     print("log: 试图把数据写入mysql")
-    insert_message(session_id, session["history"][-2].type,
-                   session["history"][-2].content, session["metadatas"]["filename"])
-    insert_message(session_id, session["history"][-1].type,
-                   session["history"][-1].content, session["metadatas"]["filename"])
-    if len(session["history"]) % 10 == 0:
-        session["vector_store"] = add_long_term_memory(session["history"][-10:], session['vector_store'])
-        return session["vector_store"]
-    return None
+    # human/ai 一问一答作为一个事务写入
+    filename = session["metadatas"]["filename"]
+    chat_store.insert_messages([
+        (session_id, msg.type, msg.content, filename) for msg in session["history"][-2:]
+    ])
 
 
 def delete_session_in_mysql(session_id):
     """
     Delete all chat records associated with a specific session_id.
     """
-    conn = mysql.connector.connect(**DB_CONFIG)
-    cursor = conn.cursor()
+    chat_store.delete_session(session_id)
 
-    query = "DELETE FROM chat_history WHERE session_id = %s"
-    cursor.execute(query, (session_id,))
 
-    conn.commit()
-    cursor.close()
-    conn.close()
+def insert_session(session_id, doc_id, filename):
+    chat_store.insert_session(session_id, doc_id, filename)
 
 
-def delete_session_in_chroma(session_id):
-    """directly delete all chat records associated with a specific session_id."""
-    # 物理删除存储embeddings的文件，尽管.sqlite3中仍有元数据信息
-    target_dir = os.path.join(args.CHROMA_PERSIST_DIR, session_id)
-    if os.path.exists(target_dir):
-        shutil.rmtree(target_dir)
+def delete_session_memories(doc_id, session_id):
+    """delete the memory collection of a session, and its memories left in the collection of its document"""
+    get_chroma_client().delete_collection(memory_collection_name(session_id))
+    get_chroma_client().collection(doc_id).delete(where=memory_filter(session_id))
+
+
+def move_memories_out_of_document(doc_id):
+    """
+    Long-term memories used to be written into the collection of the document, next to its chunks. Move them
+    to the memory collections of their sessions, so the document collection only holds chunks.
+    :return: number of memories moved
+    """
+    collection = get_chroma_client().collection(doc_id)._collection
+    result = collection.get(where=memory_filter(), include=["embeddings", "documents", "metadatas"])
+    if not result["ids"]:
+        return 0
+    by_session = {}
+    for i, metadata in enumerate(result["metadatas"]):
+        # 旧会话的记忆没有session_id，其collection以session_id命名
+        by_session.setdefault((metadata or {}).get("session_id") or doc_id, []).append(i)
+    for session_id, indices in by_session.items():
+        memory_collection(session_id)._collection.upsert(
+            ids=[result["ids"][i] for i in indices],
+            embeddings=[result["embeddings"][i] for i in indices],
+            documents=[result["documents"][i] for i in indices],
+            metadatas=[{**(result["metadatas"][i] or {}), "type": MEMORY_TYPE, "session_id": session_id}
+                       for i in indices])
+    collection.delete(ids=result["ids"])
+    print(f"log: 把 {len(result['ids'])} 条长期记忆从 {doc_id} 移到各会话的记忆collection")
+    return len(result["ids"])
+
+
+def delete_document_in_chroma(doc_id):
+    """delete the Chroma collection (records, metadata and embeddings) and the BM25 index of a document."""
+    # 通过客户端删除collection；其HNSW段目录以段UUID命名，由 python -m utils.chroma_compact 回收
+    get_chroma_client().delete_collection(doc_id)
+    if os.path.exists(bm25_path(doc_id)):
+        os.remove(bm25_path(doc_id))
 
 
 def test():
@@ -162,12 +330,8 @@ def test():
         Document(page_content="上海是中国的经济中心。", metadata={"source": "wiki", "type": "documents"}),
         Document(page_content="广州以美食闻名。", metadata={"source": "wiki", "type": "documents"}),
     ]
-    vector_store = Chroma.from_documents(
-        documents=docs,
-        embedding=embeddings,
-        collection_name="demo_collection",
-        persist_directory=args.CHROMA_PERSIST_DIR
-    )
+    vector_store = get_chroma_client().collection("demo_collection")
+    vector_store.add_documents(docs)
     vector_store.add_texts(["这是新加入的数据"], metadatas=[{"type": "memory"}])
     print("成功存储")
     vector_store, chat_data = load_data_from_chroma("demo_collection")
@@ -176,8 +340,7 @@ def test():
 
 if __name__ == "__main__":
     # test()
-    # delete_session_in_chroma("6095ea36-2a38-47b1-bd0a-509ef452ce20")
-    vector_store, chat_data = load_data_from_chroma(session_id="785ddfd8-6e4b-4820-9fd9-67f0196d141e",
-                                                    data_type="lang-term-memory",
-                                                    persist_dir="../data/CHROMA_PERSIST")
+    # delete_document_in_chroma("6095ea36-2a38-47b1-bd0a-509ef452ce20")
+    vector_store, chat_data = load_data_from_chroma(doc_id=memory_collection_name("785ddfd8-6e4b-4820-9fd9-67f0196d141e"),
+                                                    data_type=MEMORY_TYPE, persist_dir="../data/CHROMA_PERSIST")
     print(chat_data)
\ No newline at end of file
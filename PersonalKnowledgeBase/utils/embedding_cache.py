@@ -0,0 +1,198 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from typing import List
+
+from langchain_core.embeddings import Embeddings
+
+from utils.hashing import text_hash
+
+logger = logging.getLogger(__name__)
+
+# sqlite limits the number of host parameters of one statement
+_LOOKUP_CHUNK = 500
+# last_used of cache hits is written in batches, not on every lookup
+_TOUCH_BATCH = 1024
+_TOUCH_INTERVAL = 60.0
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper with an on-disk cache keyed by hash(model name + text).
+    Texts found in the cache never reach the wrapped model. When the cache grows beyond `max_bytes` the
+    least recently used vectors are evicted. Lookups only read, the use times of the hits are kept in memory
+    and written with the next store, eviction or batch of `_TOUCH_BATCH` hits.
+    """
+
+    def __init__(self, underlying: Embeddings, model_name: str, path: str, max_bytes: int = 512 * 1024 * 1024):
+        """
+        :param underlying: the embeddings model that computes missing vectors
+        :param model_name: part of the cache key, vectors of different models never collide
+        :param path: sqlite file of the cache
+        :param max_bytes: size budget of the cached vectors
+        """
+        self.underlying = underlying
+        self.model_name = model_name
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._touched = {}  # key -> last use not written yet
+        self._touches_written_at = time.monotonic()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS embedding_cache (
+                key TEXT PRIMARY KEY,
+                vector BLOB NOT NULL,
+                nbytes INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_used ON embedding_cache (last_used)")
+        self._conn.commit()
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(nbytes), 0) FROM embedding_cache").fetchone()[0]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(texts, "document", self.underlying.embed_documents)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([text], "query", lambda missing: [self.underlying.embed_query(t) for t in missing])[0]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._touched.clear()
+            self._conn.execute("DELETE FROM embedding_cache")
+            self._conn.commit()
+            self._total_bytes = 0
+
+    def _embed(self, texts, kind, compute):
+        # documents and queries may be embedded differently by some models, so they get separate keys
+        keys = [text_hash(text, f"{self.model_name}:{kind}") for text in texts]
+        with self._lock:
+            found = self._lookup(set(keys))
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        miss_count = sum(1 for key in keys if key not in found)
+        with self._lock:
+            self.hits += len(texts) - miss_count
+            self.misses += miss_count
+
+        if missing:
+            vectors = compute(list(missing.values()))
+            computed = dict(zip(missing.keys(), vectors))
+            with self._lock:
+                self._store(computed)
+            found.update(computed)
+        return [list(found[key]) for key in keys]
+
+    def _lookup(self, keys):
+        found = {}
+        keys = list(keys)
+        for i in range(0, len(keys), _LOOKUP_CHUNK):
+            part = keys[i:i + _LOOKUP_CHUNK]
+            marks = ", ".join("?" * len(part))
+            for key, blob in self._conn.execute(
+                    f"SELECT key, vector FROM embedding_cache WHERE key IN ({marks})", part):
+                found[key] = array("f", blob).tolist()
+        now = time.time()
+        self._touched.update((key, now) for key in found)
+        if len(self._touched) >= _TOUCH_BATCH or time.monotonic() - self._touches_written_at > _TOUCH_INTERVAL:
+            self._write_touches()
+            self._conn.commit()
+        return found
+
+    def _write_touches(self):
+        """write the pending last_used updates, the caller commits"""
+        if self._touched:
+            self._conn.executemany("UPDATE embedding_cache SET last_used = ? WHERE key = ?",
+                                   [(used, key) for key, used in self._touched.items()])
+            self._touched.clear()
+        self._touches_written_at = time.monotonic()
+
+    def _store(self, computed):
+        now = time.time()
+        rows = []
+        for key, vector in computed.items():
+            blob = array("f", vector).tobytes()
+            rows.append((key, blob, len(blob), now))
+        before = self._conn.total_changes
+        self._conn.executemany(
+            "INSERT OR IGNORE INTO embedding_cache (key, vector, nbytes, last_used) VALUES (?, ?, ?, ?)", rows)
+        if self._conn.total_changes - before == len(rows):
+            self._total_bytes += sum(row[2] for row in rows)
+        else:
+            # another thread stored some of the same vectors in the meantime
+            self._total_bytes = self._conn.execute(
+                "SELECT COALESCE(SUM(nbytes), 0) FROM embedding_cache").fetchone()[0]
+        # eviction below orders by last_used, the recent hits must be in the table first
+        self._write_touches()
+        self._conn.commit()
+        if self._total_bytes > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        """drop least recently used vectors until the cache is at 90% of its budget"""
+        target = int(self.max_bytes * 0.9)
+        rows = self._conn.execute("SELECT key, nbytes FROM embedding_cache ORDER BY last_used").fetchall()
+        victims = []
+        for key, nbytes in rows:
+            if self._total_bytes <= target:
+                break
+            victims.append((key,))
+            self._total_bytes -= nbytes
+        self._conn.executemany("DELETE FROM embedding_cache WHERE key = ?", victims)
+        self._conn.commit()
+        self.evictions += len(victims)
+        logger.info("embedding cache evicted %d vectors", len(victims))
+
+
+def test():
+    import tempfile
+
+    class FakeEmbeddings(Embeddings):
+        calls = 0
+
+        def embed_documents(self, texts):
+            FakeEmbeddings.calls += len(texts)
+            return [[float(len(t)), 1.0, 0.5] for t in texts]
+
+        def embed_query(self, text):
+            return self.embed_documents([text])[0]
+
+    path = os.path.join(tempfile.mkdtemp(), "embedding_cache.sqlite3")
+    cached = CachedEmbeddings(FakeEmbeddings(), "fake", path, max_bytes=12 * 3)
+    print(cached.embed_documents(["a", "bb", "a"]))
+    print(cached.embed_documents(["a", "bb", "ccc", "dddd"]))
+    print(cached.stats(), "model calls:", FakeEmbeddings.calls)
+
+    # hits are not written by the lookup, the next store writes them before it evicts
+    cached = CachedEmbeddings(FakeEmbeddings(), "fake", os.path.join(tempfile.mkdtemp(), "touch.sqlite3"))
+    cached.embed_documents(["e", "f"])
+    changes = cached._conn.total_changes
+    cached.embed_documents(["e"])
+    assert cached._conn.total_changes == changes and cached._touched
+    cached.embed_documents(["g"])
+    assert not cached._touched
+
+if __name__ == "__main__":
+    test()
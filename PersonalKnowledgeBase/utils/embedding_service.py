@@ -0,0 +1,182 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import List
+
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+
+class BatchingEmbeddings(Embeddings):
+    """
+    In-process embedding service: concurrent embed calls are queued and a single worker thread runs them
+    through the wrapped model in batches. A batch is sent when it holds `max_batch_size` texts or when its
+    oldest request has waited `max_wait` seconds. Queries are taken before documents, so a large ingestion
+    batch does not hold back the query of an /ask. The model can be passed as a factory, it is then loaded by
+    the worker on the first batch.
+    """
+
+    def __init__(self, underlying, max_batch_size=64, max_wait=0.005, queries_as_documents=False):
+        """
+        :param underlying: the embeddings model, or a function without arguments that builds it
+        :param max_batch_size: max number of texts per model call (a larger document request is sent alone)
+        :param max_wait: seconds a request may wait for others to join its batch
+        :param queries_as_documents: the model embeds queries like documents (e.g. sentence-transformers
+                                     without a query prompt), queries then share batches with documents
+        """
+        self._model = underlying if isinstance(underlying, Embeddings) else None
+        self._model_factory = None if self._model is not None else underlying
+        self.model_load_seconds = None
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queries_as_documents = queries_as_documents
+        self._pending = deque()  # (kind, texts, future, enqueued_at)
+        self._pending_texts = 0
+        self._cond = threading.Condition()
+        self._worker = None
+        self.requests = 0
+        self.texts = 0
+        self.batches = 0
+        self.max_batch_seen = 0
+        self.max_queue_depth = 0
+        self.wait_seconds = 0.0
+
+    @property
+    def underlying(self) -> Embeddings:
+        if self._model is None:
+            start = time.perf_counter()
+            self._model = self._model_factory()
+            self.model_load_seconds = round(time.perf_counter() - start, 3)
+            logger.info("loaded embedding model in %.2fs", self.model_load_seconds)
+        return self._model
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        return self._submit("document", list(texts)).result()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._submit("query", [text]).result()[0]
+
+    def stats(self):
+        with self._cond:
+            return {
+                "requests": self.requests,
+                "texts": self.texts,
+                "batches": self.batches,
+                "avg_batch_size": round(self.texts / self.batches, 2) if self.batches else 0.0,
+                "max_batch_size": self.max_batch_seen,
+                "queue_depth": len(self._pending),
+                "max_queue_depth": self.max_queue_depth,
+                "avg_wait_ms": round(self.wait_seconds / self.requests * 1000, 3) if self.requests else 0.0,
+                "model_load_seconds": self.model_load_seconds,
+            }
+
+    def _submit(self, kind, texts):
+        future = Future()
+        with self._cond:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="embedding-service", daemon=True)
+                self._worker.start()
+            self._pending.append((kind, texts, future, time.monotonic()))
+            self._pending_texts += len(texts)
+            self.max_queue_depth = max(self.max_queue_depth, len(self._pending))
+            self._cond.notify()
+        return future
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                deadline = self._pending[0][3] + self.max_wait
+                while self._pending_texts < self.max_batch_size and (remaining := deadline - time.monotonic()) > 0:
+                    self._cond.wait(remaining)
+                batch = self._take_batch()
+            try:
+                self._process(batch)
+            except Exception:
+                logger.exception("embedding batch failed")
+
+    def _take_batch(self):
+        """pop up to `max_batch_size` texts, queries first; called with the lock held"""
+        ordered = sorted(self._pending, key=lambda request: request[0] != "query")
+        batch, size = [], 0
+        for request in ordered:
+            if batch and size + len(request[1]) > self.max_batch_size:
+                continue
+            batch.append(request)
+            size += len(request[1])
+            if size >= self.max_batch_size:
+                break
+        now = time.monotonic()
+        for request in batch:
+            self._pending.remove(request)
+            self.wait_seconds += now - request[3]
+        self._pending_texts -= size
+        self.requests += len(batch)
+        self.texts += size
+        self.batches += 1
+        self.max_batch_seen = max(self.max_batch_seen, size)
+        return batch
+
+    def _process(self, batch):
+        try:
+            model = self.underlying
+        except Exception as e:
+            for request in batch:
+                request[2].set_exception(e)
+            return
+        if self.queries_as_documents:
+            groups = [(model.embed_documents, batch)]
+        else:
+            queries = [request for request in batch if request[0] == "query"]
+            documents = [request for request in batch if request[0] == "document"]
+            groups = [(lambda texts: [model.embed_query(t) for t in texts], queries),
+                      (model.embed_documents, documents)]
+        for embed, requests in groups:
+            if not requests:
+                continue
+            try:
+                vectors = embed([text for request in requests for text in request[1]])
+            except Exception as e:
+                for request in requests:
+                    request[2].set_exception(e)
+                continue
+            start = 0
+            for _, texts, future, _ in requests:
+                future.set_result(vectors[start:start + len(texts)])
+                start += len(texts)
+
+
+def test():
+    class CountingEmbeddings(Embeddings):
+        def __init__(self):
+            self.calls = []
+
+        def embed_documents(self, texts):
+            self.calls.append(len(texts))
+            time.sleep(0.01)
+            return [[float(len(t)), 1.0] for t in texts]
+
+        def embed_query(self, text):
+            return self.embed_documents([text])[0]
+
+    from concurrent.futures import ThreadPoolExecutor
+    model = CountingEmbeddings()
+    service = BatchingEmbeddings(lambda: model, max_batch_size=16, max_wait=0.02, queries_as_documents=True)
+    texts = [f"query {'x' * i}" for i in range(40)]
+    with ThreadPoolExecutor(40) as pool:
+        vectors = list(pool.map(service.embed_query, texts))
+    assert vectors == [[float(len(t)), 1.0] for t in texts]
+    assert service.embed_documents(["a", "bb"]) == [[1.0, 1.0], [2.0, 1.0]]
+    print("model calls:", model.calls)
+    print(service.stats())
+    assert len(model.calls) < len(texts)
+
+
+if __name__ == '__main__':
+    test()
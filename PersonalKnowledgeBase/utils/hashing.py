@@ -0,0 +1,36 @@
+import hashlib
+
+
+def text_hash(text, namespace=""):
+    """
+    Content address of a piece of text.
+    :param text:
+    :param namespace: e.g. a model name, so the same text gets different keys for different models
+    :return: sha256 hex digest
+    """
+    digest = hashlib.sha256()
+    if namespace:
+        digest.update(namespace.encode("utf-8"))
+        digest.update(b"\0")
+    digest.update(text.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def documents_hash(docs):
+    """
+    Content address of a chunked document: hash of the ordered chunk hashes.
+    :param docs: list of langchain Documents
+    """
+    return text_hash("\n".join(text_hash(doc.page_content) for doc in docs), "documents")
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """
+    Content address of a file, read in chunks.
+    :return: sha256 hex digest of the file bytes
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
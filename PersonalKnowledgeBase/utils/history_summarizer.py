@@ -0,0 +1,135 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import get_llm, Args
+from prompts.qa import history_summary_prompt
+from utils.llm_scheduler import llm_scheduler
+
+args = Args()
+logger = logging.getLogger(__name__)
+
+
+class HistorySummarizer:
+    """
+    Folds the messages that leave the history window of a thread into its running summary, off the request
+    path. compact_history hands the dropped messages over with `submit` and picks the new summary up on a
+    later turn with `take`, the previous summary is used meanwhile. The jobs of one thread run in order, each
+    on top of the summary of the previous one.
+    """
+
+    def __init__(self, max_workers=2):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="history-summary")
+        self._threads = {}  # thread_id -> {"summary", "backlog": [(role, text), ...], "running"}
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.summarized = 0
+        self.failures = 0
+
+    def submit(self, thread_id, summary, messages):
+        """
+        queue messages dropped from the window of a thread, returns at once
+        :param summary: current summary of the thread, ignored while an earlier job of the thread is not taken
+        :param messages: BaseMessages, oldest first
+        """
+        with self._lock:
+            self.submitted += 1
+            entry = self._threads.get(thread_id)
+            if entry is None:
+                entry = self._threads[thread_id] = {"summary": summary, "backlog": [], "running": False}
+            entry["backlog"].extend((msg.type, msg.content) for msg in messages)
+            if entry["running"]:
+                return
+            entry["running"] = True
+        self._executor.submit(self._run, thread_id, entry)
+
+    def take(self, thread_id):
+        """
+        :return: latest summary of the thread computed in the background, None if nothing was submitted since
+                 the last call
+        """
+        with self._lock:
+            entry = self._threads.get(thread_id)
+            if entry is None:
+                return None
+            if not entry["running"]:
+                del self._threads[thread_id]
+            return entry["summary"]
+
+    def discard(self, thread_id):
+        with self._lock:
+            self._threads.pop(thread_id, None)
+
+    def flush(self, timeout=None):
+        """wait until no summary is being computed, False on timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                if not any(entry["running"] for entry in self._threads.values()):
+                    return True
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "threads": len(self._threads),
+                "running": sum(1 for entry in self._threads.values() if entry["running"]),
+                "submitted": self.submitted,
+                "summarized": self.summarized,
+                "failures": self.failures,
+            }
+
+    def _run(self, thread_id, entry):
+        while True:
+            with self._lock:
+                if self._threads.get(thread_id) is not entry or not entry["backlog"]:
+                    entry["running"] = False
+                    return
+                messages, entry["backlog"] = entry["backlog"], []
+                summary = entry["summary"]
+            try:
+                summary = self._summarize(summary, messages)
+                with self._lock:
+                    self.summarized += 1
+            except Exception as e:
+                # the turns are still in the chat history store and the long-term memory
+                with self._lock:
+                    self.failures += 1
+                logger.warning("failed to summarize %d messages of thread %s, dropping them: %s", len(messages),
+                               thread_id, e)
+            with self._lock:
+                entry["summary"] = summary
+
+    def _summarize(self, summary, messages):
+        history = "\n".join(f"{role}: {text}\n" for role, text in messages)
+        prompt = history_summary_prompt.invoke({'summary': summary or "(empty)", 'history': history})
+        return llm_scheduler.invoke(get_llm(), prompt.to_messages()).content.strip()
+
+
+def test():
+    from langchain_core.messages import HumanMessage, AIMessage
+
+    summarizer = HistorySummarizer()
+    calls = []
+
+    def summarize(summary, messages):
+        calls.append(len(messages))
+        time.sleep(0.1)
+        return f"{summary}+{len(messages)}"
+
+    summarizer._summarize = summarize
+    turns = [HumanMessage("question"), AIMessage("answer")]
+    summarizer.submit("t1", "s", turns)
+    summarizer.submit("t1", "ignored", turns * 2)  # chained on the first job
+    assert summarizer.take("t2") is None
+    assert summarizer.flush(5)
+    assert summarizer.take("t1") == "s+2+4", calls
+    assert summarizer.take("t1") is None
+    print(summarizer.stats())
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,86 @@
+import logging
+import threading
+import time
+
+from utils.hashing import text_hash
+
+logger = logging.getLogger(__name__)
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """
+    Merge ranked lists of Documents: score(doc) = sum over the lists of 1 / (k + rank).
+    Documents are matched by their Chroma id, or by their text when they have none.
+    :return: list of (Document, score), best first
+    """
+    scores, documents = {}, {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking, start=1):
+            key = doc.id or text_hash(doc.page_content)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+            documents.setdefault(key, doc)
+    return [(documents[key], score) for key, score in sorted(scores.items(), key=lambda item: -item[1])]
+
+
+class CrossEncoderReranker:
+    """Local cross-encoder (sentence-transformers) scoring (query, chunk) pairs, the model is loaded on first use"""
+
+    def __init__(self, model_name, max_length=512):
+        self.model_name = model_name
+        self.max_length = max_length
+        self._model = None
+        self._lock = threading.Lock()
+
+    def rerank(self, query, documents, k):
+        if not documents:
+            return []
+        with self._lock:
+            if self._model is None:
+                from sentence_transformers import CrossEncoder
+                self._model = CrossEncoder(self.model_name, max_length=self.max_length)
+        scores = self._model.predict([(query, doc.page_content) for doc in documents])
+        ranked = sorted(zip(documents, scores), key=lambda item: -float(item[1]))
+        return [doc for doc, _ in ranked[:k]]
+
+
+class HybridRetriever:
+    """
+    Retrieval over one session: BM25 candidates and vector candidates are fused with reciprocal rank fusion,
+    then optionally reranked by a cross-encoder. Exact terms (identifiers, numbers, names) are found by BM25
+    even when the embedding misses them.
+    """
+
+    def __init__(self, vector_store, bm25_index=None, reranker=None, top_k=2, candidate_k=20, rrf_k=60,
+                 filter=None):
+        """
+        :param vector_store: Chroma collection of the session
+        :param bm25_index: BM25Index of the same chunks, None for vector search only
+        :param reranker: CrossEncoderReranker applied to the fused candidates, None to keep the fusion order
+        :param top_k: number of chunks returned
+        :param candidate_k: number of candidates taken from each retriever
+        :param rrf_k: rank offset of the fusion, larger values flatten the rank weights
+        :param filter: metadata filter of the vector search, e.g. {"type": "documents"}
+        """
+        self.vector_store = vector_store
+        self.bm25_index = bm25_index
+        self.reranker = reranker
+        self.top_k = top_k
+        self.candidate_k = candidate_k
+        self.rrf_k = rrf_k
+        self.filter = filter
+
+    def retrieve(self, query, k=None):
+        k = k or self.top_k
+        if self.bm25_index is None and self.reranker is None:
+            return self.vector_store.similarity_search(query, k=k, filter=self.filter)
+
+        start = time.perf_counter()
+        vector_docs = self.vector_store.similarity_search(query, k=self.candidate_k, filter=self.filter)
+        rankings = [vector_docs]
+        if self.bm25_index is not None:
+            rankings.append([doc for doc, _ in self.bm25_index.search(query, k=self.candidate_k)])
+        fused = [doc for doc, _ in reciprocal_rank_fusion(rankings, k=self.rrf_k)]
+        if self.reranker is not None:
+            fused = self.reranker.rerank(query, fused, k)
+        logger.debug("hybrid retrieval of %d candidates in %.1f ms", len(fused), (time.perf_counter() - start) * 1000)
+        return fused[:k]
@@ -0,0 +1,119 @@
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def normalize_query(query):
+    return re.sub(r"\s+", " ", query.strip().lower())
+
+
+def term_pattern(terms):
+    """
+    regex matching any of the terms: latin words as whole words (plural allowed), CJK terms anywhere since
+    they are not separated by spaces
+    """
+    parts = [rf"\b{re.escape(term)}s?\b" if term.isascii() else re.escape(term) for term in terms]
+    return re.compile("|".join(parts)) if parts else None
+
+
+class IntentRouter:
+    """
+    Local first stage of the intent classification: recent decisions are cached, otherwise the query is
+    compared with the centroids of example queries of each intent, a summary keyword only moves the score
+    towards "summarize". `classify` returns None when the margin between the two centroids is too small or the
+    query points at a part of the document ("key points of section 4.2", "第三章讲了什么"), the caller then
+    asks the LLM and reports the answer back with `remember`.
+    """
+
+    def __init__(self, embeddings, summarize_examples, qa_examples, summarize_keywords=(), detail_qualifiers=(),
+                 margin=0.05, keyword_prior=0.05, cache_size=1024):
+        """
+        :param embeddings: langchain Embeddings used for the query and the example centroids
+        :param summarize_examples: example queries asking for a summary of the whole document
+        :param qa_examples: example queries asking about details
+        :param summarize_keywords: words that hint at a summary request
+        :param detail_qualifiers: words that point at a part of the document, the local stages are skipped
+        :param margin: min difference of the cosine similarities to both centroids to trust the embedding
+        :param keyword_prior: added to the summary similarity when a summary keyword is present
+        :param cache_size: number of recent query -> intent decisions kept
+        """
+        self.embeddings = embeddings
+        self.examples = {"summarize": list(summarize_examples), "qa": list(qa_examples)}
+        self.keyword_pattern = term_pattern(summarize_keywords)
+        self.qualifier_pattern = term_pattern(detail_qualifiers)
+        self.margin = margin
+        self.keyword_prior = keyword_prior
+        self.cache_size = cache_size
+        self._centroids = None
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.decisions = {"cache": 0, "rule": 0, "embedding": 0, "llm": 0}
+        self.deferred = 0
+
+    def classify(self, query):
+        """
+        :return: 'summarize', 'qa' or None if the local stages are not confident
+        """
+        key = normalize_query(query)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.decisions["cache"] += 1
+                return self._cache[key]
+
+        if self.qualifier_pattern is not None and self.qualifier_pattern.search(key):
+            with self._lock:
+                self.deferred += 1
+            return None
+
+        scores = self.similarities(query)
+        keyword = self.keyword_pattern is not None and self.keyword_pattern.search(key) is not None
+        if keyword:
+            scores["summarize"] += self.keyword_prior
+        (best, best_score), (_, other_score) = sorted(scores.items(), key=lambda item: -item[1])
+        if best_score - other_score >= self.margin:
+            return self._decide(key, best, "rule" if keyword and best == "summarize" else "embedding")
+        return None
+
+    def similarities(self, query):
+        """cosine similarity between the query and the centroid of each intent"""
+        centroids = self._get_centroids()
+        vector = self._normalize(np.asarray(self.embeddings.embed_query(query), dtype=np.float32))
+        return {intent: float(vector @ centroid) for intent, centroid in centroids.items()}
+
+    def remember(self, query, intent, source="llm"):
+        """store a decision made outside of the router, e.g. by the LLM fallback"""
+        return self._decide(normalize_query(query), intent, source)
+
+    def stats(self):
+        with self._lock:
+            local = self.decisions["cache"] + self.decisions["rule"] + self.decisions["embedding"]
+            total = local + self.decisions["llm"]
+            return {**self.decisions, "deferred": self.deferred, "local_rate": local / total if total else 0.0,
+                    "cached": len(self._cache)}
+
+    def _decide(self, key, intent, source):
+        with self._lock:
+            self.decisions[source] += 1
+            self._cache[key] = intent
+            self._cache.move_to_end(key)
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return intent
+
+    def _get_centroids(self):
+        if self._centroids is None:
+            centroids = {}
+            for intent, examples in self.examples.items():
+                vectors = np.asarray(self.embeddings.embed_documents(examples), dtype=np.float32)
+                vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+                centroids[intent] = self._normalize(vectors.mean(axis=0))
+            self._centroids = centroids
+        return self._centroids
+
+    @staticmethod
+    def _normalize(vector):
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
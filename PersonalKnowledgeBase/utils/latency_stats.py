@@ -0,0 +1,37 @@
+import threading
+from collections import deque
+
+
+class LatencyStats:
+    """
+    Running latency counters: totals since start plus percentiles over the last `window` samples.
+    """
+
+    def __init__(self, window=1000):
+        """
+        :param window: number of recent samples the percentiles are computed from
+        """
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+            self.count += 1
+            self.total += seconds
+
+    def stats(self):
+        with self._lock:
+            samples = sorted(self._samples)
+            count, total = self.count, self.total
+        if not samples:
+            return {"count": count, "mean": 0.0, "p50": 0.0, "p95": 0.0, "max": 0.0}
+        return {
+            "count": count,
+            "mean": round(total / count, 4),
+            "p50": round(samples[len(samples) // 2], 4),
+            "p95": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 4),
+            "max": round(samples[-1], 4),
+        }
@@ -0,0 +1,325 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import deque
+
+from config import Args
+
+args = Args()
+logger = logging.getLogger(__name__)
+
+# errors caused by our own code, retrying them cannot help
+NON_RETRYABLE = (TypeError, KeyError, AttributeError, NotImplementedError)
+
+
+def estimate_prompt_tokens(prompt):
+    """cheap estimate (~4 characters per token) of the tokens of a prompt value, message list or string"""
+    if hasattr(prompt, "to_messages"):
+        prompt = prompt.to_messages()
+    if isinstance(prompt, (list, tuple)):
+        text = "".join(str(getattr(msg, "content", msg)) for msg in prompt)
+    else:
+        text = str(prompt)
+    return max(1, len(text) // 4)
+
+
+class SlotPool:
+    """
+    Counting semaphore shared by threads and coroutines of any event loop. Waiters are served in arrival order,
+    a released slot is handed to the next waiter directly, nobody polls.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._free = size
+        self._waiters = deque()  # threading.Event, or (loop, future) of a coroutine
+        self._lock = threading.Lock()
+
+    @property
+    def in_use(self):
+        with self._lock:
+            return self.size - self._free
+
+    def acquire(self):
+        with self._lock:
+            if self._free and not self._waiters:
+                self._free -= 1
+                return
+            event = threading.Event()
+            self._waiters.append(event)
+        event.wait()
+
+    async def aacquire(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._free and not self._waiters:
+                self._free -= 1
+                return
+            waiter = (loop, loop.create_future())
+            self._waiters.append(waiter)
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    raise
+            if waiter[1].done() and not waiter[1].cancelled():
+                # the slot was granted before the cancellation reached us
+                self.release()
+            # otherwise _grant sees the cancelled future and passes the slot on
+            raise
+
+    def release(self):
+        with self._lock:
+            while self._waiters:
+                waiter = self._waiters.popleft()
+                if isinstance(waiter, threading.Event):
+                    waiter.set()
+                    return
+                loop, future = waiter
+                try:
+                    loop.call_soon_threadsafe(self._grant, future)
+                    return
+                except RuntimeError:
+                    continue  # its loop is closed
+            self._free += 1
+
+    def _grant(self, future):
+        if future.cancelled():
+            self.release()
+        else:
+            future.set_result(None)
+
+
+class LLMScheduler:
+    """
+    Gate for every chat model call: at most `max_in_flight` calls run at the same time, a token bucket keeps
+    the estimated usage under `tokens_per_minute`, and failed calls are retried with exponential backoff.
+    Works from coroutines (`ainvoke`) and from plain threads (`invoke`) with shared limits. A slot is given
+    back however the call ends, including the cancellation of the calling task.
+    """
+
+    def __init__(self, max_in_flight=4, tokens_per_minute=None, max_retries=3, backoff_base=1.0, backoff_max=30.0,
+                 token_estimator=estimate_prompt_tokens):
+        """
+        :param max_in_flight: max number of concurrent calls
+        :param tokens_per_minute: token budget, None for no budget
+        :param max_retries: retries after the first failed attempt
+        :param backoff_base: seconds waited before the first retry, doubled every retry
+        :param backoff_max: upper bound of a single backoff
+        :param token_estimator: (prompt) -> estimated prompt tokens
+        """
+        self.max_in_flight = max_in_flight
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.token_estimator = token_estimator
+        self._slots = SlotPool(max_in_flight)
+        self._lock = threading.Lock()
+        self._tokens = float(tokens_per_minute or 0)
+        self._refilled_at = time.monotonic()
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.cancelled = 0
+        self.tokens_used = 0
+        self.wait_seconds = 0.0
+        self.max_in_flight_seen = 0
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(max_in_flight=args.llm_max_in_flight, tokens_per_minute=args.llm_tokens_per_minute,
+                   max_retries=args.llm_max_retries, backoff_base=args.llm_backoff_base,
+                   backoff_max=args.llm_backoff_max)
+
+    async def ainvoke(self, llm, prompt, **kwargs):
+        cost = self._cost(prompt)
+        for attempt in range(self.max_retries + 1):
+            start = time.monotonic()
+            delay = self._reserve_tokens(cost)
+            try:
+                if delay:
+                    await asyncio.sleep(delay)
+                await self._slots.aacquire()
+            except asyncio.CancelledError:
+                self._refund_tokens(cost)
+                raise
+            self._started(time.monotonic() - start)
+            response, outcome = None, "failed"
+            try:
+                response = await llm.ainvoke(prompt, **kwargs)
+                outcome = "ok"
+            except asyncio.CancelledError:
+                outcome = "cancelled"
+                raise
+            except NON_RETRYABLE:
+                raise
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                error = e
+            finally:
+                self._slots.release()
+                self._finished(cost, response, outcome)
+            if outcome == "ok":
+                return response
+            await asyncio.sleep(self._backoff(attempt, error))
+
+    def invoke(self, llm, prompt, **kwargs):
+        cost = self._cost(prompt)
+        for attempt in range(self.max_retries + 1):
+            start = time.monotonic()
+            delay = self._reserve_tokens(cost)
+            if delay:
+                time.sleep(delay)
+            self._slots.acquire()
+            self._started(time.monotonic() - start)
+            response, outcome = None, "failed"
+            try:
+                response = llm.invoke(prompt, **kwargs)
+                outcome = "ok"
+            except NON_RETRYABLE:
+                raise
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                error = e
+            finally:
+                self._slots.release()
+                self._finished(cost, response, outcome)
+            if outcome == "ok":
+                return response
+            time.sleep(self._backoff(attempt, error))
+
+    def wrap(self, llm):
+        """
+        Runnable calling `llm` through the scheduler, for models that are invoked by library code such as the
+        ReAct agent. The run config is passed on, so callbacks (e.g. astream_events) still see the model.
+        """
+        from langchain_core.runnables import RunnableLambda
+
+        def call(messages, config):
+            return self.invoke(llm, messages, config=config)
+
+        async def acall(messages, config):
+            return await self.ainvoke(llm, messages, config=config)
+
+        return RunnableLambda(call, afunc=acall, name="scheduled_llm")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": self._slots.in_use,
+                "max_in_flight": self.max_in_flight,
+                "max_in_flight_seen": self.max_in_flight_seen,
+                "calls": self.calls,
+                "retries": self.retries,
+                "failures": self.failures,
+                "cancelled": self.cancelled,
+                "tokens_used": self.tokens_used,
+                "tokens_available": None if self.tokens_per_minute is None else int(self._tokens),
+                "wait_seconds": round(self.wait_seconds, 3),
+            }
+
+    def _cost(self, prompt):
+        cost = self.token_estimator(prompt)
+        if self.tokens_per_minute:
+            # a single prompt larger than the whole budget would wait forever
+            cost = min(cost, self.tokens_per_minute)
+        return cost
+
+    def _reserve_tokens(self, cost):
+        """take the tokens of a call from the bucket, return the seconds to wait until they are really there"""
+        if not self.tokens_per_minute:
+            return 0
+        with self._lock:
+            self._refill()
+            # the bucket may go negative: later callers wait behind the tokens already promised
+            self._tokens -= cost
+            return max(0.0, -self._tokens * 60.0 / self.tokens_per_minute)
+
+    def _refund_tokens(self, cost):
+        if self.tokens_per_minute:
+            with self._lock:
+                self._tokens += cost
+
+    def _started(self, waited):
+        with self._lock:
+            self.calls += 1
+            self.wait_seconds += waited
+            self.max_in_flight_seen = max(self.max_in_flight_seen, self._slots.in_use)
+
+    def _finished(self, cost, response, outcome):
+        with self._lock:
+            if outcome == "cancelled":
+                self.cancelled += 1
+                return
+            if outcome == "failed":
+                self.failures += 1
+                return
+            used = cost
+            usage = getattr(response, "usage_metadata", None)
+            if usage and usage.get("total_tokens"):
+                # charge the real usage, including the completion
+                used = usage["total_tokens"]
+                if self.tokens_per_minute:
+                    self._tokens -= used - cost
+            self.tokens_used += used
+
+    def _refill(self):
+        now = time.monotonic()
+        rate = self.tokens_per_minute / 60.0
+        self._tokens = min(float(self.tokens_per_minute), self._tokens + (now - self._refilled_at) * rate)
+        self._refilled_at = now
+
+    def _backoff(self, attempt, error):
+        with self._lock:
+            self.retries += 1
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        delay = random.uniform(delay / 2, delay)
+        logger.warning("llm call failed (%s), retry %d in %.1fs", error, attempt + 1, delay)
+        return delay
+
+
+llm_scheduler = LLMScheduler.from_args(args)
+
+
+async def test():
+    from langchain_core.language_models import FakeListChatModel
+
+    class FlakyChatModel(FakeListChatModel):
+        failures_left: int = 2
+
+        async def ainvoke(self, *a, **kw):
+            if self.failures_left > 0:
+                self.failures_left -= 1
+                raise RuntimeError("429 rate limited")
+            return await super().ainvoke(*a, **kw)
+
+    scheduler = LLMScheduler(max_in_flight=2, tokens_per_minute=600, backoff_base=0.1)
+    fake = FlakyChatModel(responses=[f"summary {i}" for i in range(10)], sleep=0.1)
+    results = await asyncio.gather(*[scheduler.ainvoke(fake, f"chunk {i} " * 40) for i in range(10)])
+    print([r.content for r in results])
+    print(scheduler.stats())
+
+    # cancelled callers give their slot back, waiting or running
+    slow = FakeListChatModel(responses=["slow"], sleep=10)
+    scheduler = LLMScheduler(max_in_flight=2)
+    tasks = [asyncio.create_task(scheduler.ainvoke(slow, "question")) for _ in range(4)]
+    await asyncio.sleep(0.1)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    assert scheduler.stats()["in_flight"] == 0
+    quick = FakeListChatModel(responses=["ok"])
+    assert (await asyncio.wait_for(scheduler.ainvoke(quick, "question"), 1)).content == "ok"
+    assert scheduler.invoke(quick, "question").content == "ok"
+    print(scheduler.stats())
+
+
+if __name__ == "__main__":
+    asyncio.run(test())
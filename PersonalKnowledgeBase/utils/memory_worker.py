@@ -0,0 +1,335 @@
+import logging
+import queue
+import re
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+
+from config import get_llm, get_embeddings, Args
+from prompts.extract_key_info import extract_key_info_prompt
+from utils.chroma_client import get_chroma_client
+from utils.hashing import text_hash
+from utils.llm_scheduler import llm_scheduler
+
+args = Args()
+logger = logging.getLogger(__name__)
+
+MEMORY_TYPE = "memory"
+# memories written before the type was fixed
+LEGACY_MEMORY_TYPES = ("lang-term-memory",)
+MEMORY_COLLECTION_PREFIX = "memory_"
+_BULLET = re.compile(r"^\s*(?:[-*•·]|\d+[.)])\s*")
+
+
+def memory_collection_name(session_id):
+    return MEMORY_COLLECTION_PREFIX + session_id
+
+
+def memory_collection(session_id, chroma_client=None):
+    """
+    Chroma collection of the long-term memories of a session. Memories are kept apart from the chunks of the
+    document: the chunk index is not searched through a metadata filter, and both are tuned on their own.
+    """
+    return (chroma_client or get_chroma_client()).collection(memory_collection_name(session_id),
+                                                             hnsw=args.memory_hnsw)
+
+
+def memory_filter(session_id=None):
+    """
+    chroma filter of the long-term memories (of one session) stored in a document collection, where they
+    were written before they had collections of their own
+    """
+    type_filter = {"type": {"$in": [MEMORY_TYPE, *LEGACY_MEMORY_TYPES]}}
+    if not session_id:
+        return type_filter
+    return {"$and": [type_filter, {"session_id": session_id}]}
+
+
+def parse_facts(text):
+    """bullet points of the extraction answer as separate facts, duplicates within the answer removed"""
+    facts, seen = [], set()
+    for line in text.splitlines():
+        fact = _BULLET.sub("", line).strip().strip("*").strip()
+        key = " ".join(fact.lower().split())
+        if len(key) < 3 or key in seen:
+            continue
+        seen.add(key)
+        facts.append(fact)
+    return facts
+
+
+def normalize_fact(fact):
+    return " ".join(fact.lower().split())
+
+
+class MemoryConsolidator:
+    """
+    Turns chat turns into long-term memories off the request path. Jobs queued by `submit` are taken in
+    batches: the jobs of one session are merged into a single extraction, the extractions of the batch run
+    concurrently (bounded by the llm scheduler), all new facts are embedded in one call, and facts that are
+    already stored for the session (same text, or cosine similarity above `dedup_threshold`) are skipped.
+    """
+
+    def __init__(self, batch_size=args.memory_batch_size, batch_wait=args.memory_batch_wait,
+                 dedup_threshold=args.memory_dedup_threshold, max_queue=args.memory_max_queue,
+                 chroma_client=None, embeddings=None):
+        """
+        :param batch_size: max jobs consolidated together
+        :param batch_wait: seconds the worker waits for more jobs after the first one of a batch
+        :param dedup_threshold: cosine similarity above which a fact counts as already known
+        :param max_queue: jobs beyond it are dropped (the turns stay in the chat history store)
+        :param chroma_client: defaults to the client of args.CHROMA_PERSIST_DIR
+        :param embeddings: defaults to the shared embedding model
+        """
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.dedup_threshold = dedup_threshold
+        self.chroma_client = chroma_client
+        self.embeddings = embeddings
+        self._pending = queue.Queue(maxsize=max_queue)
+        self._executor = ThreadPoolExecutor(max_workers=max(1, args.llm_max_in_flight),
+                                            thread_name_prefix="memory-extract")
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._discarded = set()
+        self._worker = None
+        self.in_flight = 0
+        self.submitted = 0
+        self.dropped = 0
+        self.batches = 0
+        self.jobs_done = 0
+        self.extractions = 0
+        self.facts_extracted = 0
+        self.facts_written = 0
+        self.duplicates = 0
+        self.failures = 0
+        self.last_batch_seconds = None
+
+    def submit(self, session_id, doc_id, messages):
+        """
+        queue the consolidation of chat turns, returns at once
+        :param doc_id: document of the session, nothing is written once it is deleted
+        :param messages: BaseMessages of the turns
+        :return: False if the queue is full and the job was dropped
+        """
+        job = {"session_id": session_id, "doc_id": doc_id, "created_at": time.time(),
+               "messages": [(msg.type, msg.content) for msg in messages]}
+        with self._lock:
+            self._discarded.discard(session_id)
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._work_loop, name="memory-consolidator", daemon=True)
+                self._worker.start()
+        try:
+            self._pending.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            logger.warning("memory queue full, dropped the turns of session %s", session_id)
+            return False
+        with self._lock:
+            self.submitted += 1
+        return True
+
+    def discard(self, session_id):
+        """forget the queued jobs of a deleted session; waits for a write of it that is in progress"""
+        with self._write_lock, self._lock:
+            self._discarded.add(session_id)
+
+    def flush(self, timeout=None):
+        """wait until the queued jobs are consolidated, False on timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._pending.unfinished_tasks:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def _collection_exists(self, doc_id):
+        return (self.chroma_client or get_chroma_client()).collection_metadata(doc_id) is not None
+
+    def _work_loop(self):
+        while True:
+            batch = [self._pending.get()]
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._pending.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            with self._lock:
+                self.in_flight = len(batch)
+            start = time.perf_counter()
+            try:
+                self._consolidate(batch)
+            except Exception as e:
+                with self._lock:
+                    self.failures += len(batch)
+                logger.exception("failed to consolidate %d memory jobs: %s", len(batch), e)
+            finally:
+                with self._lock:
+                    self.in_flight = 0
+                    self.batches += 1
+                    self.jobs_done += len(batch)
+                    self.last_batch_seconds = round(time.perf_counter() - start, 3)
+                for _ in batch:
+                    self._pending.task_done()
+
+    def _extract(self, messages):
+        content = "\n" + "".join(f"{role}: {text}\n" for role, text in messages)
+        prompt = extract_key_info_prompt.invoke({"history": content})
+        return parse_facts(llm_scheduler.invoke(get_llm(), prompt).content)
+
+    def _submit_extract(self, messages):
+        try:
+            return self._executor.submit(self._extract, messages)
+        except RuntimeError:
+            # the interpreter is exiting (services.shutdown runs from atexit) and the pool takes no new work,
+            # the queued jobs are extracted in the worker thread instead
+            future = Future()
+            try:
+                future.set_result(self._extract(messages))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+    def _consolidate(self, batch):
+        # one extraction per session, its queued turns in order
+        sessions = {}
+        for job in batch:
+            entry = sessions.setdefault(job["session_id"], {"doc_id": job["doc_id"], "messages": []})
+            entry["doc_id"] = job["doc_id"]
+            entry["messages"].extend(job["messages"])
+        with self._lock:
+            sessions = {sid: entry for sid, entry in sessions.items() if sid not in self._discarded}
+        if not sessions:
+            return
+
+        futures = {sid: self._submit_extract(entry["messages"]) for sid, entry in sessions.items()}
+        facts = []  # (session_id, doc_id, fact)
+        for sid, future in futures.items():
+            try:
+                facts.extend((sid, sessions[sid]["doc_id"], fact) for fact in future.result())
+            except Exception as e:
+                with self._lock:
+                    self.failures += 1
+                logger.warning("memory extraction of session %s failed: %s", sid, e)
+        with self._lock:
+            self.extractions += len(futures)
+            self.facts_extracted += len(facts)
+        if not facts:
+            return
+
+        embeddings = np.asarray((self.embeddings or get_embeddings()).embed_documents([fact for _, _, fact in facts]), dtype=np.float32)
+        by_session = {}
+        for i, (sid, doc_id, fact) in enumerate(facts):
+            by_session.setdefault((sid, doc_id), []).append(i)
+        for (sid, doc_id), indices in by_session.items():
+            with self._write_lock:
+                with self._lock:
+                    if sid in self._discarded:
+                        continue
+                if not self._collection_exists(doc_id):
+                    # the document was deleted meanwhile, do not recreate its collection
+                    continue
+                self._write(sid, [facts[i][2] for i in indices], embeddings[indices])
+
+    def _write(self, session_id, facts, embeddings):
+        collection = memory_collection(session_id, self.chroma_client)._collection
+        ids = [f"memory_{text_hash(normalize_fact(fact), session_id)[:32]}" for fact in facts]
+        existing = set(collection.get(ids=ids, include=[])["ids"])
+        known = np.zeros((0, embeddings.shape[1]), dtype=np.float32)
+        stored = collection.get(include=["embeddings"])
+        if stored["ids"]:
+            known = np.asarray(stored["embeddings"], dtype=np.float32)
+        keep = []
+        for i, (memory_id, vector) in enumerate(zip(ids, embeddings)):
+            if memory_id in existing or memory_id in {ids[j] for j in keep}:
+                continue
+            candidates = np.vstack([known, embeddings[keep]]) if keep else known
+            if len(candidates):
+                similarity = candidates @ vector / (np.linalg.norm(candidates, axis=1) * np.linalg.norm(vector)
+                                                    + 1e-12)
+                if similarity.max() >= self.dedup_threshold:
+                    continue
+            keep.append(i)
+        with self._lock:
+            self.duplicates += len(facts) - len(keep)
+            self.facts_written += len(keep)
+        if not keep:
+            return
+        now = time.time()
+        collection.upsert(ids=[ids[i] for i in keep], embeddings=embeddings[keep].tolist(),
+                          documents=[facts[i] for i in keep],
+                          metadatas=[{"type": MEMORY_TYPE, "session_id": session_id, "created_at": now}] * len(keep))
+        logger.info("stored %d long-term memories of session %s (%d duplicates)", len(keep), session_id,
+                    len(facts) - len(keep))
+
+    def stats(self):
+        with self._lock:
+            oldest = None
+            with self._pending.mutex:
+                if self._pending.queue:
+                    oldest = round(time.time() - self._pending.queue[0]["created_at"], 3)
+            return {
+                "queued": self._pending.qsize(),
+                "in_flight": self.in_flight,
+                "oldest_queued_seconds": oldest,
+                "submitted": self.submitted,
+                "dropped": self.dropped,
+                "batches": self.batches,
+                "jobs_done": self.jobs_done,
+                "avg_batch_size": round(self.jobs_done / self.batches, 2) if self.batches else None,
+                "last_batch_seconds": self.last_batch_seconds,
+                "extractions": self.extractions,
+                "facts_extracted": self.facts_extracted,
+                "facts_written": self.facts_written,
+                "duplicates": self.duplicates,
+                "failures": self.failures,
+            }
+
+
+def test():
+    import tempfile
+    from langchain_core.embeddings import Embeddings
+    from langchain_core.messages import HumanMessage, AIMessage
+    from utils.chroma_client import ChromaClient
+
+    class WordEmbeddings(Embeddings):
+        def embed_documents(self, texts):
+            vectors = []
+            for text in texts:
+                vector = np.zeros(32)
+                for word in normalize_fact(text).split():
+                    vector[int(text_hash(word)[:8], 16) % 32] += 1
+                vectors.append(vector.tolist())
+            return vectors
+
+        def embed_query(self, text):
+            return self.embed_documents([text])[0]
+
+    assert parse_facts("- likes tea\n* likes tea\n2. lives in Paris\n\n") == ["likes tea", "lives in Paris"]
+    with tempfile.TemporaryDirectory() as tmp:
+        chroma_client = ChromaClient(tmp)
+        chroma_client.collection("doc_a", WordEmbeddings())
+        for session_id in ("s1", "s2"):
+            chroma_client.collection(memory_collection_name(session_id), WordEmbeddings(), hnsw=args.memory_hnsw)
+        consolidator = MemoryConsolidator(batch_wait=0.1, chroma_client=chroma_client, embeddings=WordEmbeddings())
+        consolidator._extract = lambda messages: parse_facts("\n".join(f"- {text}" for _, text in messages))
+        turns = [HumanMessage("my name is Alice"), AIMessage("Nice to meet you Alice")]
+        consolidator.submit("s1", "doc_a", turns)
+        consolidator.submit("s2", "doc_a", turns)
+        consolidator.submit("s1", "doc_a", turns)
+        consolidator.submit("s3", "doc_missing", turns)
+        assert consolidator.flush(10)
+        stored = memory_collection("s1", chroma_client)._collection.get()
+        assert len(stored["ids"]) == 2, stored
+        assert chroma_client.collection_metadata("doc_missing") is None
+        assert chroma_client.collection_metadata(memory_collection_name("s3")) is None
+        print(consolidator.stats())
+        chroma_client.close()
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,200 @@
+import logging
+import threading
+from collections import OrderedDict
+
+from config import Args
+
+args = Args()
+logger = logging.getLogger(__name__)
+
+# keys that are only present while a session is active (loaded on first /ask)
+HEAVY_KEYS = ("vector_store", "memory_store", "bm25_index")
+
+
+def estimate_session_bytes(session, embedding_dim=args.embedding_dim):
+    """
+    Rough memory footprint of an active session: chunk text held by its BM25 index plus the float32 vectors
+    chroma keeps in its HNSW index.
+    :param session: active session with its vector store and BM25 index
+    :param embedding_dim:
+    :return: estimated size in bytes
+    """
+    bm25_index = session.get("bm25_index")
+    if bm25_index is not None:
+        text_bytes, chunks = sum(len(text.encode("utf-8")) for text in bm25_index.texts), len(bm25_index)
+    else:
+        text_bytes, chunks = 0, session["vector_store"]._collection.count()
+    return text_bytes + chunks * embedding_dim * 4
+
+
+class SessionRegistry:
+    """
+    Session store that keeps only metadata (filename, history) for every session and opens the vector store,
+    memory store and BM25 index of a session on first use. Active sessions are evicted in LRU order once
+    `max_active` or `max_active_bytes` is exceeded.
+
+    session_id -> {
+      "history": [ BaseMessage, ... ],
+      "metadatas": {filename, doc_id},  # doc_id: Chroma collection of the document, shared by its sessions
+    }
+    The stores of an active session ("vector_store", "memory_store", "bm25_index") are kept apart, `get`
+    returns a snapshot of the session with them. Evicting a session only drops the registry's reference, a
+    request holding a snapshot keeps using its stores.
+    """
+
+    def __init__(self, metadata_loader, activator, max_active=args.max_active_sessions,
+                 max_active_bytes=args.max_active_session_mb * 1024 * 1024, on_evict=None):
+        """
+        :param metadata_loader: () -> {session_id: {"history": [...], "metadatas": {...}}}
+        :param activator: (session_id, session) -> {"vector_store": ..., "memory_store": ..., "bm25_index": ...}
+        :param max_active: max number of sessions kept active at the same time
+        :param max_active_bytes: max estimated memory of all active sessions
+        :param on_evict: (session_id) -> None, called after a session is evicted, without the registry lock
+        """
+        self._metadata_loader = metadata_loader
+        self._activator = activator
+        self._on_evict = on_evict
+        self.max_active = max_active
+        self.max_active_bytes = max_active_bytes
+        self._sessions = {}
+        self._handles = {}  # session_id -> {key: store for key in HEAVY_KEYS} of the active sessions
+        self._active = OrderedDict()  # session_id -> estimated bytes, least recently used first
+        self._activating = {}  # session_id -> lock held while the session is being activated
+        self._removed = set()  # deleted sessions a concurrent refresh must not bring back
+        self._lock = threading.RLock()
+        self._loaded = False
+
+    def refresh(self, force=False):
+        """
+        load session metadata from the database, once unless forced; sessions already known in memory are
+        kept as they are. The database is read without holding the registry lock
+        """
+        if self._loaded and not force:
+            return
+        sessions = self._metadata_loader()
+        with self._lock:
+            for session_id, session in sessions.items():
+                if session_id not in self._sessions and session_id not in self._removed:
+                    self._sessions[session_id] = session
+            self._loaded = True
+
+    def _known(self, session_id):
+        self.refresh()
+        with self._lock:
+            if session_id in self._sessions:
+                return True
+        # created by another process (or server) since the last load
+        self.refresh(force=True)
+        with self._lock:
+            return session_id in self._sessions
+
+    def list_sessions(self):
+        """
+        :return: [(session_id, session), ...] without activating any session
+        """
+        self.refresh()
+        with self._lock:
+            return list(self._sessions.items())
+
+    def __contains__(self, session_id):
+        return self._known(session_id)
+
+    def peek(self, session_id):
+        """the session metadata as it is, without activating it; None for an unknown session_id"""
+        self._known(session_id)
+        with self._lock:
+            return self._sessions.get(session_id)
+
+    def add(self, session_id, session):
+        """register a session; if it already carries its vector store it is counted as active"""
+        handles = {key: session.pop(key) for key in HEAVY_KEYS if key in session}
+        evicted = []
+        with self._lock:
+            self._removed.discard(session_id)
+            self._sessions[session_id] = session
+            if handles.get("vector_store") is not None:
+                self._handles[session_id] = handles
+                evicted = self._mark_active(session_id, estimate_session_bytes(handles))
+        self._evicted(evicted)
+
+    def get(self, session_id):
+        """
+        Return a snapshot of the session with its vector store and BM25 index loaded, activating it if
+        necessary. The snapshot shares the history list of the registry entry. Only the session being activated
+        waits for its stores, the registry stays available to the others meanwhile.
+        :raise KeyError: unknown session_id
+        """
+        if not self._known(session_id):
+            raise KeyError(session_id)
+        with self._lock:
+            session = self._sessions[session_id]
+            if session_id in self._handles:
+                self._active.move_to_end(session_id)
+                return {**session, **self._handles[session_id]}
+            activating = self._activating.setdefault(session_id, threading.Lock())
+        with activating:
+            with self._lock:
+                if session_id in self._handles:  # activated by a concurrent request
+                    self._active.move_to_end(session_id)
+                    return {**session, **self._handles[session_id]}
+            logger.info("activating session %s", session_id)
+            handles = self._activator(session_id, session)
+            nbytes = estimate_session_bytes(handles)
+            with self._lock:
+                if self._sessions.get(session_id) is not session:
+                    raise KeyError(session_id)  # removed meanwhile
+                self._handles[session_id] = handles
+                evicted = self._mark_active(session_id, nbytes)
+                self._activating.pop(session_id, None)
+        self._evicted(evicted)
+        return {**session, **handles}
+
+    def remove(self, session_id):
+        with self._lock:
+            self._active.pop(session_id, None)
+            self._handles.pop(session_id, None)
+            self._activating.pop(session_id, None)
+            self._removed.add(session_id)
+            return self._sessions.pop(session_id, None)
+
+    def evict(self, session_id):
+        """drop the registry's reference to the stores of a session but keep its metadata"""
+        with self._lock:
+            evicted = self._evict(session_id)
+        self._evicted(evicted)
+
+    def _evict(self, session_id):
+        self._active.pop(session_id, None)
+        if self._handles.pop(session_id, None) is None:
+            return []
+        logger.info("evicted idle session %s", session_id)
+        return [session_id]
+
+    def _evicted(self, session_ids):
+        if self._on_evict is None:
+            return
+        for session_id in session_ids:
+            try:
+                self._on_evict(session_id)
+            except Exception as e:
+                logger.warning("eviction hook failed for session %s: %s", session_id, e)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "active_sessions": len(self._active),
+                "active_bytes": sum(self._active.values()),
+                "max_active": self.max_active,
+                "max_active_bytes": self.max_active_bytes,
+            }
+
+    def _mark_active(self, session_id, nbytes):
+        self._active[session_id] = nbytes
+        self._active.move_to_end(session_id)
+        # always keep the session that was just touched
+        evicted = []
+        while len(self._active) > 1 and (len(self._active) > self.max_active
+                                         or sum(self._active.values()) > self.max_active_bytes):
+            evicted += self._evict(next(iter(self._active)))
+        return evicted
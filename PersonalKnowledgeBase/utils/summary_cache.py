@@ -0,0 +1,94 @@
+import os
+import sqlite3
+import threading
+import time
+
+from utils.hashing import text_hash
+
+
+class SummaryCache:
+    """
+    Side table of map-reduce summaries keyed by content hash.
+    Chunk summaries are keyed by hash(model + chunk text), so a re-uploaded or revised document only summarizes
+    the chunks that changed. Final summaries are keyed by the ordered list of chunk hashes.
+    """
+
+    def __init__(self, path, namespace=""):
+        """
+        :param path: sqlite file of the cache
+        :param namespace: e.g. the chat model name, summaries of different models are kept apart
+        """
+        self.namespace = namespace
+        self.chunk_hits = 0
+        self.chunk_misses = 0
+        self.final_hits = 0
+        self.final_misses = 0
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS chunk_summaries (
+                key TEXT PRIMARY KEY,
+                summary TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS final_summaries (
+                key TEXT PRIMARY KEY,
+                summary TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        self._conn.commit()
+
+    def chunk_key(self, content):
+        return text_hash(content, f"{self.namespace}:chunk")
+
+    def document_key(self, contents):
+        return text_hash("\n".join(self.chunk_key(content) for content in contents), f"{self.namespace}:document")
+
+    def get_chunk_summary(self, content):
+        summary = self._get("chunk_summaries", self.chunk_key(content))
+        with self._lock:
+            if summary is None:
+                self.chunk_misses += 1
+            else:
+                self.chunk_hits += 1
+        return summary
+
+    def put_chunk_summary(self, content, summary):
+        self._put("chunk_summaries", self.chunk_key(content), summary)
+
+    def get_final_summary(self, contents):
+        summary = self._get("final_summaries", self.document_key(contents))
+        with self._lock:
+            if summary is None:
+                self.final_misses += 1
+            else:
+                self.final_hits += 1
+        return summary
+
+    def put_final_summary(self, contents, summary):
+        self._put("final_summaries", self.document_key(contents), summary)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "chunk_hits": self.chunk_hits,
+                "chunk_misses": self.chunk_misses,
+                "final_hits": self.final_hits,
+                "final_misses": self.final_misses,
+            }
+
+    def _get(self, table, key):
+        with self._lock:
+            row = self._conn.execute(f"SELECT summary FROM {table} WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def _put(self, table, key, summary):
+        with self._lock:
+            self._conn.execute(f"INSERT OR REPLACE INTO {table} (key, summary, created_at) VALUES (?, ?, ?)",
+                               (key, summary, time.time()))
+            self._conn.commit()
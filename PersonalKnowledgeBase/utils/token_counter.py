@@ -0,0 +1,68 @@
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+
+_CJK = r"\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"
+# one match per CJK character, word, digit run or other symbol
+_TOKEN_PATTERN = re.compile(rf"[{_CJK}]|[^\W\d_{_CJK}]+|\d+|[^\w\s]", re.UNICODE)
+
+
+def approx_token_count(text):
+    """
+    Local approximation of a BPE/SentencePiece token count: every CJK character and symbol is one token,
+    words cost about one token per 6 characters and numbers one token per 3 digits.
+    """
+    count = 0
+    for match in _TOKEN_PATTERN.finditer(text):
+        piece = match.group()
+        if len(piece) == 1:
+            count += 1
+        elif piece.isdigit():
+            count += (len(piece) + 2) // 3
+        else:
+            count += (len(piece) + 5) // 6
+    return count
+
+
+class TokenCounter:
+    """
+    Memoized token counting with a pluggable backend, e.g. `approx_token_count` or `llm.get_num_tokens`.
+    Counts are cached per string, keyed by a hash of its content, so summaries measured again in later
+    collapse rounds cost a dict lookup.
+    """
+
+    def __init__(self, count_fn=approx_token_count, max_entries=50000):
+        """
+        :param count_fn: (text) -> number of tokens
+        :param max_entries: max number of cached counts, least recently used ones are dropped first
+        """
+        self.count_fn = count_fn
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def count(self, text):
+        key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return cached
+        tokens = self.count_fn(text)
+        with self._lock:
+            self.misses += 1
+            self._cache[key] = tokens
+            if len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return tokens
+
+    def count_documents(self, documents):
+        return sum(self.count(doc.page_content) for doc in documents)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._cache)}
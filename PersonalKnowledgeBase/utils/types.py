@@ -1,7 +1,8 @@
 from typing import TypedDict, List, Annotated, Literal
 import operator
 from langchain_core.documents import Document
-from langchain_core.messages import BaseMessage
+from langchain_core.messages import BaseMessage, RemoveMessage
+from langgraph.graph.message import REMOVE_ALL_MESSAGES
 
 
 class SummaryOverallState(TypedDict):
@@ -15,10 +16,22 @@ class SummaryState(TypedDict):
     content: str
 
 
+def window_history(left, right):
+    """
+    history reducer: new messages are appended, a RemoveMessage(id=REMOVE_ALL_MESSAGES) replaces the history
+    with the messages after it (used to seed a thread and to drop the turns folded into history_summary)
+    """
+    for i in range(len(right) - 1, -1, -1):
+        if isinstance(right[i], RemoveMessage) and right[i].id == REMOVE_ALL_MESSAGES:
+            return list(right[i + 1:])
+    return left + right
+
+
 class OrchestratorState(TypedDict):
     task: Literal['summarize', 'qa']
     query: str
-    contents: List[Document]
+    doc_id: str
     final_summary: str
     final_answer: str
-    history: Annotated[List[BaseMessage], operator.add]
\ No newline at end of file
+    history: Annotated[List[BaseMessage], window_history]
+    history_summary: str
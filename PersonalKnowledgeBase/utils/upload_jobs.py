@@ -0,0 +1,102 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import Args
+
+args = Args()
+logger = logging.getLogger(__name__)
+
+FINISHED_STAGES = ("done", "failed")
+
+
+class UploadJobManager:
+    """
+    Runs ingestion jobs on a worker pool and keeps their status for polling.
+    job_id -> {
+      "job_id", "filename", "stage": queued | indexing | done | failed,
+      "chunks", "pages", "timings": {queued, parse, embed, total}, "error", "created_at", "finished_at"
+    }
+    """
+
+    def __init__(self, max_workers=args.upload_workers, job_ttl=args.upload_job_ttl):
+        """
+        :param max_workers: number of uploads ingested at the same time
+        :param job_ttl: seconds a finished job stays available to /upload_status
+        """
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="upload")
+        self.job_ttl = job_ttl
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, job_id, func, *func_args, **info):
+        """
+        Queue `func(job_id, *func_args)`; the function reports its progress through `update`.
+        :param info: extra fields stored in the job status, e.g. filename
+        """
+        now = time.time()
+        with self._lock:
+            self._prune(now)
+            self._jobs[job_id] = {
+                "job_id": job_id, "stage": "queued", "chunks": 0, "pages": 0,
+                "timings": {}, "error": None, "created_at": now, "finished_at": None, **info,
+            }
+        self.executor.submit(self._run, job_id, func, *func_args)
+        return self.get(job_id)
+
+    def complete(self, job_id, **info):
+        """record a job that needed no work, e.g. an upload of a document that is already indexed"""
+        now = time.time()
+        with self._lock:
+            self._prune(now)
+            self._jobs[job_id] = {
+                "job_id": job_id, "stage": "done", "chunks": 0, "pages": 0,
+                "timings": {"total": 0.0}, "error": None, "created_at": now, "finished_at": now, **info,
+            }
+        return self.get(job_id)
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            timings = fields.pop("timings", None)
+            if timings:
+                job["timings"].update(timings)
+            job.update(fields)
+            if job["stage"] in FINISHED_STAGES and job["finished_at"] is None:
+                job["finished_at"] = time.time()
+                job["timings"]["total"] = round(job["finished_at"] - job["created_at"], 3)
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return None if job is None else {**job, "timings": dict(job["timings"])}
+
+    def is_pending(self, job_id):
+        job = self.get(job_id)
+        return job is not None and job["stage"] not in FINISHED_STAGES
+
+    def stats(self):
+        with self._lock:
+            stages = {}
+            for job in self._jobs.values():
+                stages[job["stage"]] = stages.get(job["stage"], 0) + 1
+            return {"jobs": len(self._jobs), "stages": stages}
+
+    def _run(self, job_id, func, *func_args):
+        with self._lock:
+            job = self._jobs[job_id]
+            job["timings"]["queued"] = round(time.time() - job["created_at"], 3)
+        try:
+            func(job_id, *func_args)
+        except Exception as e:
+            logger.exception("upload job %s failed: %s", job_id, e)
+            self.update(job_id, stage="failed", error=str(e))
+
+    def _prune(self, now):
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job["finished_at"] is not None and now - job["finished_at"] > self.job_ttl]
+        for job_id in expired:
+            del self._jobs[job_id]